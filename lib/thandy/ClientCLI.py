@@ -13,6 +13,7 @@ import thandy.util
 from thandy.util import logCtrl
 import thandy.repository
 import thandy.download
+import thandy.asyncdownload
 import thandy.master_keys
 import thandy.packagesys.PackageSystem
 import thandy.socksurls
@@ -73,7 +74,10 @@ def update(args):
         [ "repo=", "no-download", "loop", "no-packagesys",
           "install", "socks-port=", "debug", "info",
           "warn", "force-check", "controller-log-format",
-          "download-method="
+          "download-method=", "rehash", "persist-sig-cache",
+          "verify-workers=", "download-engine=", "hedge", "hedge-delay=",
+          "max-threads=", "max-per-mirror=", "speculative",
+          "chunk-store"
           ])
     download = True
     keep_looping = False
@@ -82,6 +86,16 @@ def update(args):
     socksPort = None
     forceCheck = False
     downloadMethod = "direct"
+    rehash = False
+    persistSigCache = False
+    verifyWorkers = 0
+    downloadEngine = "threads"
+    hedge = False
+    hedgeDelay = None
+    maxThreads = None
+    maxPerMirror = None
+    speculative = False
+    chunkStore = False
 
     for o, v in options:
         if o == '--repo':
@@ -100,6 +114,27 @@ def update(args):
             forceCheck = True
         elif o == '--download-method':
             downloadMethod = v
+        elif o == '--rehash':
+            rehash = True
+        elif o == '--persist-sig-cache':
+            persistSigCache = True
+        elif o == '--verify-workers':
+            verifyWorkers = int(v)
+        elif o == '--download-engine':
+            downloadEngine = v
+        elif o == '--hedge':
+            hedge = True
+        elif o == '--hedge-delay':
+            hedge = True
+            hedgeDelay = float(v)
+        elif o == '--max-threads':
+            maxThreads = int(v)
+        elif o == '--max-per-mirror':
+            maxPerMirror = int(v)
+        elif o == '--speculative':
+            speculative = True
+        elif o == '--chunk-store':
+            chunkStore = True
 
     configureLogs(options)
 
@@ -112,15 +147,52 @@ def update(args):
         usage()
         sys.exit()
 
-    repo = thandy.repository.LocalRepository(repoRoot)
-    downloader = thandy.download.DownloadManager()
-    downloader.start()
+    if downloadEngine not in ("threads", "eventloop"):
+        usage()
 
-    filesDownloaded = []
+    repo = thandy.repository.LocalRepository(repoRoot,
+                                  persistSignatureCache=persistSigCache,
+                                  verifyWorkers=verifyWorkers,
+                                  useChunkStore=chunkStore)
+    if rehash:
+        repo.getDigestCache().clear()
+    # What we know about the mirrors survives from one run to the next.
+    statusLog = thandy.download.DownloadStatusLog.load(
+        thandy.util.userFilename("download-status.json"))
+    if downloadEngine == "eventloop":
+        downloader = thandy.asyncdownload.EventLoopDownloadManager(
+            statusLog=statusLog, maxThreads=maxThreads,
+            maxPerMirror=maxPerMirror)
+    else:
+        downloader = thandy.download.DownloadManager(
+            statusLog=statusLog, maxThreads=maxThreads,
+            maxPerMirror=maxPerMirror)
+    downloader.start()
 
-    # XXXX We could make this loop way smarter.  Right now, it doesn't
-    # back off between failures, and it doesn't notice newly downloadable files
-    # until all downloading files are finished.
+    try:
+        _runUpdate(repo, downloader, statusLog, args, repoRoot,
+                   use_packagesys=use_packagesys, install=install,
+                   keep_looping=keep_looping, download=download,
+                   forceCheck=forceCheck, socksPort=socksPort, hedge=hedge,
+                   hedgeDelay=hedgeDelay, speculative=speculative)
+    finally:
+        # Don't leave our verification workers running.
+        repo.close()
+
+def _runUpdate(repo, downloader, statusLog, args, repoRoot, use_packagesys,
+               install, keep_looping, download, forceCheck, socksPort, hedge,
+               hedgeDelay, speculative):
+    """Helper for update: plan, download, and install until we're done,
+       using the options that update parsed."""
+    # Every file we have asked for since we last ran out of work.
+    filesDownloaded = set()
+    # Files that a mirror told us haven't changed since we fetched them.
+    notModified = set()
+
+    # We plan again whenever a download finishes, so that anything it
+    # makes fetchable starts downloading while other files are still
+    # arriving.  Planning again is cheap: getFilesToUpdate only looks
+    # closely at the files that have changed.
     while True:
         hashes = {}
         lengths = {}
@@ -137,12 +209,22 @@ def update(args):
               btMetadataDict=btMetadata,
               alreadyInstalledSet=alreadyInstalled,
               cacheRoot=repoRoot)
+        repo.saveCaches()
 
         if forceCheck:
             files.add("/meta/timestamp.txt")
             forceCheck = False
 
         if installable and not files:
+            # Don't install while downloads we started (such as
+            # speculative ones) are still writing into our cache, or
+            # abandon them by returning.  Let them finish, then plan
+            # again, in case they changed anything.
+            if not downloader.finished():
+                logging.debug("Waiting for outstanding downloads.")
+                downloader.wait()
+                continue
+
             for bundle, transaction in installable.items():
                 if transaction.isReady():
                     logCtrl("READY", BUNDLE=bundle)
@@ -159,11 +241,24 @@ def update(args):
                        content=", ".join(sorted(filesDownloaded)))
             return
 
-        elif not files:
-            logging.info("No files to download")
+        # A file that a mirror just said is unchanged, but that we still
+        # need, is one that no mirror can give us yet.  (Most often this
+        # is an out-of-date timestamp.)  Asking again at once won't help,
+        # so we wait as if there were nothing to do -- but we don't
+        # install anything from metadata we can't trust to be current.
+        fetchable = files - notModified
+        if not fetchable and downloader.finished():
+            if files:
+                logging.warn("The mirrors have nothing newer than our "
+                             "copies of %s; can't update until they do.",
+                             ", ".join(sorted(files)))
+            else:
+                logging.info("No files to download")
             if not keep_looping:
                 return
 
+            filesDownloaded = set()
+            notModified = set()
             ts = repo.getTimestampFile().get()
             age = time.time() - thandy.formats.parseTime(ts['at'])
             delay = thandy.repository.MAX_TIMESTAMP_AGE - age
@@ -175,9 +270,12 @@ def update(args):
             time.sleep(delay)
             continue
 
-        for f in files: logCtrl("WANTFILE", FILENAME=f)
-        logging.info("Files to download are: %s", ", ".join(sorted(files)))
-        filesDownloaded = files
+        newFiles = sorted(f for f in fetchable
+                          if not downloader.isCurrentlyDownloading(f))
+        for f in newFiles: logCtrl("WANTFILE", FILENAME=f)
+        if newFiles:
+            logging.info("Files to download are: %s", ", ".join(newFiles))
+        filesDownloaded.update(files)
 
         if not download:
             return
@@ -186,27 +284,13 @@ def update(args):
         if not mirrorlist:
             mirrorlist = thandy.master_keys.DEFAULT_MIRRORLIST
 
-        if files:
-            waitTill = min(downloader.getRetryTime(mirrorlist, f)
-                           for f in files)
-            now = time.time()
-            if waitTill > now:
-                delay = int(waitTill - now) + 1
-                logging.info("Waiting another %s seconds before we are willing "
-                             "to retry any mirror.", delay)
-                logCtrl("WAIT", FOR="MIRROR")
-                time.sleep(delay)
-                continue
-
+        # The downloader holds back any file that no mirror will give us
+        # yet, and gets on with the others.
         logging.debug("Launching downloads")
-        now = time.time()
-        for f in files:
-            if downloader.getRetryTime(mirrorlist, f) > now:
-                logging.info("Waiting a while before we fetch %s", f)
-                continue
-
+        for f in newFiles:
             dj = None
-            if thandy.bt_compat.BtCompat.shouldUseBt() and downloadingFiles:
+            if thandy.bt_compat.BtCompat.shouldUseBt() and downloadingFiles \
+                   and f in btMetadata:
                 dj = thandy.download.ThandyBittorrentDownloadJob(
                     repo.getFilename(btMetadata[f]), f,
                     repo.getFilename(f),
@@ -221,9 +305,14 @@ def update(args):
                     wantHash=hashes.get(f),
                     wantLength=lengths.get(f),
                     repoFile=repo.getRequestedFile(f),
-                    useTor=(socksPort!=None))
-
-            def successCb(rp=f):
+                    useTor=(socksPort!=None),
+                    hedge=hedge, hedgeDelay=hedgeDelay)
+
+            def successCb(rp=f, dj=dj):
+                if dj.wasNotModified():
+                    notModified.add(rp)
+                else:
+                    notModified.discard(rp)
                 rf = repo.getRequestedFile(rp)
                 if rf != None:
                     rf.clear()
@@ -233,9 +322,32 @@ def update(args):
 
             downloader.addDownloadJob(dj)
 
-        logging.debug("Waiting for downloads to finish.")
-        downloader.wait()
-        logging.info("All downloads finished.")
+        # While we're still fetching the metadata that lets us check
+        # bundles and packages, guess which ones we'll need from the
+        # metadata we have so far, and fetch them too.
+        if speculative and [ f for f in files if f.startswith("/meta/") ]:
+            now = time.time()
+            specHashes = {}
+            specLengths = {}
+            for f in sorted(repo.getSpeculativeFiles(args, specHashes,
+                                                     specLengths)):
+                if downloader.isCurrentlyDownloading(f) or \
+                       downloader.getRetryTime(mirrorlist, f) > now:
+                    continue
+                logCtrl("PREFETCH", FILENAME=f)
+                downloader.addDownloadJob(thandy.download.ThandyDownloadJob(
+                    f, repo.getQuarantineFilename(f),
+                    mirrorlist,
+                    wantHash=specHashes[f],
+                    wantLength=specLengths[f],
+                    useTor=(socksPort!=None)))
+
+        logging.debug("Waiting for a download to finish.")
+        downloader.wait(anyJob=True)
+        try:
+            statusLog.save()
+        except (OSError, IOError), e:
+            logging.warn("Couldn't save download status: %s", e)
 
 def json2xml(args):
     if len(args) != 1:
@@ -252,6 +364,11 @@ def usage():
     print "         [--debug|--info|--warn] [--force-check]"
     print "         [--controller-log-format]"
     print "         [--download-method=direct|bittorrent]"
+    print "         [--rehash] [--persist-sig-cache] [--verify-workers=N]"
+    print "         [--download-engine=threads|eventloop]"
+    print "         [--hedge] [--hedge-delay=seconds]"
+    print "         [--max-threads=N] [--max-per-mirror=N] [--speculative]"
+    print "         [--chunk-store]"
     print "         bundle1, bundle2, ..."
     print "  json2xml file"
     sys.exit(1)
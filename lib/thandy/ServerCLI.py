@@ -35,17 +35,37 @@ def snarfObj(fname):
     finally:
         f.close()
 
+def writeCompressed(fname, content):
+    """Write the gzipped sibling of the repository file 'fname', whose
+       contents are 'content'."""
+    gzFname = fname + ".gz"
+    thandy.util.replaceFile(gzFname, thandy.util.gzipString(content))
+    os.chmod(gzFname, 0644)
+
+def writeRepoFile(fname, content, compress=False):
+    """Replace the repository file 'fname' with 'content'.  Write its
+       gzipped sibling too if 'compress', or if it already has one, so
+       that a mirror never serves a stale gzipped copy."""
+    thandy.util.replaceFile(fname, content)
+    os.chmod(fname, 0644)
+    if compress or os.path.exists(fname + ".gz"):
+        writeCompressed(fname, content)
+
 def insert(args):
     repo = os.environ.get("THANDY_MASTER_REPO")
     backupDir = thandy.util.userFilename("old_files")
     checkSigs = True
+    compress = False
 
-    options, args = getopt.getopt(args, "", ["repo=", "no-check"])
+    options, args = getopt.getopt(args, "", ["repo=", "no-check",
+                                             "compress"])
     for o,v in options:
         if o == "--repo":
             repo = v
         elif o == "--no-check":
             checkSigs = False
+        elif o == "--compress":
+            compress = True
 
     if not repo:
         print "No repository specified."
@@ -93,6 +113,9 @@ def insert(args):
             oldContents = snarf(targetPath)
             if oldContents == content:
                 print "  File unchanged!"
+                if compress and not os.path.exists(targetPath + ".gz"):
+                    print "  Writing %s.gz..."%targetPath
+                    writeCompressed(targetPath, content)
                 n_ok += 1
                 continue
 
@@ -106,8 +129,7 @@ def insert(args):
             print "  Making %s"%parentDir
             os.makedirs(parentDir, 0755)
         print "  Replacing file..."
-        thandy.util.replaceFile(targetPath, content)
-        os.chmod(targetPath, 0644)
+        writeRepoFile(targetPath, content, compress)
         print "  Done."
         n_ok += 1
     if n_ok != len(args):
@@ -116,13 +138,16 @@ def insert(args):
 def timestamp(args):
     repo = os.environ.get("THANDY_MASTER_REPO")
     ts_keyfile = thandy.util.userFilename("timestamp_key")
+    compress = False
 
-    options, args = getopt.getopt(args, "", ["repo=", "ts-key="])
+    options, args = getopt.getopt(args, "", ["repo=", "ts-key=", "compress"])
     for o,v in options:
         if o == "--repo":
             repo = v
         elif o == "--ts-key":
             ts_keyfile = v
+        elif o == "--compress":
+            compress = True
 
     if repo == None:
         print "No repository specified."
@@ -147,6 +172,9 @@ def timestamp(args):
     bundles = []
     for dirpath, dirname, fns in os.walk(os.path.join(repo, "bundleinfo")):
         for fn in fns:
+            if fn.endswith(".gz"):
+                # A gzipped copy of a bundle we'll read anyway.
+                continue
             fn = os.path.join(dirpath, fn)
             try:
                 bObj, bLen = snarfObj(fn)
@@ -176,13 +204,42 @@ def timestamp(args):
         thandy.formats.sign(signable, k)
 
     content = json.dumps(signable, sort_keys=True)
-    thandy.util.replaceFile(tsFname, content)
-    os.chmod(tsFname, 0644)
+    writeRepoFile(tsFname, content, compress)
+
+def compress(args):
+    repo = os.environ.get("THANDY_MASTER_REPO")
+
+    options, args = getopt.getopt(args, "", ["repo="])
+    for o,v in options:
+        if o == "--repo":
+            repo = v
+
+    if repo == None:
+        print "No repository specified."
+        usage()
+    if not os.path.exists(repo):
+        print "No such repository as %r"%repo
+        usage()
+
+    n_ok = 0
+    for path in args:
+        fn = os.path.join(repo, path.lstrip("/"))
+        try:
+            content = snarf(fn)
+        except (OSError, IOError), e:
+            print "Couldn't open %s: %s"%(fn, e)
+            continue
+        print "Writing %s.gz..."%fn
+        writeCompressed(fn, content)
+        n_ok += 1
+    if n_ok != len(args):
+        sys.exit(1)
 
 def usage():
     print "Known commands:"
-    print "  insert [--no-check] [--repo=repository] file ..."
-    print "  timestamp [--repo=repository]"
+    print "  insert [--no-check] [--compress] [--repo=repository] file ..."
+    print "  timestamp [--compress] [--repo=repository]"
+    print "  compress [--repo=repository] path ..."
     sys.exit(1)
 
 def main():
@@ -190,7 +247,7 @@ def main():
         usage()
     cmd = sys.argv[1]
     args = sys.argv[2:]
-    if cmd in [ "insert", "timestamp" ]:
+    if cmd in [ "insert", "timestamp", "compress" ]:
         globals()[cmd](args)
     else:
         usage()
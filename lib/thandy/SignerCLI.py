@@ -8,6 +8,7 @@ import thandy.keys
 import thandy.formats
 import thandy.util
 import thandy.bt_compat
+import thandy.delta
 
 json = thandy.util.importJSON()
 
@@ -48,20 +49,85 @@ def getKey(ks, keyid=None, role=None, path=None):
 
 # ------------------------------
 
+def makedelta(fromFile, dataFile, relpath):
+    """Write a delta from fromFile to dataFile, for the repository file at
+       relpath, into the current directory.  Return the delta's relative
+       path in the repository and its filename."""
+    f = open(fromFile, 'rb')
+    old = f.read()
+    f.close()
+    f = open(dataFile, 'rb')
+    new = f.read()
+    f.close()
+    deltaRelpath = "%s.delta-%s" % (
+        relpath, thandy.formats.getDigest(old).encode("hex")[:16])
+    location = os.path.split(deltaRelpath)[-1]
+    print "Writing delta from %s to %s"%(fromFile, location)
+    thandy.util.replaceFile(location, thandy.delta.makeDelta(old, new))
+    return deltaRelpath, location
+
+def makechunks(dataFile, relpath):
+    """Split dataFile into pieces for a chunk store.  Write the pieces
+       under "chunks" in the current directory, and the chunk index for
+       the repository file at relpath into the current directory.  Return
+       the index's relative path in the repository and its filename."""
+    f = open(dataFile, 'rb')
+    data = f.read()
+    f.close()
+    index, chunks = thandy.formats.makeChunkIndex(data)
+    nNew = 0
+    for chunkRelpath, content in chunks:
+        fname = chunkRelpath[1:]
+        if os.path.exists(fname):
+            continue
+        thandy.util.ensureParentDir(fname)
+        thandy.util.replaceFile(fname, content)
+        nNew += 1
+    print "Wrote %s new chunks of %s to chunks/"%(nNew, len(chunks))
+    indexRelpath = relpath + ".chunks"
+    location = os.path.split(indexRelpath)[-1]
+    print "Writing chunk index to %s"%location
+    f = open(location, 'w')
+    json.dump(index, f, indent=1, sort_keys=True)
+    f.close()
+    return indexRelpath, location
+
 def makepackage(args):
-    options, args = getopt.getopt(args, "", "keyid=")
+    options, args = getopt.getopt(args, "", ["keyid=", "delta-from=",
+                                             "chunks"])
     keyid = None
+    deltaFrom = []
+    chunks = False
     for o,v in options:
         if o == "--keyid":
             keyid = v
+        elif o == "--delta-from":
+            if "=" not in v:
+                usage()
+            deltaFrom.append(v.split("=", 1))
+        elif o == "--chunks":
+            chunks = True
 
     if len(args) < 2:
         usage()
 
     configFile = args[0]
     dataFile = args[1]
+    deltas = []
+    chunkIndex = None
+    if deltaFrom or chunks:
+        ignore = lambda lang, val: None
+        relpath = thandy.formats.readConfigFile(
+            configFile, ['relpath'],
+            preload={ 'ShortDesc' : ignore, 'LongDesc' : ignore })['relpath']
+        for fromRelpath, fromFile in deltaFrom:
+            deltaRelpath, location = makedelta(fromFile, dataFile, relpath)
+            deltas.append((fromRelpath, fromFile, deltaRelpath, location))
+        if chunks:
+            chunkIndex = makechunks(dataFile, relpath)
     print "Generating package."
-    package = thandy.formats.makePackageObj(configFile, dataFile)
+    package = thandy.formats.makePackageObj(configFile, dataFile, deltas,
+                                            chunkIndex)
     relpath = package['location']
     print "need a key with role matching [package %s]"%relpath
     ks = getKeyStore()
@@ -306,7 +372,8 @@ def usage():
     print "  addrole keyid role path"
     print "  delrole keyid role path"
     print "  dumpkey [--include-secret] keyid"
-    print "  makepackage config datafile"
+    print "  makepackage [--delta-from=relpath=oldfile ...] [--chunks]"
+    print "              config datafile"
     print "  makebundle config packagefile ..."
     print "  signkeylist keylist"
     print "  makekeylist keylist"
@@ -0,0 +1,679 @@
+# Copyright 2008 The Tor Project, Inc.  See LICENSE for licensing information.
+
+"""An event-loop download engine.  Instead of giving each download a
+   thread, EventLoopDownloadManager runs all of its HTTP transfers in the
+   thread that calls wait(), using non-blocking sockets and asyncore, so
+   that hundreds of files can be in flight at once.  Looking up a host
+   name can block, so a few background threads do that for us.
+"""
+
+import asyncore
+import httplib
+import logging
+import os
+import Queue
+import select
+import socket
+import sys
+import threading
+import time
+import urllib
+import urllib2
+import cStringIO
+
+import thandy.download
+import thandy.socksurls
+
+# How long to wait for network activity before looking at our timeouts
+# and at our worker thread.
+_POLL_INTERVAL = 0.5
+# Give up on a connection that has sent and received nothing for this
+# many seconds.
+_IDLE_TIMEOUT = 120
+# Refuse responses whose headers are longer than this.
+_MAX_HEADER_LEN = 64*1024
+# select() can't handle a lot of sockets on some platforms; use poll()
+# when we have it.
+_USE_POLL = hasattr(select, "poll")
+# How many threads look up host names for an EventLoopDownloadManager,
+# how long we remember the answers, and how often we check for new ones
+# while we're waiting for network activity.
+_RESOLVER_THREADS = 4
+_RESOLVE_CACHE_TIME = 60
+_RESOLVE_POLL_INTERVAL = 0.05
+
+def _formatRequest(host, port, path, haveLength, headers={}):
+    """Return an HTTP request for 'path' on host:port, asking for
+       everything after the first haveLength bytes if haveLength is set,
+       and sending any other headers in 'headers'.
+
+       We speak HTTP/1.0 so that the server won't send the body chunked,
+       and close the connection when we're done.
+    """
+    if port != 80:
+        host = "%s:%d" % (host, port)
+    lines = [ "GET %s HTTP/1.0" % (path or "/"),
+              "Host: %s" % host,
+              "Connection: close" ]
+    if haveLength is not None:
+        lines.append("Range: bytes=%s-" % haveLength)
+    for k, v in sorted(headers.items()):
+        lines.append("%s: %s" % (k, v))
+    return "\r\n".join(lines) + "\r\n\r\n"
+
+def canUseEventLoop(url, useTor):
+    """Return true iff an EventLoopDownloadManager can fetch 'url' itself.
+       We only speak plain HTTP, and we don't talk to HTTP proxies."""
+    urltype = urllib2.splittype(url)[0]
+    if urltype is None or urltype.lower() != "http":
+        return False
+    return bool(useTor) or "http" not in urllib.getproxies()
+
+class EventLoopDownloadManager(thandy.download.DownloadManager):
+    """A DownloadManager that runs up to maxConcurrent downloads at once
+       in the thread that calls wait(), instead of in worker threads.  As
+       with DownloadManager, we hold at most maxPerMirror connections to
+       any one mirror.
+
+       Jobs we can't run in the event loop -- ones that don't use HTTP,
+       or that use a proxy other than Tor, or BitTorrent -- go to a
+       worker thread, as with DownloadManager.  Either way, job callbacks
+       run in the thread that calls wait(), and every result goes to
+       statusLog.
+    """
+    ## Fields:
+    #   _map: the asyncore socket map holding our _EventLoopTransfers.
+    #   _pending: a DownloadQueue of jobs waiting for a slot in the event
+    #     loop.
+    #   _nActive: how many jobs the event loop is running.
+    #   _held: a list of jobs we took from _pending, but held back
+    #     because every mirror that has their files is at its limit.
+    #   _hedges: a list of the _EventLoopHedges we're running.
+    #   _resolver: the _Resolver that looks up host names for us.
+    #   nEventLoop, nThreaded: how many jobs we've run in the event
+    #     loop, and how many we've given to a worker thread.
+    def __init__(self, maxConcurrent=100, n_threads=1, statusLog=None,
+                 maxThreads=None, maxPerMirror=None):
+        thandy.download.DownloadManager.__init__(self, n_threads, statusLog,
+                                                 maxThreads, maxPerMirror)
+        self._maxConcurrent = maxConcurrent
+        self._map = {}
+        self._pending = thandy.download.DownloadQueue()
+        self._nActive = 0
+        self._held = []
+        self._hedges = []
+        self._resolver = _Resolver(self)
+        self.nEventLoop = 0
+        self.nThreaded = 0
+
+    def _dispatch(self, job):
+        if job._usesTransfers:
+            self._pending.put(job)
+        else:
+            self.nThreaded += 1
+            self._queueForThread(job)
+
+    def wait(self, anyJob=False):
+        """Run our downloads until we have no active or pending jobs, or
+           if 'anyJob', until any job has finished."""
+        while not self.finished():
+            delay = self._releaseDelayed()
+            self._launchPending()
+            # Connect the transfers whose hosts we've looked up, including
+            # any we just started with numeric or cached addresses.
+            self._resolver.runCallbacks()
+            if self._map:
+                asyncore.loop(timeout=self._getPollTimeout(delay),
+                              use_poll=_USE_POLL, map=self._map, count=1)
+                now = time.time()
+                self._expireIdle(now)
+                for h in self._hedges[:]:
+                    h.checkTimer(now)
+            elif self._pending.empty() or self._resolver.isBusy():
+                # Only our worker thread or our resolver has anything
+                # to do.
+                self.done.acquire()
+                self.done.wait(self._getPollTimeout(delay))
+                self.done.release()
+                # It may have been using a connection that a held job
+                # was waiting for.
+                self._releaseHeld()
+
+            if self._runCallbacks() and anyJob:
+                return
+
+        # Jobs queue their callbacks before they count as finished.
+        self._runCallbacks()
+
+    def reprioritize(self, relPath, priorityClass):
+        return (self._pending.reprioritize(relPath, priorityClass) or
+                thandy.download.DownloadManager.reprioritize(
+                    self, relPath, priorityClass))
+
+    def _getPollTimeout(self, delay=None):
+        """Helper: return how long we can wait for network activity before
+           one of our hedges needs to ask another mirror, or before
+           'delay' seconds pass, if it's given."""
+        timeout = _POLL_INTERVAL
+        if delay is not None:
+            timeout = min(timeout, delay)
+        if self._resolver.isBusy():
+            # Our resolver threads can't wake up poll(), so check on
+            # them often.
+            timeout = min(timeout, _RESOLVE_POLL_INTERVAL)
+        now = time.time()
+        for h in self._hedges:
+            deadline = h.getDeadline()
+            if deadline is not None:
+                timeout = min(timeout, max(0, deadline - now))
+        return timeout
+
+    def _releaseHeld(self):
+        """Helper: a connection has closed, so put the jobs we were holding
+           back for want of one into _pending again."""
+        for job in self._held:
+            self._pending.put(job)
+        self._held = []
+
+    def _launchPending(self):
+        """Helper: start as many pending jobs as we have room for."""
+        while not self._pending.empty() and \
+                  self._nActive < self._maxConcurrent:
+            self._startJob(self._pending.get())
+
+    def _startJob(self, job):
+        """Helper: start running 'job' in the event loop, or hand it to a
+           worker thread if we can't."""
+        try:
+            mirrors = job._getHedgeMirrors()
+            if mirrors is not None:
+                self._startHedge(job, mirrors)
+                return
+            xfer = job._prepareDownload()
+            if xfer is None:
+                self._jobDone(job, None)
+                return
+            if not canUseEventLoop(xfer.url, job._useTor):
+                self.nThreaded += 1
+                self._queueForThread(job)
+                return
+            if self.connectionPool.isBusy(xfer.url, job._useTor):
+                # The job chose the least busy mirror it could, and it's
+                # still at its limit.
+                logging.debug("holding %s until a connection is free",
+                              job.getRelativePath())
+                self._held.append(job)
+                return
+            logging.info("start %s in event loop", job.getRelativePath())
+            def onDone(err):
+                failure = None
+                if err is not None:
+                    failure = job._getFailure(err)
+                self._transferDone(job, failure)
+            _EventLoopTransfer(self, job, xfer, onDone)
+            self._nActive += 1
+            self.nEventLoop += 1
+        except:
+            self._jobDone(job, job._getFailure(sys.exc_info()[1]))
+
+    def _startHedge(self, job, mirrors):
+        """Helper: start fetching 'job' from the mirrors in 'mirrors' as a
+           hedged request."""
+        for m in mirrors:
+            if not canUseEventLoop(job._getMirrorURL(m), job._useTor):
+                self.nThreaded += 1
+                self._queueForThread(job)
+                return
+        logging.info("start %s in event loop, hedged",
+                     job.getRelativePath())
+        hedge = _EventLoopHedge(self, job, mirrors, job._getHedgeDelay())
+        self._hedges.append(hedge)
+        self._nActive += 1
+        self.nEventLoop += 1
+        hedge.start()
+
+    def _hedgeDone(self, hedge, job):
+        """Callback: 'hedge', which was fetching 'job', is done."""
+        self._hedges.remove(hedge)
+        self._releaseHeld()
+        failure = None
+        if hedge.winner is None:
+            failure = job._getFailure(hedge.error)
+        self._transferDone(job, failure)
+
+    def _expireIdle(self, now):
+        """Helper: give up on every transfer that has been quiet for too
+           long."""
+        for t in self._map.values():
+            if t._lastActivity + _IDLE_TIMEOUT < now:
+                t._fail(socket.timeout("No data from %s for %s seconds"
+                                       % (t._url, _IDLE_TIMEOUT)))
+
+    def _transferDone(self, job, failure):
+        """Callback: an _EventLoopTransfer for 'job' has finished; it failed
+           with 'failure' unless that's None."""
+        self._nActive -= 1
+        self._releaseHeld()
+        logging.info("end %s in event loop", job.getRelativePath())
+        self._jobDone(job, failure)
+
+    def _jobDone(self, job, failure):
+        """Helper: record that 'job' has finished, and queue its callbacks
+           to run from wait()."""
+        self._noteResult(job, failure)
+
+        self._lock.acquire()
+        try:
+            del self.downloads[job.getRelativePath()]
+        finally:
+            self._lock.release()
+
+class _Resolver:
+    """Looks up host names for an EventLoopDownloadManager in background
+       threads, so that a slow DNS server can't stall every transfer in
+       the event loop.  Answers go back to the event loop thread through
+       runCallbacks(), and we remember them for a little while.  We ask
+       for addresses of any family, so mirrors can be IPv6-only.
+    """
+    ## Fields:
+    #   _manager: the EventLoopDownloadManager we work for.
+    #   _nThreads: how many threads to run.
+    #   _threads: a list of the threads we've started.
+    #   _requests: a Queue of (host, port) for our threads to look up.
+    #   _results: a Queue of ((host, port), addresses, error) for
+    #     runCallbacks to hand out.
+    #   _waiting: map from (host, port) to a list of the functions waiting
+    #     for its addresses.
+    #   _cache: map from (host, port) to (expiry time, addresses).
+    # Only _requests and _results are touched by our threads.
+    def __init__(self, manager, nThreads=_RESOLVER_THREADS):
+        self._manager = manager
+        self._nThreads = nThreads
+        self._threads = []
+        self._requests = Queue.Queue()
+        self._results = Queue.Queue()
+        self._waiting = {}
+        self._cache = {}
+
+    def resolve(self, host, port, callback):
+        """Look up host:port, and later call callback(addresses, error)
+           from runCallbacks.  'addresses' is a list of results from
+           socket.getaddrinfo, or None if the lookup failed with the
+           exception 'error'."""
+        key = (host, port)
+        if key in self._waiting:
+            self._waiting[key].append(callback)
+            return
+        self._waiting[key] = [ callback ]
+
+        ent = self._cache.get(key)
+        if ent is not None and ent[0] > time.time():
+            self._results.put((key, ent[1], None))
+            return
+        try:
+            # This doesn't block, since it never asks DNS.
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM,
+                                           0, socket.AI_NUMERICHOST)
+        except socket.gaierror:
+            pass
+        else:
+            self._results.put((key, addresses, None))
+            return
+
+        if len(self._threads) < self._nThreads:
+            t = threading.Thread(target=self._thread)
+            t.setDaemon(True)
+            self._threads.append(t)
+            t.start()
+        self._requests.put(key)
+
+    def isBusy(self):
+        """Return true iff some lookup hasn't had its callbacks run."""
+        return bool(self._waiting)
+
+    def runCallbacks(self):
+        """Call the callbacks for every lookup that has finished."""
+        while True:
+            try:
+                key, addresses, err = self._results.get(block=False)
+            except Queue.Empty:
+                return
+            if addresses is not None:
+                self._cache[key] = (time.time() + _RESOLVE_CACHE_TIME,
+                                    addresses)
+            for callback in self._waiting.pop(key, ()):
+                callback(addresses, err)
+
+    def _thread(self):
+        while True:
+            host, port = key = self._requests.get()
+            try:
+                addresses = socket.getaddrinfo(host, port, 0,
+                                               socket.SOCK_STREAM)
+            except socket.error, e:
+                self._results.put((key, None, e))
+            else:
+                self._results.put((key, addresses, None))
+            # Wake up wait(), in case it's waiting on nothing but us.
+            done = self._manager.done
+            done.acquire()
+            done.notify()
+            done.release()
+
+class _EventLoopHedge(thandy.download._Hedge):
+    """A _Hedge whose copies are fetched in an EventLoopDownloadManager's
+       event loop."""
+    ## Fields:
+    #   _manager: the EventLoopDownloadManager we belong to.
+    #   _transfers: map from each running _HedgeCopy to its
+    #     _EventLoopTransfer.
+    #   _reported: true iff we've told _manager that we're done.
+    def __init__(self, manager, job, mirrors, delay):
+        thandy.download._Hedge.__init__(self, job, mirrors, delay)
+        self._manager = manager
+        self._transfers = {}
+        self._reported = False
+
+    def _launch(self, copy):
+        def onDone(err):
+            del self._transfers[copy]
+            self.copyDone(copy, err)
+            if self.isDone() and not self._transfers and not self._reported:
+                self._reported = True
+                self._manager._hedgeDone(self, self._job)
+        try:
+            self._transfers[copy] = _EventLoopTransfer(
+                self._manager, copy, copy.xfer, onDone)
+        except:
+            self._transfers[copy] = None
+            onDone(sys.exc_info()[1])
+
+    def _cancel(self, copy):
+        thandy.download._Hedge._cancel(self, copy)
+        t = self._transfers.pop(copy, None)
+        if t is not None:
+            t.cancel()
+            self._nRunning -= 1
+
+class _EventLoopTransfer(asyncore.dispatcher):
+    """A single HTTP request made from an EventLoopDownloadManager's event
+       loop, directly or through the SOCKS4a proxy.  The job decides what
+       to do with the response; we just move the bytes."""
+    ## Fields:
+    #   _manager: the EventLoopDownloadManager we belong to.
+    #   _job: the DownloadJob (or _HedgeCopy) we're fetching for.
+    #   _xfer: the job's _Transfer.
+    #   _onDone: a function to call with None when we've fetched the
+    #     file, or with an exception if we failed.
+    #   _state: "resolve" while we look up the host we connect to,
+    #     "connect" until we're connected, "socks" while we wait for
+    #     the proxy to answer, "headers" while we wait for the response
+    #     headers, "body" while we receive the body, and "done" after.
+    #   _request: the HTTP request to send.
+    #   _outbuf: what we still have to send.
+    #   _inbuf: what we've received and haven't processed yet.
+    #   _remaining: how much more body the server has promised, or None
+    #     if it didn't say.
+    #   _lastActivity: when we last sent or received anything.
+    #   _url: the URL we're fetching: xfer.url, or where it redirected us.
+    #   _nRedirects: how many redirects we followed to get to _url.
+    #   _next: the transfer that took over when we were redirected, or
+    #     None.
+    #   _claimed: true iff our connection counts against _url's mirror
+    #     in our manager's connectionPool.
+    #   _addresses: the addresses we haven't tried yet for the host we
+    #     connect to, as returned by socket.getaddrinfo.
+    def __init__(self, manager, job, xfer, onDone, url=None, nRedirects=0):
+        asyncore.dispatcher.__init__(self, map=manager._map)
+        self._manager = manager
+        self._job = job
+        self._xfer = xfer
+        self._onDone = onDone
+        self._state = "resolve"
+        self._outbuf = ""
+        self._inbuf = ""
+        self._remaining = None
+        self._lastActivity = time.time()
+        self._url = url or xfer.url
+        self._nRedirects = nRedirects
+        self._next = None
+        self._claimed = False
+        self._addresses = []
+
+        hostport, path = urllib2.splithost(urllib2.splittype(self._url)[1])
+        host, port = urllib2.splitport(hostport)
+        port = int(port or 80)
+        self._request = _formatRequest(host, port, path, xfer.haveLength,
+                                       xfer.getRequestHeaders())
+
+        if job._useTor:
+            # The proxy looks up the host for us.
+            self._outbuf = thandy.socksurls.socks4aRequest(host, port)
+            host, port = (thandy.socksurls.SOCKS_HOST,
+                          thandy.socksurls.SOCKS_PORT)
+
+        # Count against the mirror's limit while we look it up, so that
+        # our manager doesn't start too many other transfers meanwhile.
+        manager.connectionPool.claim(self._url, job._useTor)
+        self._claimed = True
+        manager._resolver.resolve(host, port, self._gotAddresses)
+
+    def _gotAddresses(self, addresses, err):
+        """Callback: we've looked up the host to connect to.  Connect to
+           the first of its 'addresses' that will let us, or fail with
+           'err' if the lookup failed."""
+        if self._state != "resolve":
+            # We were cancelled.
+            return
+        if addresses is None:
+            self._fail(err)
+            return
+        self._state = "connect"
+        self._addresses = list(addresses)
+        self._connectNext(socket.error("No addresses for %s" % self._url))
+
+    def _connectNext(self, err):
+        """Helper: start connecting to the next address in _addresses.  If
+           there are none left, fail with 'err'."""
+        while self._addresses:
+            family, _, _, _, address = self._addresses.pop(0)
+            try:
+                self.create_socket(family, socket.SOCK_STREAM)
+                self.connect(address)
+                return
+            except socket.error, e:
+                err = e
+                self.close()
+        self._fail(err)
+
+    def readable(self):
+        return self._state != "done"
+
+    def writable(self):
+        return not self.connected or len(self._outbuf) > 0
+
+    def handle_connect(self):
+        self._lastActivity = time.time()
+        if self._job._useTor:
+            self._state = "socks"
+        else:
+            self._state = "headers"
+            self._outbuf = self._request
+
+    def handle_write(self):
+        n = self.send(self._outbuf)
+        if n:
+            self._outbuf = self._outbuf[n:]
+            self._lastActivity = time.time()
+
+    def handle_read(self):
+        data = self.recv(thandy.download._READ_SIZE)
+        if not data:
+            # recv() has already called handle_close().
+            return
+        self._lastActivity = time.time()
+
+        if self._state == "body":
+            self._gotBody(data)
+            return
+
+        self._inbuf += data
+        if self._state == "socks":
+            if len(self._inbuf) < thandy.socksurls.SOCKS4_REPLY_LEN:
+                return
+            thandy.socksurls.checkSocks4Reply(self._inbuf)
+            self._inbuf = self._inbuf[thandy.socksurls.SOCKS4_REPLY_LEN:]
+            self._state = "headers"
+            self._outbuf = self._request
+        if self._state == "headers":
+            idx = self._inbuf.find("\r\n\r\n")
+            if idx < 0:
+                if len(self._inbuf) > _MAX_HEADER_LEN:
+                    raise httplib.LineTooLong("response headers")
+                return
+            head, body = self._inbuf[:idx], self._inbuf[idx+4:]
+            self._inbuf = ""
+            self._gotHeaders(head)
+            if body and self._state == "body":
+                self._gotBody(body)
+
+    def handle_close(self):
+        if self._state == "done":
+            return
+        if self._state == "body":
+            self._complete()
+            return
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err and self._state == "connect":
+            # Try the host's other addresses, if it has any.
+            self.close()
+            self._connectNext(socket.error(err, os.strerror(err)))
+        elif err:
+            self._fail(socket.error(err, os.strerror(err)))
+        else:
+            self._fail(httplib.BadStatusLine("Connection closed by %s"
+                                             % self._url))
+
+    def handle_expt(self):
+        self.handle_close()
+
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        if self._state == "connect" and isinstance(err, socket.error):
+            # Try the host's other addresses, if it has any.
+            self.close()
+            self._connectNext(err)
+        else:
+            self._fail(err)
+
+    def _gotHeaders(self, head):
+        """Helper: handle the response headers 'head'."""
+        xfer = self._xfer
+        lines = head.split("\r\n", 1)
+        parts = lines[0].split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise httplib.BadStatusLine(lines[0])
+        try:
+            status = int(parts[1])
+        except ValueError:
+            raise httplib.BadStatusLine(lines[0])
+        reason = (parts[2:] or [""])[0]
+        if len(lines) > 1:
+            headerText = lines[1] + "\r\n\r\n"
+        else:
+            headerText = "\r\n"
+        headers = httplib.HTTPMessage(cStringIO.StringIO(headerText))
+
+        if status in thandy.download._REDIRECT_CODES:
+            self._redirect(thandy.download._getRedirectURL(
+                self._url, status, headers, self._nRedirects))
+            return
+
+        if status not in (200, 206):
+            if self._job._noteHTTPError(xfer, status):
+                # We have the file already.
+                self._finish()
+                xfer.close()
+                self._onDone(None)
+                return
+            raise urllib2.HTTPError(self._url, status, reason, headers, None)
+
+        length = headers.get("Content-Length")
+        if length is not None:
+            try:
+                self._remaining = int(length)
+            except ValueError:
+                raise httplib.HTTPException("Bad Content-Length %r from %s"
+                                            % (length, self._url))
+
+        logging.info("Connected to %s", self._url)
+        self._state = "body"
+        self._job._beginBody(xfer, headers)
+        if self._remaining == 0:
+            self._complete()
+
+    def _redirect(self, url):
+        """Helper: the server sent us to 'url'.  Hand the rest of the job
+           to a new transfer that fetches it from there."""
+        if not canUseEventLoop(url, self._job._useTor):
+            raise urllib2.HTTPError(self._url, 302, "Can't follow redirect "
+                                    "to %s in the event loop" % url,
+                                    {}, None)
+        logging.info("Redirected from %s to %s", self._url, url)
+        # If this fails, we haven't let go of the job yet.
+        newTransfer = _EventLoopTransfer(self._manager, self._job, self._xfer,
+                                         self._onDone, url,
+                                         self._nRedirects + 1)
+        self._finish()
+        self._next = newTransfer
+
+    def _gotBody(self, data):
+        """Helper: handle 'data' from the response body."""
+        if self._remaining is not None:
+            data = data[:self._remaining]
+            self._remaining -= len(data)
+        if not self._job._gotData(self._xfer, data) or self._remaining == 0:
+            self._complete()
+
+    def _complete(self):
+        """Helper: we've received the whole response body.  Hand the file
+           to the job to check."""
+        self._finish()
+        job = self._job
+        try:
+            try:
+                job._endBody(self._xfer)
+            except:
+                job._abortBody(self._xfer)
+                raise
+            job._finishDownload(self._xfer)
+        except:
+            self._xfer.close()
+            self._onDone(sys.exc_info()[1])
+            return
+        self._onDone(None)
+
+    def _fail(self, err):
+        """Helper: give up on this transfer because of the exception 'err'."""
+        if self._state == "done":
+            return
+        self._finish()
+        self._job._abortBody(self._xfer)
+        self._xfer.close()
+        self._onDone(err)
+
+    def cancel(self):
+        """Stop this transfer without telling anybody."""
+        if self._next is not None:
+            self._next.cancel()
+        elif self._state != "done":
+            self._finish()
+
+    def _finish(self):
+        """Helper: stop using the network."""
+        self._state = "done"
+        if self.socket is not None:
+            self.close()
+        if self._claimed:
+            self._claimed = False
+            self._manager.connectionPool.unclaim(self._url, self._job._useTor)
@@ -0,0 +1,327 @@
+# Copyright 2008 The Tor Project, Inc.  See LICENSE for licensing information.
+
+"""Timing benchmarks for the parts of Thandy that get slow on large
+   repositories.  Run them with 'make bench'.
+"""
+
+import email.utils
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import BaseHTTPServer
+import SocketServer
+
+import thandy.keys
+import thandy.formats
+import thandy.util
+import thandy.download
+import thandy.asyncdownload
+
+json = thandy.util.importJSON()
+
+# Number of entries in each synthetic document.
+N_ENTRIES = 10000
+
+def _fakeHash(i):
+    """Return a well-formed base64 hash string that depends on 'i'."""
+    return thandy.formats.formatHash(thandy.formats.getDigest(str(i)))
+
+def makeKeylist(n=N_ENTRIES):
+    """Return a synthetic signed keylist object with 'n' keys."""
+    keys = []
+    for i in xrange(n):
+        keys.append({ 'key' : { '_keytype' : 'rsa',
+                                'e' : 'AQAB',
+                                'n' : _fakeHash(i) * 8 },
+                      'roles' : [ [ 'package', '/pkginfo/p%d/**' % i ],
+                                  [ 'bundle', '/bundleinfo/b%d/*' % i ] ] })
+    obj = { '_type' : 'Keylist',
+            'ts' : '2008-09-13 00:19:32',
+            'keys' : keys }
+    return thandy.formats.makeSignable(obj)
+
+def makeBundle(n=N_ENTRIES):
+    """Return a synthetic signed bundle object listing 'n' packages."""
+    packages = []
+    for i in xrange(n):
+        packages.append({ 'name' : 'package%d' % i,
+                          'version' : [ 0, 2, i ],
+                          'path' : '/pkginfo/p%d/p%d-0.2.%d.txt' % (i, i, i),
+                          'hash' : _fakeHash(i),
+                          'length' : 1000 + i,
+                          'order' : [ 10, i, 10 ],
+                          'optional' : False,
+                          'gloss' : { 'en' : 'Package number %d' % i },
+                          'longgloss' : { 'en' : 'It is "package" #%d' % i } })
+    obj = { '_type' : 'Bundle',
+            'at' : '2008-09-13 00:19:32',
+            'name' : 'bigbundle',
+            'os' : 'win32',
+            'version' : [ 0, 2 ],
+            'location' : '/bundleinfo/bigbundle/bigbundle-0.2.txt',
+            'packages' : packages }
+    return thandy.formats.makeSignable(obj)
+
+def makeTimestamp(n=N_ENTRIES):
+    """Return a synthetic signed timestamp object listing 'n' bundles."""
+    bundles = {}
+    for i in xrange(n):
+        bundles['/bundleinfo/b%d/' % i] = [
+            [ 0, 2, i ], '/bundleinfo/b%d/b%d-0.2.%d.txt' % (i, i, i),
+            '2008-09-13 00:19:32', _fakeHash(i), 2000 + i ]
+    obj = { '_type' : 'Timestamp',
+            'at' : '2008-09-13 00:19:32',
+            'm' : [ '2008-09-13 00:19:32', _fakeHash('m'), 100 ],
+            'k' : [ '2008-09-13 00:19:32', _fakeHash('k'), 100 ],
+            'b' : bundles }
+    return thandy.formats.makeSignable(obj)
+
+SAMPLE_DOCUMENTS = [ ('keylist', makeKeylist),
+                     ('bundle', makeBundle),
+                     ('timestamp', makeTimestamp) ]
+
+def timeFunction(fn, *args, **kwargs):
+    """Call fn(*args, **kwargs) a few times, and return the fastest
+       wall-clock time it took, in seconds."""
+    best = None
+    for _ in xrange(3):
+        t = time.time()
+        fn(*args, **kwargs)
+        t = time.time() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+def report(name, seconds):
+    """Print a single benchmark result."""
+    print "%-40s %9.2f ms" % (name, seconds * 1000)
+
+def bench_canonical():
+    for name, make in SAMPLE_DOCUMENTS:
+        obj = make()
+        report("encodeCanonical %s" % name,
+               timeFunction(thandy.formats.encodeCanonical, obj))
+        report("getDigest %s" % name,
+               timeFunction(thandy.formats.getDigest, obj['signed']))
+        content = json.dumps(obj)
+        # decodeAndDigest should cost no more than these two together.
+        report("json.loads %s" % name, timeFunction(json.loads, content))
+        report("decodeAndDigest %s" % name,
+               timeFunction(thandy.formats.decodeAndDigest, content))
+
+def bench_roles():
+    keyDB = thandy.formats.Keylist()
+    keyDB.addFromKeylist(makeKeylist()['signed'])
+    paths = [ '/pkginfo/p%d/p%d-0.2.%d.txt' % (i, i, i)
+              for i in xrange(0, N_ENTRIES, 10) ]
+    def lookup():
+        for p in paths:
+            keyDB.getKeysByRole('package', p)
+    keyDB.getKeysByRole('package', paths[0])
+    report("getKeysByRole x%d" % len(paths), timeFunction(lookup))
+
+def bench_schemas():
+    schemas = { 'keylist' : thandy.formats.KEYLIST_SCHEMA,
+                'bundle' : thandy.formats.BUNDLE_SCHEMA,
+                'timestamp' : thandy.formats.TIMESTAMP_SCHEMA }
+    for name, make in SAMPLE_DOCUMENTS:
+        obj = make()['signed']
+        schema = schemas[name]
+        schema.checkMatch(obj)
+        report("interpreted schema %s" % name,
+               timeFunction(schema._checkMatch, obj))
+        report("compiled schema %s" % name,
+               timeFunction(schema.checkMatch, obj))
+
+class LocalMirror(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves the files under a directory over HTTP on localhost, in a
+       background thread: a stand-in mirror for tests and benchmarks.
+       Like most real mirrors, it sends an ETag and a Last-Modified
+       header with each file, and answers conditional requests."""
+    ## Fields:
+    #   root: the directory we serve.
+    #   requests: a list of (path, headers, client address) for every
+    #     request we got.
+    #   failAfter: if set, we close the connection after sending this
+    #     many bytes of any response body.
+    #   delay: how many seconds to wait before answering each request, to
+    #     act like a mirror at the other end of a slow network.
+    #   gzip: if true, we compress the whole of any file we send to a
+    #     client that will accept it.
+    #   redirects: a map from request path to the location we redirect
+    #     requests for it to.
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, root, delay=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           _LocalMirrorHandler)
+        self.root = root
+        self.requests = []
+        self.failAfter = None
+        self.delay = delay
+        self.gzip = False
+        self.redirects = {}
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def getURL(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on us when they cancel a download.
+        if not issubclass(sys.exc_info()[0], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class _LocalMirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def sendError(self, code):
+        # Unlike send_error, this keeps the connection open.
+        body = "Error %d" % code
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def isCurrent(self, etag, mtime):
+        """Return true iff the client's conditional headers say it already
+           has the version of the file with 'etag', last modified at
+           'mtime'."""
+        match = self.headers.get("If-None-Match")
+        if match is not None:
+            return etag in [ m.strip() for m in match.split(",") ]
+        since = self.headers.get("If-Modified-Since")
+        if since is not None:
+            since = email.utils.parsedate_tz(since)
+            return since is not None and \
+                   int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.path, dict(self.headers.items()),
+                                self.client_address))
+        if server.delay:
+            time.sleep(server.delay)
+        if self.path in server.redirects:
+            self.send_response(302)
+            self.send_header("Location", server.redirects[self.path])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        fname = os.path.join(server.root, urllib.unquote(self.path[1:]))
+        try:
+            f = open(fname, 'rb')
+            try:
+                data = f.read()
+                mtime = os.fstat(f.fileno()).st_mtime
+            finally:
+                f.close()
+        except IOError:
+            self.sendError(404)
+            return
+
+        etag = '"%s"' % thandy.formats.getDigest(data).encode("hex")
+        lastModified = self.date_time_string(mtime)
+        if self.isCurrent(etag, mtime):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", lastModified)
+            self.end_headers()
+            return
+
+        start, end = 0, len(data)
+        rng = self.headers.get("Range")
+        if server.gzip and not rng and \
+               "gzip" in self.headers.get("Accept-Encoding", ""):
+            data = thandy.util.gzipString(data)
+            end = len(data)
+            etag = etag[:-1] + '-gzip"'
+            self.send_response(200)
+            self.send_header("Content-Encoding", "gzip")
+        elif rng:
+            m = re.match(r'bytes=(\d+)-(\d*)$', rng)
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(end, int(m.group(2)) + 1)
+            if start >= end:
+                self.sendError(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d"
+                             % (start, end-1, len(data)))
+        else:
+            self.send_response(200)
+        body = data[start:end]
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", lastModified)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if server.failAfter is not None and len(body) > server.failAfter:
+            self.wfile.write(body[:server.failAfter])
+            self.close_connection = 1
+        else:
+            self.wfile.write(body)
+
+# Number of files, file size, and per-request latency for the download
+# benchmarks.
+N_DOWNLOADS = 200
+DOWNLOAD_SIZE = 16*1024
+MIRROR_DELAY = 0.05
+
+def bench_downloads():
+    d = tempfile.mkdtemp()
+    try:
+        root = os.path.join(d, "mirror")
+        os.mkdir(root)
+        for i in xrange(N_DOWNLOADS):
+            f = open(os.path.join(root, "f%d" % i), 'wb')
+            f.write(os.urandom(DOWNLOAD_SIZE))
+            f.close()
+        mirror = LocalMirror(root, MIRROR_DELAY)
+        def fetchAll(makeManager):
+            out = tempfile.mkdtemp(dir=d)
+            manager = makeManager()
+            for i in xrange(N_DOWNLOADS):
+                manager.addDownloadJob(thandy.download.SimpleDownloadJob(
+                    os.path.join(out, "f%d" % i),
+                    "%s/f%d" % (mirror.getURL(), i)))
+            manager.start()
+            manager.wait()
+            assert len(os.listdir(out)) == N_DOWNLOADS
+        try:
+            report("threaded download x%d" % N_DOWNLOADS,
+                   timeFunction(fetchAll, thandy.download.DownloadManager))
+            report("event loop download x%d" % N_DOWNLOADS,
+                   timeFunction(fetchAll,
+                                thandy.asyncdownload.EventLoopDownloadManager))
+        finally:
+            mirror.stop()
+    finally:
+        shutil.rmtree(d)
+
+BENCHMARKS = [ bench_canonical, bench_roles, bench_schemas, bench_downloads ]
+
+def run_benchmarks():
+    for b in BENCHMARKS:
+        b()
+
+if __name__ == '__main__':
+    run_benchmarks()
@@ -2,6 +2,12 @@
 
 """This file defines an object oriented pattern matching system used to
    check decoded xJSON objects.
+
+   Each schema can check an object in two ways.  The first time it is
+   used, a schema compiles itself into a validator function built from
+   its subschemas' validators, which just answers whether an object
+   matches.  Only when the validator says no do we walk the schema again
+   the slow way, to build an error message saying what went wrong.
 """
 
 import re
@@ -13,20 +19,47 @@ class Schema:
     """A Schema matches a set of possible Python objects, of types
        that are encodable in JSON.  This is an abstract base type;
        see implementations below."""
+    ## Fields:
+    #   _validator: a function that returns True iff its argument matches
+    #      this schema, or None if we haven't compiled one yet.
+    _validator = None
+
     def matches(self, obj):
         """Return True if 'obj' matches this schema, False if it doesn't."""
-        try:
-            self.checkMatch(obj)
-        except thandy.FormatException:
-            return False
-        else:
-            return True
+        return self.compile()(obj)
 
     def checkMatch(self, obj):
-        """Raise thandy.FormatException if 'obj' does not match this schema.
+        """Raise thandy.FormatException if 'obj' does not match this schema."""
+        if not self.compile()(obj):
+            self._checkMatch(obj)
+            # The validator and _checkMatch should always agree.
+            raise thandy.FormatException("%r did not match schema"%obj)
+
+    def compile(self):
+        """Return a function that takes an object, and returns True if it
+           matches this schema, or False if it doesn't."""
+        v = self._validator
+        if v is None:
+            v = self._validator = self._makeValidator()
+        return v
+
+    def _makeValidator(self):
+        """Build and return a validator function for compile().
            Abstract method."""
         raise NotImplemented()
 
+    def _checkMatch(self, obj):
+        """Raise thandy.FormatException, with a message explaining why, if
+           'obj' does not match this schema.  This is the slow path, used
+           once the validator has failed.  Abstract method."""
+        raise NotImplemented()
+
+def _alwaysTrue(obj):
+    return True
+
+def _isString(obj):
+    return isinstance(obj, basestring)
+
 class Any(Schema):
     """
        Matches any single object.
@@ -37,7 +70,9 @@ class Any(Schema):
        >>> s.matches([1, "list"])
        True
     """
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        return _alwaysTrue
+    def _checkMatch(self, obj):
         pass
 
 class RE(Schema):
@@ -71,7 +106,12 @@ class RE(Schema):
             else:
                 reName = "pattern"
         self._reName = reName
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        match = self._re.match
+        def validate(obj):
+            return isinstance(obj, basestring) and match(obj) is not None
+        return validate
+    def _checkMatch(self, obj):
         if not isinstance(obj, basestring) or not self._re.match(obj):
             raise thandy.FormatException("%r did not match %s"
                                          %(obj,self._reName))
@@ -88,7 +128,10 @@ class Str(Schema):
     """
     def __init__(self, val):
         self._str = val
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        val = self._str
+        return lambda obj: not (val != obj)
+    def _checkMatch(self, obj):
         if self._str != obj:
             raise thandy.FormatException("Expected %r; got %r"%(self._str, obj))
 
@@ -112,7 +155,9 @@ class AnyStr(Schema):
     """
     def __init__(self):
         pass
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        return _isString
+    def _checkMatch(self, obj):
         if not isinstance(obj, basestring):
             raise thandy.FormatException("Expected a string; got %r"%obj)
 
@@ -135,9 +180,22 @@ class OneOf(Schema):
     def __init__(self, alternatives):
         self._subschemas = alternatives
 
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        validators = [ m.compile() for m in self._subschemas ]
+        def validate(obj):
+            for v in validators:
+                if v(obj):
+                    return True
+            return False
+        return validate
+
+    def _checkMatch(self, obj):
         for m in self._subschemas:
-            if m.matches(obj):
+            try:
+                m._checkMatch(obj)
+            except thandy.FormatException:
+                pass
+            else:
                 return
 
         raise thandy.FormatException("Object matched no recognized alternative")
@@ -156,9 +214,18 @@ class AllOf(Schema):
     def __init__(self, required):
         self._subschemas = required[:]
 
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        validators = [ s.compile() for s in self._subschemas ]
+        def validate(obj):
+            for v in validators:
+                if not v(obj):
+                    return False
+            return True
+        return validate
+
+    def _checkMatch(self, obj):
         for s in self._subschemas:
-            s.checkMatch(obj)
+            s._checkMatch(obj)
 
 class ListOf(Schema):
     """
@@ -195,13 +262,37 @@ class ListOf(Schema):
         self._minCount = minCount
         self._maxCount = maxCount
         self._listName = listName
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        lo, hi = self._minCount, self._maxCount
+        if isinstance(self._schema, Any):
+            def validate(obj):
+                return (isinstance(obj, (list, tuple)) and
+                        lo <= len(obj) <= hi)
+        elif isinstance(self._schema, AnyStr):
+            def validate(obj):
+                if not isinstance(obj, (list, tuple)):
+                    return False
+                for item in obj:
+                    if not isinstance(item, basestring):
+                        return False
+                return lo <= len(obj) <= hi
+        else:
+            sub = self._schema.compile()
+            def validate(obj):
+                if not isinstance(obj, (list, tuple)):
+                    return False
+                for item in obj:
+                    if not sub(item):
+                        return False
+                return lo <= len(obj) <= hi
+        return validate
+    def _checkMatch(self, obj):
         if not isinstance(obj, (list, tuple)):
             raise thandy.FormatException("Expected %s; got %r"
                                          %(self._listName,obj))
         for item in obj:
             try:
-                self._schema.checkMatch(item)
+                self._schema._checkMatch(item)
             except thandy.FormatException, e:
                 raise thandy.FormatException("%s in %s"%(e, self._listName))
 
@@ -268,7 +359,22 @@ class Struct(Schema):
         self._min = len(subschemas)
         self._allowMore = allowMore
         self._structName = structName
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        validators = [ s.compile() for s in self._subschemas ]
+        nMin, nMax = self._min, len(validators)
+        allowMore = self._allowMore
+        def validate(obj):
+            if not isinstance(obj, (list, tuple)):
+                return False
+            n = len(obj)
+            if n < nMin or (n > nMax and not allowMore):
+                return False
+            for item, v in zip(obj, validators):
+                if not v(item):
+                    return False
+            return True
+        return validate
+    def _checkMatch(self, obj):
         if not isinstance(obj, (list, tuple)):
             raise thandy.FormatException("Expected %s; got %r"
                                          %(self._structName,obj))
@@ -279,7 +385,7 @@ class Struct(Schema):
             raise thandy.FormatException(
                 "Too many fields in %s"%self._structName)
         for item, schema in zip(obj, self._subschemas):
-            schema.checkMatch(item)
+            schema._checkMatch(item)
 
 class DictOf(Schema):
     """
@@ -304,15 +410,28 @@ class DictOf(Schema):
            keySchema, and all of whose values match valSchema."""
         self._keySchema = keySchema
         self._valSchema = valSchema
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        kv = self._keySchema.compile()
+        vv = self._valSchema.compile()
+        def validate(obj):
+            try:
+                iter = obj.iteritems()
+            except AttributeError:
+                return False
+            for k,v in iter:
+                if not (kv(k) and vv(v)):
+                    return False
+            return True
+        return validate
+    def _checkMatch(self, obj):
         try:
             iter = obj.iteritems()
         except AttributeError:
             raise thandy.FormatException("Expected a dict; got %r"%obj)
 
         for k,v in iter:
-            self._keySchema.checkMatch(k)
-            self._valSchema.checkMatch(v)
+            self._keySchema._checkMatch(k)
+            self._valSchema._checkMatch(v)
 
 class Opt:
     """Helper; applied to a value in Obj to mark it optional.
@@ -329,6 +448,10 @@ class Opt:
         self._schema = schema
     def checkMatch(self, obj):
         self._schema.checkMatch(obj)
+    def compile(self):
+        return self._schema.compile()
+    def _checkMatch(self, obj):
+        self._schema._checkMatch(obj)
 
 class Obj(Schema):
     """
@@ -351,7 +474,39 @@ class Obj(Schema):
         self._objname = _objname
         self._required = d.items()
 
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        # Keys we only need to check for, and keys whose values we need
+        # to check.
+        present = []
+        checked = []
+        for k,schema in self._required:
+            isOpt = isinstance(schema, Opt)
+            if isOpt:
+                schema = schema._schema
+            if isinstance(schema, Any):
+                if not isOpt:
+                    present.append(k)
+            else:
+                checked.append((k, schema.compile(), isOpt))
+        def validate(obj):
+            if not isinstance(obj, dict):
+                return False
+            for k in present:
+                if k not in obj:
+                    return False
+            for k, v, isOpt in checked:
+                try:
+                    item = obj[k]
+                except KeyError:
+                    if isOpt:
+                        continue
+                    return False
+                if not v(item):
+                    return False
+            return True
+        return validate
+
+    def _checkMatch(self, obj):
         if not isinstance(obj, dict):
             raise thandy.FormatException("Wanted a %s; did not get a dict"%
                                          self._objname)
@@ -366,7 +521,7 @@ class Obj(Schema):
 
             else:
                 try:
-                    schema.checkMatch(item)
+                    schema._checkMatch(item)
                 except thandy.FormatException, e:
                     raise thandy.FormatException("%s in %s.%s"
                                                  %(e,self._objname,k))
@@ -404,7 +559,28 @@ class TaggedObj(Schema):
         self._ignoreOthers = ignoreUnrecognized
         self._tagvals = tagvals
 
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        tagName, tagOpt = self._tagName, self._tagOpt
+        ignoreOthers = self._ignoreOthers
+        validators = dict((tag, schema.compile())
+                          for tag, schema in self._tagvals.iteritems())
+        def validate(obj):
+            try:
+                tag = obj[tagName]
+            except KeyError:
+                return tagOpt
+            except TypeError:
+                return False
+            if not isinstance(tag, basestring):
+                return False
+            try:
+                v = validators[tag]
+            except KeyError:
+                return ignoreOthers
+            return v(obj)
+        return validate
+
+    def _checkMatch(self, obj):
         try:
             tag = obj[self._tagName]
         except KeyError:
@@ -428,7 +604,7 @@ class TaggedObj(Schema):
                 raise thandy.FormatException("Unrecognized value %s for %s"%(
                         tag, self._tagName))
 
-        subschema.checkMatch(obj)
+        subschema._checkMatch(obj)
 
 class Int(Schema):
     """
@@ -459,7 +635,14 @@ class Int(Schema):
         if plo is None: plo = "..."
         if phi is None: phi = "..."
         self._range = "[%s,%s]"%(plo,phi)
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        lo, hi = self._lo, self._hi
+        def validate(obj):
+            if isinstance(obj, bool) or not isinstance(obj, (int, long)):
+                return False
+            return (lo is None or lo <= obj) and (hi is None or obj <= hi)
+        return validate
+    def _checkMatch(self, obj):
         if isinstance(obj, bool) or not isinstance(obj, (int, long)):
             # We need to check for bool as a special case, since bool
             # is for historical reasons a subtype of int.
@@ -481,7 +664,9 @@ class Bool(Schema):
     """
     def __init__(self):
         pass
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        return lambda obj: isinstance(obj, bool)
+    def _checkMatch(self, obj):
         if not isinstance(obj, bool):
             raise thandy.FormatException("Got %r instead of a boolean"%obj)
 
@@ -502,9 +687,23 @@ class Func(Schema):
         #DOCDOC
         self._fn = fn
         self._base = baseSchema
-    def checkMatch(self, obj):
+    def _makeValidator(self):
+        fn = self._fn
+        if self._base:
+            base = self._base.compile()
+        else:
+            base = _alwaysTrue
+        def validate(obj):
+            if not base(obj):
+                return False
+            try:
+                return fn(obj) is not False
+            except thandy.FormatException:
+                return False
+        return validate
+    def _checkMatch(self, obj):
         if self._base:
-            self._base.checkMatch(obj)
+            self._base._checkMatch(obj)
         r = self._fn(obj)
         if r is False:
             raise thandy.FormatException("%s returned False"%self._fn)
@@ -0,0 +1,173 @@
+# Copyright 2008 The Tor Project, Inc.  See LICENSE for licensing information.
+
+"""Binary deltas between two versions of an installable file.
+
+   A delta says how to build the new file out of pieces of the old one,
+   plus whatever bytes are new.  We find the shared pieces by splitting
+   both files at content-defined boundaries: places chosen by a rolling
+   hash of the bytes just before them.  An insertion or deletion only
+   moves the boundaries near it, so the pieces after it still line up
+   between the two versions.
+
+   A delta file is the string DELTA_MAGIC, the length of the new file
+   as an 8-byte big-endian integer, and a series of operations:
+       "C" OFFSET LENGTH   -- copy LENGTH bytes of the old file from OFFSET
+       "A" LENGTH DATA     -- add the LENGTH bytes of DATA
+       "E"                 -- end of the delta
+   where OFFSET and LENGTH are 8-byte big-endian integers.
+"""
+
+import struct
+
+import Crypto.Hash.SHA256
+
+import thandy
+
+DELTA_MAGIC = "THANDY-DELTA-1\n"
+
+# Limits on the size of the pieces we split files into for deltas.  The
+# average size is about 2**_DELTA_AVG_BITS bytes.
+_DELTA_MIN_CHUNK = 1024
+_DELTA_AVG_BITS = 12
+_DELTA_MAX_CHUNK = 32*1024
+
+# How many bytes to copy at a time when applying a delta.
+_COPY_SIZE = 64*1024
+
+def _makeGearTable():
+    """Return a table of 256 pseudorandom 32-bit numbers.  They come
+       from SHA256, so that every platform splits files the same way."""
+    table = []
+    for i in xrange(256):
+        d = Crypto.Hash.SHA256.new("thandy-gear-%d" % i).digest()
+        table.append(struct.unpack("!L", d[:4])[0])
+    return table
+
+_GEAR = _makeGearTable()
+
+def splitChunks(data, minSize=_DELTA_MIN_CHUNK, avgBits=_DELTA_AVG_BITS,
+                maxSize=_DELTA_MAX_CHUNK):
+    """Split the string 'data' at content-defined boundaries, and return
+       a list of (offset, length) for the pieces.  No piece is longer
+       than maxSize, or shorter than minSize unless it's the last.
+
+       >>> splitChunks("")
+       []
+       >>> splitChunks("abc")
+       [(0, 3)]
+       >>> pieces = splitChunks("".join(str(i) for i in xrange(20000)))
+       >>> sum(n for _, n in pieces)
+       88890
+       >>> [ o for o, _ in pieces[:4] ]
+       [0, 9009, 18171, 19645]
+    """
+    # A gear hash only depends on the last 32 bytes it has seen, so we
+    # can start each piece's hash 32 bytes before its earliest boundary.
+    mask = ((1 << avgBits) - 1) << (32 - avgBits)
+    gear = _GEAR
+    buf = bytearray(data)
+    n = len(buf)
+    result = []
+    start = 0
+    while start < n:
+        end = min(n, start + maxSize)
+        cut = end
+        first = start + minSize
+        if first < end:
+            h = 0
+            for i in xrange(max(start, first - 32), first):
+                h = ((h << 1) + gear[buf[i]]) & 0xffffffff
+            for i in xrange(first, end):
+                if not h & mask:
+                    cut = i
+                    break
+                h = ((h << 1) + gear[buf[i]]) & 0xffffffff
+        result.append((start, cut - start))
+        start = cut
+    return result
+
+def makeDelta(old, new):
+    """Return a delta (as a string) that turns the string 'old' into the
+       string 'new'.
+
+       >>> d = makeDelta("abc", "abcabc")
+       >>> d.startswith(DELTA_MAGIC)
+       True
+    """
+    index = {}
+    for offset, length in splitChunks(old):
+        d = Crypto.Hash.SHA256.new(old[offset:offset+length]).digest()
+        index.setdefault(d, offset)
+
+    # A list of [ "C", offset, length ] and [ "A", [ pieces ] ].
+    ops = []
+    for offset, length in splitChunks(new):
+        piece = new[offset:offset+length]
+        oldOffset = index.get(Crypto.Hash.SHA256.new(piece).digest())
+        if oldOffset is None:
+            if ops and ops[-1][0] == "A":
+                ops[-1][1].append(piece)
+            else:
+                ops.append([ "A", [ piece ] ])
+        elif ops and ops[-1][0] == "C" and \
+                 ops[-1][1] + ops[-1][2] == oldOffset:
+            ops[-1][2] += length
+        else:
+            ops.append([ "C", oldOffset, length ])
+
+    out = [ DELTA_MAGIC, struct.pack("!Q", len(new)) ]
+    for op in ops:
+        if op[0] == "C":
+            out.append("C" + struct.pack("!QQ", op[1], op[2]))
+        else:
+            data = "".join(op[1])
+            out.append("A" + struct.pack("!Q", len(data)))
+            out.append(data)
+    out.append("E")
+    return "".join(out)
+
+def _readExactly(f, n):
+    """Helper: read exactly 'n' bytes from the file 'f', or raise
+       FormatException if it ends first."""
+    s = f.read(n)
+    if len(s) != n:
+        raise thandy.FormatException("Delta file is truncated")
+    return s
+
+def applyDelta(oldFile, deltaFile, outFile):
+    """Read a delta from the file object 'deltaFile', and write the new
+       file it describes to 'outFile', copying from the seekable file
+       object 'oldFile' as needed.  Return the SHA256 digest of what we
+       wrote.  Raise FormatException if the delta is malformed, or doesn't
+       fit the old file."""
+    if _readExactly(deltaFile, len(DELTA_MAGIC)) != DELTA_MAGIC:
+        raise thandy.FormatException("Not a delta file")
+    wantLength, = struct.unpack("!Q", _readExactly(deltaFile, 8))
+    digestObj = Crypto.Hash.SHA256.new()
+    total = 0
+    while True:
+        op = _readExactly(deltaFile, 1)
+        if op == "E":
+            break
+        elif op == "C":
+            offset, length = struct.unpack("!QQ", _readExactly(deltaFile, 16))
+            oldFile.seek(offset)
+            src = oldFile
+        elif op == "A":
+            length, = struct.unpack("!Q", _readExactly(deltaFile, 8))
+            src = deltaFile
+        else:
+            raise thandy.FormatException("Unknown delta operation %r" % op)
+        total += length
+        if total > wantLength:
+            raise thandy.FormatException("Delta makes too long a file")
+        while length:
+            s = src.read(min(length, _COPY_SIZE))
+            if not s:
+                raise thandy.FormatException("Delta doesn't fit the file")
+            outFile.write(s)
+            digestObj.update(s)
+            length -= len(s)
+    if total != wantLength:
+        raise thandy.FormatException("Delta makes too short a file")
+    return digestObj.digest()
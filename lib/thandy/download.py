@@ -1,13 +1,31 @@
 # Copyright 2008 The Tor Project, Inc.  See LICENSE for licensing information.
 
+import collections
+import cStringIO
+import heapq
 import httplib
 import logging
+import math
 import os
 import Queue
+import random
+import socket
+import struct
 import sys
 import threading
 import time
+import urllib
 import urllib2
+import urlparse
+import zlib
+
+import Crypto.Hash.SHA256
+
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
 
 import thandy.util
 import thandy.socksurls
@@ -15,14 +33,383 @@ import thandy.checkJson
 
 from thandy.util import logCtrl
 
+json = thandy.util.importJSON()
+
+# How many bytes to read from the network at a time.
+_READ_SIZE = 64*1024
+# Downloads no longer than this are kept in memory as they arrive, so
+# that we can check them without reading them back from disk.
+_MAX_BUFFERED_CHECK = 16*1024*1024
+
+# While downloading, save a checkpoint of our hash state every this many
+# bytes, so that a resumed download doesn't need to rehash what it had.
+_CHECKPOINT_INTERVAL = 4*1024*1024
+# How many bytes at the end of the covered part of a file we hash to
+# make sure that a checkpoint still matches the file.
+_CHECKPOINT_TAIL = 64*1024
+
+# Files at least this long whose length we know get split into segments
+# that we fetch from several mirrors at once.
+_MIN_SEGMENTED_LENGTH = 8*1024*1024
+# How long each of those segments is.
+_SEGMENT_SIZE = 1024*1024
+# The largest number of mirrors we fetch a single file from at once.
+_MAX_SEGMENT_MIRRORS = 4
+# A mirror with nothing left to fetch takes over half of another mirror's
+# segment, if at least this much of the segment is left.
+_MIN_SEGMENT_SPLIT = 128*1024
+
+# When hedging is on, we ask a second mirror for a file if the first
+# hasn't delivered it soon enough -- but only for files no longer than
+# this, so that hedging can't cost us much bandwidth.
+_MAX_HEDGED_LENGTH = 256*1024
+# How long we give the first mirror, if we haven't seen enough downloads
+# to know how long one usually takes.
+_DEFAULT_HEDGE_DELAY = 2.0
+# We never give the first mirror less time than this...
+_MIN_HEDGE_DELAY = 0.2
+# ... and otherwise give it as long as this fraction of small downloads
+# take.
+_HEDGE_PERCENTILE = 0.95
+
+S = thandy.checkJson
+_CHECKPOINT_SCHEMA = S.Obj(
+    v=S.Int(),
+    impl=S.AnyStr(),
+    offset=S.Int(lo=0),
+    state=thandy.formats.BASE64_SCHEMA,
+    check=thandy.formats.HASH_SCHEMA,
+    tail=thandy.formats.HASH_SCHEMA)
+del S
+
+def _loadLibcrypto():
+    """Helper: return a ctypes handle to OpenSSL's libcrypto and a string
+       identifying its version, or (None, None) if we can't load it."""
+    if ctypes is None:
+        return None, None
+    for name in ("crypto", "eay32", "libeay32"):
+        fname = ctypes.util.find_library(name)
+        if fname is None:
+            continue
+        try:
+            lib = ctypes.CDLL(fname)
+            for fn in (lib.SHA256_Init, lib.SHA256_Update, lib.SHA256_Final):
+                fn.restype = ctypes.c_int
+        except (OSError, AttributeError):
+            continue
+        lib.SHA256_Update.argtypes = [ ctypes.c_void_p, ctypes.c_char_p,
+                                       ctypes.c_size_t ]
+        versionFn = (getattr(lib, "OpenSSL_version_num", None) or
+                     getattr(lib, "SSLeay", None))
+        if versionFn is None:
+            continue
+        versionFn.restype = ctypes.c_ulong
+        return lib, "openssl-%x" % versionFn()
+    return None, None
+
+_libcrypto, _libcryptoVersion = _loadLibcrypto()
+
+class ResumableSHA256:
+    """A SHA256 hash object whose intermediate state can be saved and
+       restored later, even by another process.  PyCrypto and hashlib
+       can't do that, so we use OpenSSL's SHA256 directly.  If we can't
+       load OpenSSL, isAvailable() returns false, and you can't make one.
+    """
+    ## Fields:
+    #   _ctx: a buffer holding an OpenSSL SHA256_CTX.
+    #
+    # sizeof(SHA256_CTX) in every OpenSSL since 0.9.8.
+    _CTX_SIZE = 112
+    # The layout of a SHA256_CTX: h[8], Nl, Nh, data[16], num, md_len,
+    # all 32-bit words.
+    _CTX_FORMAT = "=8I2I16I2I"
+
+    def __init__(self, state=None, length=None):
+        """Make a new hash object, starting from 'state' (as returned by
+           getState()) if provided.  If 'length' is provided, the state
+           must be that of a hash of 'length' bytes.  Raises ValueError
+           if the state is not one that OpenSSL could have made, since
+           OpenSSL trusts the counters in it when it copies data."""
+        assert _libcrypto is not None
+        self._ctx = ctypes.create_string_buffer(self._CTX_SIZE)
+        if state is None:
+            _libcrypto.SHA256_Init(self._ctx)
+        else:
+            self._checkState(state, length)
+            ctypes.memmove(self._ctx, state, self._CTX_SIZE)
+
+    @classmethod
+    def _checkState(cls, state, length):
+        """Helper: raise ValueError unless 'state' is a well-formed
+           SHA256_CTX for a hash of 'length' bytes (or of any number of
+           bytes, if 'length' is None)."""
+        if len(state) != cls._CTX_SIZE:
+            raise ValueError("Hash state has the wrong length")
+        fields = struct.unpack(cls._CTX_FORMAT, state)
+        nl, nh, num, mdLen = fields[8], fields[9], fields[26], fields[27]
+        if num >= 64 or mdLen != 32:
+            raise ValueError("Hash state is corrupt")
+        nBits = (nh << 32) | nl
+        if nBits % 8 or num != (nBits // 8) % 64:
+            raise ValueError("Hash state is corrupt")
+        if length is not None and nBits != length * 8:
+            raise ValueError("Hash state is for the wrong length")
+
+    @staticmethod
+    def isAvailable():
+        """Return true iff we can make ResumableSHA256 objects."""
+        return _libcrypto is not None
+
+    @staticmethod
+    def getImplementation():
+        """Return a string identifying the library whose state we save;
+           states from other libraries aren't compatible."""
+        return _libcryptoVersion
+
+    def update(self, s):
+        _libcrypto.SHA256_Update(self._ctx, s, len(s))
+
+    def digest(self):
+        """Return the digest of everything hashed so far.  Unlike the
+           underlying OpenSSL function, this doesn't change our state."""
+        ctx = ctypes.create_string_buffer(self._ctx.raw, self._CTX_SIZE)
+        out = ctypes.create_string_buffer(32)
+        _libcrypto.SHA256_Final(out, ctx)
+        return out.raw
+
+    def getState(self):
+        """Return a string encoding our state."""
+        return self._ctx.raw
+
+def _newGzipDecoder():
+    """Return a new decompression object for a gzip stream."""
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _newDownloadDigest():
+    """Return a new SHA256 object to hash a download with.  If we can,
+       use one whose state we can save."""
+    if ResumableSHA256.isAvailable():
+        return ResumableSHA256()
+    return Crypto.Hash.SHA256.new()
+
 class BadCompoundData(thandy.DownloadError):
     """DOCDOC"""
     pass
 
+class BadSegmentedData(BadCompoundData):
+    """Raised when a file that we assembled from segments fetched from
+       several mirrors turns out to be no good."""
+    def __init__(self, err, mirrors):
+        BadCompoundData.__init__(self, err)
+        # List of urlbase for every mirror that sent us part of the file.
+        self.mirrors = mirrors
+
+# Download priority classes, most urgent first.  Each class of file
+# has to arrive before we can tell which files of the next class we need.
+PRIORITY_META = 0
+PRIORITY_BUNDLE = 1
+PRIORITY_PACKAGE = 2
+PRIORITY_DATA = 3
+
+_PRIORITY_PREFIXES = [ ("/meta/", PRIORITY_META),
+                       ("/bundleinfo/", PRIORITY_BUNDLE),
+                       ("/pkginfo/", PRIORITY_PACKAGE) ]
+
+# A job that has waited this many seconds in a DownloadQueue ranks with
+# newly queued jobs of the next more urgent class.
+_AGING_INTERVAL = 60
+
+def getPriorityClass(relPath):
+    """Return the priority class for the file at relPath in a repository.
+
+       >>> getPriorityClass("/meta/timestamp.txt")
+       0
+       >>> getPriorityClass("/pkginfo/tor/tor-0.2.txt")
+       2
+       >>> getPriorityClass("/data/tor-0.2.exe")
+       3
+    """
+    for prefix, cls in _PRIORITY_PREFIXES:
+        if relPath.startswith(prefix):
+            return cls
+    return PRIORITY_DATA
+
+class DownloadQueue:
+    """A thread-safe queue of DownloadJobs, which gives out the most
+       urgent job first.  A job's urgency depends on its priority class
+       (see getPriorityClass), then on its length: smaller files first.
+
+       So that nothing waits forever, jobs get more urgent as they wait:
+       a job moves up a whole class every _AGING_INTERVAL seconds.  (This
+       doesn't change the order of jobs that were queued at the same time,
+       so we can decide the order when a job is queued.)
+    """
+    ## Fields:
+    #   _cond: a Condition protecting our fields, notified when a job is
+    #     added.
+    #   _heap: a heap of [key, seq, job, queuedAt] lists.  A list whose
+    #     job is None has been superseded.
+    #   _entries: map from relPath to the entry in _heap for the last job
+    #     we queued for that path.
+    #   _nJobs: the number of live entries in _heap.
+    #   _seq: a counter, to keep jobs with equal keys in order.
+    #   _nWakeups: how many times wakeWaiters has been called.
+    def __init__(self, agingInterval=_AGING_INTERVAL):
+        self._agingInterval = agingInterval
+        self._cond = threading.Condition()
+        self._heap = []
+        self._entries = {}
+        self._nJobs = 0
+        self._seq = 0
+        self._nWakeups = 0
+
+    def _getKey(self, job, queuedAt):
+        """Helper: return the heap key for 'job', queued at the time
+           'queuedAt'."""
+        cls = job.getPriorityClass()
+        length = job._wantLength or 0
+        # Fold the length into the class: log2 of any length we'll see is
+        # less than 64.
+        key = cls + math.log(length + 1, 2) / 64
+        return key + float(queuedAt) / self._agingInterval
+
+    def _push(self, job, queuedAt):
+        """Helper: add 'job' to the heap.  Caller must hold _cond."""
+        entry = [ self._getKey(job, queuedAt), self._seq, job, queuedAt ]
+        self._seq += 1
+        self._nJobs += 1
+        self._entries[job.getRelativePath()] = entry
+        heapq.heappush(self._heap, entry)
+
+    def put(self, job, now=None):
+        """Add 'job' to the queue."""
+        if now is None:
+            now = time.time()
+        self._cond.acquire()
+        try:
+            self._push(job, now)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def get(self, block=True, wakeups=None):
+        """Remove and return the most urgent job.  If there is none, wait
+           for one if 'block'; otherwise raise Queue.Empty.  Also raise
+           Queue.Empty instead of waiting if wakeWaiters has been called
+           since getWakeupCount returned 'wakeups' (or since we were
+           called, if 'wakeups' is None)."""
+        self._cond.acquire()
+        try:
+            if wakeups is None:
+                wakeups = self._nWakeups
+            while True:
+                while self._heap and self._heap[0][2] is None:
+                    heapq.heappop(self._heap)
+                if self._heap:
+                    break
+                if not block or self._nWakeups != wakeups:
+                    raise Queue.Empty()
+                self._cond.wait()
+            entry = heapq.heappop(self._heap)
+            job = entry[2]
+            self._nJobs -= 1
+            relPath = job.getRelativePath()
+            if self._entries.get(relPath) is entry:
+                del self._entries[relPath]
+            return job
+        finally:
+            self._cond.release()
+
+    def getWakeupCount(self):
+        """Return a value to pass to get(), so that it won't wait if
+           wakeWaiters is called after we return."""
+        self._cond.acquire()
+        try:
+            return self._nWakeups
+        finally:
+            self._cond.release()
+
+    def wakeWaiters(self):
+        """Make every call to get() that is waiting for a job raise
+           Queue.Empty, so that its caller can decide whether it still
+           wants one."""
+        self._cond.acquire()
+        try:
+            self._nWakeups += 1
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def reprioritize(self, relPath, priorityClass):
+        """If the job for relPath is in this queue, give it the priority
+           class 'priorityClass'.  Return true iff it was here."""
+        self._cond.acquire()
+        try:
+            entry = self._entries.get(relPath)
+            if entry is None:
+                return False
+            job = entry[2]
+            entry[2] = None
+            self._nJobs -= 1
+            job.setPriorityClass(priorityClass)
+            self._push(job, entry[3])
+            return True
+        finally:
+            self._cond.release()
+
+    def empty(self):
+        self._cond.acquire()
+        try:
+            return self._nJobs == 0
+        finally:
+            self._cond.release()
+
+    def __len__(self):
+        self._cond.acquire()
+        try:
+            return self._nJobs
+        finally:
+            self._cond.release()
+
+# Default limits for DownloadManager's worker pool: the most threads we'll
+# run, and the most connections we'll hold open to any one mirror.
+_MAX_THREADS = 8
+_MAX_PER_MIRROR = 2
+# How often, in seconds, DownloadManager reconsiders how many threads to
+# run; and how much better or worse aggregate throughput has to get
+# before we call it a change.
+_POOL_SAMPLE_INTERVAL = 2.0
+_POOL_MIN_GAIN = 0.1
+
 class DownloadManager:
     """Class to track a set of downloads and pass them out to worker threads.
+
+       We run between n_threads and maxThreads worker threads.  While
+       jobs are waiting, we add a thread every so often for as long as
+       each new thread makes our total throughput better; when it gets
+       worse, or the queue runs dry, we let threads go.  We hold at most
+       maxPerMirror connections to any one mirror.
+
+       A job that no mirror will serve yet, because we're waiting to
+       retry all the mirrors that have it, is held back until one will;
+       meanwhile, other jobs go ahead.
     """
-    def __init__(self, n_threads=2):
+    ## Fields (for the worker pool):
+    #   _minThreads, _maxThreads: bounds on the number of worker threads.
+    #   _target: how many worker threads we want right now.
+    #   _nBusy: how many worker threads are running a job.
+    #   _nextThreadIdx: the number to give the next thread we start.
+    #   _started: true iff start() has been called.
+    #   _sampleStart, _sampleBytes: when we started measuring throughput
+    #     at the current _target, and how many bytes we've fetched since.
+    #   _lastThroughput: bytes per second we got at the previous
+    #     _target, or None if we don't know.
+    ## Fields (for held jobs; protected by _lock):
+    #   _delayed: a heap of (time, seq, job) for the jobs we're holding
+    #     until 'time', when some mirror should be willing to serve them.
+    #   _nDelayed: a counter, to keep jobs with equal times in order.
+    def __init__(self, n_threads=2, statusLog=None, maxThreads=None,
+                 maxPerMirror=None):
         # Prevents concurrent modification to downloads and haveDownloaded
         self._lock = threading.RLock()
         # Map from resource relPath to job.
@@ -31,31 +418,125 @@ class DownloadManager:
         # managed to dowload.
         self.haveDownloaded = {}
         # Work queue of DownloadJobs that we intend to process once a thread
-        # is free.
-        self.downloadQueue = Queue.Queue()
+        # is free, most urgent first.
+        self.downloadQueue = DownloadQueue()
         # Work queue of functions that need to be run in the main thread.
         self.resultQueue = Queue.Queue()
 
-        # List of worker threads.
-        self.threads = [ threading.Thread(target=self._thread, args=[idx])
-                         for idx in xrange(n_threads) ]
+        # List of running worker threads.
+        self.threads = []
         # Condition that gets triggered whenever a thread is finished doing
         # something.
         self.done = threading.Condition()
-        for t in self.threads:
-            t.setDaemon(True)
+
+        if maxThreads is None:
+            maxThreads = max(n_threads, _MAX_THREADS)
+        if maxPerMirror is None:
+            maxPerMirror = _MAX_PER_MIRROR
+        self._minThreads = n_threads
+        self._maxThreads = maxThreads
+        self._target = n_threads
+        self._nBusy = 0
+        self._nextThreadIdx = 0
+        self._started = False
+        self._sampleStart = time.time()
+        self._sampleBytes = 0
+        self._lastThroughput = None
+
+        self._delayed = []
+        self._nDelayed = 0
 
         # Used to remember the status of downloads to avoid too much retrying
-        self.statusLog = DownloadStatusLog()
+        if statusLog is None:
+            statusLog = DownloadStatusLog()
+        self.statusLog = statusLog
+
+        # Persistent connections to mirrors, shared by our threads.
+        self.connectionPool = ConnectionPool(maxPerHost=maxPerMirror)
 
         # Used to tell the main thread to raise an exception.
         self._raiseMe = None
 
     def start(self):
-        """Start all of this download manager's worker threads."""
-        for t in self.threads:
+        """Start this download manager's worker threads."""
+        self._lock.acquire()
+        try:
+            self._started = True
+            logCtrl("CONCURRENCY", THREADS=str(self._target),
+                    MAXTHREADS=str(self._maxThreads),
+                    PERMIRROR=str(self.connectionPool._maxPerHost))
+            self._growPool()
+        finally:
+            self._lock.release()
+
+    def _growPool(self):
+        """Helper: start as many worker threads as we want and have work
+           for.  Caller must hold _lock."""
+        if not self._started:
+            return
+        want = max(self._minThreads,
+                   min(self._target, self._nBusy + len(self.downloadQueue)))
+        while len(self.threads) < want:
+            t = threading.Thread(target=self._thread,
+                                 args=[self._nextThreadIdx])
+            t.setDaemon(True)
+            self._nextThreadIdx += 1
+            self.threads.append(t)
             t.start()
 
+    def _retireThread(self):
+        """Helper: called by a worker thread between jobs.  If we have more
+           threads than we want, remove the calling thread from the pool
+           and return true."""
+        self._lock.acquire()
+        try:
+            if len(self.threads) <= max(self._minThreads, self._target):
+                return False
+            self.threads.remove(threading.currentThread())
+            return True
+        finally:
+            self._lock.release()
+
+    def _adjustPool(self, nBytes, now=None):
+        """Helper: a worker thread has just fetched nBytes bytes.  Decide
+           whether to change the number of threads we want, and start
+           more threads if we need them.  Caller must hold _lock."""
+        if now is None:
+            now = time.time()
+        self._sampleBytes += nBytes
+        elapsed = now - self._sampleStart
+        if elapsed < _POOL_SAMPLE_INTERVAL:
+            return
+        throughput = self._sampleBytes / elapsed
+        queued = len(self.downloadQueue)
+        last = self._lastThroughput
+        target = self._target
+        if queued == 0:
+            target = max(self._minThreads, self._nBusy)
+        elif last is None or throughput >= last * (1 + _POOL_MIN_GAIN):
+            # Adding threads has helped so far; try another.
+            target = min(self._maxThreads, target + 1)
+        elif throughput < last * (1 - _POOL_MIN_GAIN):
+            # The last thread made things worse.
+            target = max(self._minThreads, target - 1)
+
+        self._sampleStart = now
+        self._sampleBytes = 0
+        self._lastThroughput = throughput
+        if target != self._target:
+            logging.info("Changing download threads from %s to %s "
+                         "(%d bytes/sec, %s queued)", self._target, target,
+                         throughput, queued)
+            logCtrl("CONCURRENCY", THREADS=str(target),
+                    THROUGHPUT=str(int(throughput)), QUEUED=str(queued))
+            shrinking = target < self._target
+            self._target = target
+            if shrinking:
+                # Idle threads are waiting for a job; wake them so that
+                # the ones we don't want any more can retire.
+                self.downloadQueue.wakeWaiters()
+        self._growPool()
+
     def isCurrentlyDownloading(self, relPath):
         """Return true iff this download manager is currently downloading
            some copy of the resource at relPath."""
@@ -84,35 +565,129 @@ class DownloadManager:
         finally:
             self._lock.release()
 
-    def wait(self):
-        """Pause until we have no active or pending jobs."""
-        while not self.finished():
-            # Wait till somebody tells us to do something.
+    def wait(self, anyJob=False):
+        """Pause until we have no active or pending jobs.  If 'anyJob',
+           return as soon as any job has finished and had its callbacks
+           run, instead."""
+        while True:
+            # Wait till somebody tells us to do something, or until we can
+            # start a job we're holding.  We hold 'done' from the check
+            # until we wait, so that we can't miss it.
             self.done.acquire()
-            self.done.wait()
-            self.done.release()
+            try:
+                delay = self._releaseDelayed()
+                if self.finished() or \
+                       (anyJob and not self.resultQueue.empty()):
+                    break
+                self.done.wait(delay)
+            finally:
+                self.done.release()
 
-            # Did something go wrong?
-            if self._raiseMe:
-                raise self._raiseMe
+            if self._runCallbacks() and anyJob:
+                return
 
-            # Suck functions out of resultQueue and run them until
-            # resultQueue is empty.
-            try:
-                while True:
-                    item = self.resultQueue.get(block=False)
-                    item()
-            except Queue.Empty:
-                pass
+        # Jobs queue their callbacks before they count as finished.
+        self._runCallbacks()
+
+    def _runCallbacks(self):
+        """Helper: run everything in resultQueue in this thread.  Return
+           the number of callbacks we ran."""
+        # Did something go wrong?
+        if self._raiseMe:
+            raise self._raiseMe
+
+        # Suck functions out of resultQueue and run them until
+        # resultQueue is empty.
+        n = 0
+        try:
+            while True:
+                item = self.resultQueue.get(block=False)
+                item()
+                n += 1
+        except Queue.Empty:
+            pass
+        return n
 
     def addDownloadJob(self, job):
         """Add another DownloadJob to the end of the work queue."""
         job.setDownloadStatusLog(self.statusLog)
+        job.setConnectionPool(self.connectionPool)
         rp = job.getRelativePath()
         self._lock.acquire()
         self.downloads[rp] = job
         self._lock.release()
+        self._schedule(job)
+
+    def _schedule(self, job, now=None):
+        """Helper: dispatch 'job' if some mirror will serve it now;
+           otherwise hold it until one will."""
+        if now is None:
+            now = time.time()
+        readyAt = job.getReadyTime()
+        if readyAt <= now:
+            self._dispatch(job)
+            return
+        rp = job.getRelativePath()
+        logging.info("Waiting %d seconds before we fetch %s",
+                     readyAt - now, rp)
+        logCtrl("WAIT", FOR="MIRROR", FILENAME=rp)
+        self._lock.acquire()
+        try:
+            heapq.heappush(self._delayed, (readyAt, self._nDelayed, job))
+            self._nDelayed += 1
+        finally:
+            self._lock.release()
+
+    def _releaseDelayed(self, now=None):
+        """Helper: dispatch every job we've been holding that some mirror
+           should now serve.  Return the number of seconds until we can
+           dispatch the next one, or None if we aren't holding any."""
+        if now is None:
+            now = time.time()
+        ready = []
+        self._lock.acquire()
+        try:
+            while self._delayed and self._delayed[0][0] <= now:
+                ready.append(heapq.heappop(self._delayed)[2])
+        finally:
+            self._lock.release()
+        # A mirror may have failed again since we decided to wait.
+        for job in ready:
+            self._schedule(job, now)
+
+        self._lock.acquire()
+        try:
+            if not self._delayed:
+                return None
+            return max(0, self._delayed[0][0] - now)
+        finally:
+            self._lock.release()
+
+    def _dispatch(self, job):
+        """Helper: start 'job' as soon as we have room for it."""
+        self._queueForThread(job)
+
+    def _queueForThread(self, job):
+        """Helper: put 'job' on the queue for our worker threads."""
         self.downloadQueue.put(job)
+        self._lock.acquire()
+        try:
+            self._growPool()
+        finally:
+            self._lock.release()
+
+    def reprioritize(self, relPath, priorityClass):
+        """If the job for relPath hasn't started yet, give it the priority
+           class 'priorityClass'.  Return true iff it hadn't started."""
+        self._lock.acquire()
+        try:
+            for _, _, job in self._delayed:
+                if job.getRelativePath() == relPath:
+                    job.setPriorityClass(priorityClass)
+                    return True
+        finally:
+            self._lock.release()
+        return self.downloadQueue.reprioritize(relPath, priorityClass)
 
     def getRetryTime(self, mirrorList, relPath):
         """Given a mirrorlist and a filename relative to the repository root,
@@ -133,33 +708,59 @@ class DownloadManager:
         """Callback: invoked when a download fails."""
         pass
 
+    def _noteResult(self, job, failure):
+        """Helper: record the outcome of 'job' in our statusLog, and queue
+           its callback to run in the main thread.  'failure' is the
+           DownloadFailure it returned, or None if it succeeded."""
+        if failure == None:
+            self.statusLog.succeeded(job.getMirror(), job.getRelativePath())
+            stats = job.getTransferStats()
+            if stats is not None:
+                self.statusLog.noteTransfer(job.getMirror(), *stats)
+            self.resultQueue.put(job._success)
+        else:
+            self.statusLog.failed(failure)
+            self.resultQueue.put(job._failure)
+
     def _thread(self, idx):
         # Run in the background per thread.  idx is the number of the thread.
         while True:
-            job = self.downloadQueue.get() # Grab a job from queue.
+            # Note the wakeup count before we decide not to retire, so
+            # that if the pool shrinks after we decide, we don't wait.
+            wakeups = self.downloadQueue.getWakeupCount()
+            if self._retireThread():
+                break
+            try:
+                job = self.downloadQueue.get(wakeups=wakeups)
+            except Queue.Empty:
+                # We were woken because the pool shrank.
+                continue
             rp = job.getRelativePath()
             success = False
+            self._lock.acquire()
+            self._nBusy += 1
+            self._lock.release()
             try:
                 logging.info("start %s in Thread %s", rp, idx)
                 failure = job.download() # Execute the download.
                 logging.info("end %s in Thread %s", rp, idx)
             finally:
+                self._noteResult(job, failure)
+
                 self._lock.acquire()
                 try:
                     del self.downloads[rp]
                     if success: # If we downloaded correctly, say so.
                         self.haveDownloaded[rp] = True
+                    self._nBusy -= 1
+                    stats = job.getTransferStats()
+                    if stats is not None:
+                        self._adjustPool(stats[1])
+                    else:
+                        self._adjustPool(0)
                 finally:
                     self._lock.release()
 
-                if failure == None:
-                    self.statusLog.succeeded(job.getMirror(),
-                                             job.getRelativePath())
-                    self.resultQueue.put(job._success)
-                else:
-                    self.statusLog.failed(failure)
-                    self.resultQueue.put(job._failure)
-
                 self.done.acquire()
                 self.done.notify()
                 self.done.release()
@@ -193,11 +794,19 @@ class DownloadFailure:
 
            Use DownloadFailure.badCompoundFile().  We don't know who
            to blame, so we treat the whole network as having gone bibbledy.
+
+       D - We assembled a file from segments fetched from several
+           mirrors, and it was no good.
+
+           Use DownloadFailure.badSegmentedFile(): one of those mirrors
+           sent us garbage, so we blame each of them.
     """
     def __init__(self, urlbase, relPath, networkError=False):
         self._urlbase = urlbase
         self._relPath = relPath
         self._network = networkError
+        # Other mirrors that share the blame with _urlbase.
+        self._otherMirrors = []
 
         self._when = time.time()
 
@@ -213,30 +822,82 @@ class DownloadFailure:
     def connectionFailed(urlbase):
         return DownloadFailure(urlbase, None, True)
 
+    @staticmethod
+    def badSegmentedFile(urlbases, relpath):
+        failure = DownloadFailure(urlbases[0], relpath)
+        failure._otherMirrors = list(urlbases[1:])
+        return failure
+
 S = thandy.checkJson
 _FAIL_SCHEMA = S.Struct([S.Int(), thandy.formats.TIME_SCHEMA], allowMore=True)
+# [ latency in msec, bytes per second or 0 if unknown, errors per 1000
+#   attempts, time of last update ]
+_MIRROR_STATS_SCHEMA = S.Struct([S.Int(lo=0), S.Int(lo=0), S.Int(lo=0, hi=1000),
+                                 thandy.formats.TIME_SCHEMA], allowMore=True)
+# [ urlbase, ETag or "", Last-Modified or "", SHA256 of the file ]
+_VALIDATORS_SCHEMA = S.Struct([S.AnyStr(), S.AnyStr(), S.AnyStr(),
+                               thandy.formats.HASH_SCHEMA], allowMore=True)
 _STATUS_LOG_SCHEMA = S.Obj(
     v=S.Int(),
     mirrorFailures=S.DictOf(S.AnyStr(), _FAIL_SCHEMA),
-    networkFailures=_FAIL_SCHEMA)
+    networkFailures=_FAIL_SCHEMA,
+    mirrorStats=S.Opt(S.DictOf(S.AnyStr(), _MIRROR_STATS_SCHEMA)),
+    validators=S.Opt(S.DictOf(S.AnyStr(), _VALIDATORS_SCHEMA)))
 del S
 
+# How much each new observation of a mirror counts toward its running
+# latency, throughput, and error rate.
+_STATS_ALPHA = 0.3
+# What we've seen of a mirror counts half as much in choosing mirrors
+# after this many seconds without news of it.
+_STATS_HALF_LIFE = 7*24*3600
+# Transfers shorter than this don't tell us much about throughput.
+_MIN_THROUGHPUT_SAMPLE = 16*1024
+# How often we ignore what we've seen and choose a mirror by its weight
+# alone, so that we keep learning about mirrors we've been avoiding.
+_EXPLORE_PROBABILITY = 0.1
+# How long we assume a file is when choosing a mirror for it, if we
+# don't know.
+_DEFAULT_FILE_LENGTH = 64*1024
+
 class DownloadStatusLog:
-    """Tracks when we can retry downloading from various mirrors.
+    """Tracks when we can retry downloading from various mirrors, and how
+       well each mirror has served us.
 
        Currently, we treat every failure as affecting a mirror, the
        network, or both.  When a mirror or the network fails, we back
        off for a while before we attempt it again.  For each failure
        with no intervening success, we back off longer.
+
+       We also keep a running average of each mirror's latency,
+       throughput, and error rate, and use them to favor the mirrors
+       that will get us a file soonest: see weighMirrors().
+
+       And we remember the ETag and Last-Modified headers that came with
+       each file, so that we can ask for it next time only if it has
+       changed: see getValidators().
     """
     # XXXX get smarter.
-    # XXXX make this persistent.
-    def __init__(self, mirrorFailures={}, networkFailures=[0,0]):
+    def __init__(self, mirrorFailures={}, networkFailures=[0,0],
+                 mirrorStats={}, validators={}):
         self._lock = threading.RLock()
         # Map from urlbase to [ nFailures, lastFailureTime ]
         self._mirrorFailures = dict(mirrorFailures)
         # [ nFailures, lastFailureTime ] for the network as a while.
         self._netFailure = list(networkFailures)
+        # Map from urlbase to [ latency in seconds, bytes per second or
+        # None, error rate, lastUpdateTime ]
+        self._mirrorStats = dict((k, list(v))
+                                 for k, v in mirrorStats.iteritems())
+        # Map from relPath to (urlbase, ETag or None, Last-Modified or
+        # None, SHA256 digest) for the copy of the file we got from the
+        # mirror at urlbase.
+        self._validators = dict(validators)
+        # The file we save ourself to, or None.
+        self._fname = None
+        # How many seconds our most recent downloads of small files took,
+        # oldest first.
+        self._smallFileTimes = collections.deque(maxlen=200)
 
     def _getDelay(self, isMirror, failureCount):
         """Return how long we should wait since the 'failureCount'th
@@ -257,21 +918,205 @@ class DownloadStatusLog:
            state of this DownloadStatusLog."""
         def formatEnt(e):
             return [ e[0], thandy.formats.formatTime(e[1]) ]
-        return { 'v': 1,
-                 'networkFailures' : formatEnt(self._netFailure),
-                 'mirrorFailures' :
-                 dict((k, formatEnt(v)) for k, v
-                      in self._mirrorFailures.iteritems())
-                 }
+        def formatStats(e):
+            return [ int(e[0]*1000), int(e[1] or 0), int(e[2]*1000),
+                     thandy.formats.formatTime(e[3]) ]
+        def formatValidators(e):
+            return [ e[0], e[1] or "", e[2] or "",
+                     thandy.formats.formatHash(e[3]) ]
+        self._lock.acquire()
+        try:
+            return { 'v': 1,
+                     'networkFailures' : formatEnt(self._netFailure),
+                     'mirrorFailures' :
+                     dict((k, formatEnt(v)) for k, v
+                          in self._mirrorFailures.iteritems()),
+                     'mirrorStats' :
+                     dict((k, formatStats(v)) for k, v
+                          in self._mirrorStats.iteritems()),
+                     'validators' :
+                     dict((k, formatValidators(v)) for k, v
+                          in self._validators.iteritems())
+                     }
+        finally:
+            self._lock.release()
 
     @staticmethod
     def fromJSON(obj):
         _STATUS_LOG_SCHEMA.checkMatch(obj)
         def parseEnt(e):
             return [ e[0], thandy.formats.parseTime(e[1]) ]
+        def parseStats(e):
+            return [ e[0] / 1000.0, e[1] or None, e[2] / 1000.0,
+                     thandy.formats.parseTime(e[3]) ]
+        def parseValidators(e):
+            return ( e[0], e[1] or None, e[2] or None,
+                     thandy.formats.parseHash(e[3]) )
         return DownloadStatusLog( dict((k, parseEnt(v)) for k,v
                                         in obj['mirrorFailures'].iteritems()),
-                                  parseEnt(obj['networkFailures']))
+                                  parseEnt(obj['networkFailures']),
+                                  dict((k, parseStats(v)) for k,v
+                                       in obj.get('mirrorStats',
+                                                  {}).iteritems()),
+                                  dict((k, parseValidators(v)) for k,v
+                                       in obj.get('validators',
+                                                  {}).iteritems()))
+
+    @staticmethod
+    def load(fname):
+        """Return a DownloadStatusLog read from 'fname', which will save
+           itself there.  A missing or malformed file gives us an empty
+           log."""
+        log = None
+        try:
+            f = open(fname, 'r')
+        except IOError:
+            pass
+        else:
+            try:
+                try:
+                    log = DownloadStatusLog.fromJSON(json.load(f))
+                except (ValueError, thandy.FormatException), e:
+                    logging.warn("Ignoring corrupt download status %s: %s",
+                                 fname, e)
+            finally:
+                f.close()
+        if log is None:
+            log = DownloadStatusLog()
+        log._fname = fname
+        return log
+
+    def save(self):
+        """Write this log to the file we loaded it from, if any."""
+        if self._fname is None:
+            return
+        thandy.util.ensureParentDir(self._fname)
+        thandy.util.replaceFile(self._fname, json.dumps(self.toJSON()))
+
+    def _updateStats(self, urlbase, latency=None, throughput=None,
+                     error=None):
+        """Helper: fold a new observation of the mirror at urlbase into
+           its running averages.  Caller must hold _lock."""
+        if urlbase is None:
+            return
+        now = time.time()
+        st = self._mirrorStats.get(urlbase)
+        if st is None:
+            st = self._mirrorStats[urlbase] = [ latency or 0.0, throughput,
+                                                error or 0.0, now ]
+        def avg(old, new):
+            if old is None:
+                return new
+            return old + _STATS_ALPHA * (new - old)
+        if latency is not None:
+            st[0] = avg(st[0], latency)
+        if throughput is not None:
+            st[1] = avg(st[1], throughput)
+        if error is not None:
+            st[2] = avg(st[2], error)
+        st[3] = now
+
+    def getValidators(self, relPath):
+        """Return a (urlbase, etag, lastModified, digest) tuple for the
+           last copy of relPath that we fetched in full: the mirror we got
+           it from, the ETag and Last-Modified headers that mirror sent
+           (either may be None), and the SHA256 digest of the file.
+           Return None if we don't know."""
+        self._lock.acquire()
+        try:
+            return self._validators.get(relPath)
+        finally:
+            self._lock.release()
+
+    def setValidators(self, relPath, urlbase, etag, lastModified, digest):
+        """Remember the validators for the copy of relPath that we just
+           fetched; see getValidators().  If etag and lastModified are both
+           None, forget what we knew."""
+        self._lock.acquire()
+        try:
+            if etag is None and lastModified is None:
+                self._validators.pop(relPath, None)
+            else:
+                self._validators[relPath] = (urlbase, etag, lastModified,
+                                             digest)
+        finally:
+            self._lock.release()
+
+    def noteTransfer(self, urlbase, latency, nBytes, seconds):
+        """Note that the mirror at urlbase started answering a request
+           after 'latency' seconds, then sent us nBytes in 'seconds'
+           seconds."""
+        throughput = None
+        if nBytes >= _MIN_THROUGHPUT_SAMPLE and seconds > 0:
+            throughput = nBytes / seconds
+        self._lock.acquire()
+        try:
+            self._updateStats(urlbase, latency, throughput)
+            if nBytes <= _MAX_HEDGED_LENGTH:
+                self._smallFileTimes.append(latency + seconds)
+        finally:
+            self._lock.release()
+
+    def getSmallFileTime(self, fraction):
+        """Return how many seconds it took to download the quickest
+           'fraction' of the small files we've fetched lately, or None if
+           we haven't fetched enough to say."""
+        self._lock.acquire()
+        try:
+            times = sorted(self._smallFileTimes)
+        finally:
+            self._lock.release()
+        if len(times) < 20:
+            return None
+        return times[min(len(times)-1, int(len(times) * fraction))]
+
+    def _getExpectedTime(self, urlbase, length):
+        """Helper: return how many seconds we expect the mirror at urlbase
+           to take to send us 'length' bytes, and how much what we know
+           about it still counts; or (None, 0) if we don't know.  Caller
+           must hold _lock."""
+        st = self._mirrorStats.get(urlbase)
+        if st is None or st[1] is None:
+            return None, 0
+        t = st[0] + float(length) / st[1]
+        if st[2] >= 1:
+            t = float("inf")
+        else:
+            # Each error costs us a whole extra attempt.
+            t /= (1 - st[2])
+        age = max(0, time.time() - st[3])
+        return t, 0.5 ** (age / _STATS_HALF_LIFE)
+
+    def weighMirrors(self, mirrors, length=None):
+        """Given a list of mirror objects from a mirrorlist, return a list
+           of (weight, mirror) tuples for randChooseWeighted.  We scale
+           each mirror's signed weight by how much faster than average we
+           expect it to send a file of 'length' bytes, as far as we know
+           and as recently as we learned it.  Once in a while, we use the
+           signed weights alone."""
+        if random.random() < _EXPLORE_PROBABILITY:
+            return [ (m['weight'], m) for m in mirrors ]
+        if length is None:
+            length = _DEFAULT_FILE_LENGTH
+        self._lock.acquire()
+        try:
+            expected = [ self._getExpectedTime(m['urlbase'], length)
+                         for m in mirrors ]
+        finally:
+            self._lock.release()
+        known = [ 1.0 / t for t, _ in expected if t is not None ]
+        if not known:
+            return [ (m['weight'], m) for m in mirrors ]
+        meanSpeed = sum(known) / len(known)
+        result = []
+        for m, (t, decay) in zip(mirrors, expected):
+            factor = 1.0
+            if t is not None and meanSpeed > 0:
+                factor = (1.0 / t) / meanSpeed
+                factor = 1.0 + (factor - 1.0) * decay
+                factor = min(max(factor, 0.05), 20.0)
+            result.append( (m['weight'] * factor, m) )
+        return result
 
     def failed(self, failure):
         """Note that 'failure', a DownloadFailure object, has occurred."""
@@ -279,9 +1124,14 @@ class DownloadStatusLog:
         try:
             when = long(failure._when)
 
-            # If there's a mirror to blame, blame it.
+            # If there are mirrors to blame, blame them.
             if failure._urlbase != None:
-                s = self._mirrorFailures.setdefault(failure._urlbase, [0, 0])
+                blame = [ failure._urlbase ] + failure._otherMirrors
+            else:
+                blame = []
+            for urlbase in blame:
+                self._updateStats(urlbase, error=1.0)
+                s = self._mirrorFailures.setdefault(urlbase, [0, 0])
                 # XXXX This "+ 5" business is a hack.  The idea is to keep
                 # multiple failure within 5 seconds from counting as one,
                 # since it's common for us to launch multiple downloads
@@ -313,6 +1163,7 @@ class DownloadStatusLog:
             except KeyError:
                 pass
             self._netFailure = [0, 0]
+            self._updateStats(urlbase, error=0.0)
         finally:
             self._lock.release()
 
@@ -348,6 +1199,11 @@ class DownloadStatusLog:
 class DownloadJob:
     """Abstract base class.  Represents a thing to be downloaded, and the
        knowledge of how to download it."""
+    # True iff this job fetches its file with _prepareDownload(),
+    # _beginBody() and friends, so that something other than _download()
+    # can drive them.
+    _usesTransfers = True
+
     def __init__(self, targetPath, tmpPath, wantHash=None,
                  repoFile=None, useTor=False, wantLength=None):
         """Create a new DownloadJob.  When it is finally downloaded,
@@ -363,6 +1219,17 @@ class DownloadJob:
         self._wantLength = wantLength
         self._repoFile = repoFile
         self._useTor = useTor
+        # A ConnectionPool to get HTTP connections from, or None.
+        self._connectionPool = None
+        # How many bytes of the temporary file we had to read back in
+        # order to hash them, on our last attempt.
+        self._bytesRehashed = 0
+        # The _Transfer for our last attempt, or None.
+        self._lastTransfer = None
+        # Our priority class, if somebody has set it.
+        self._priorityClass = None
+        # True iff our last attempt found that we had the file already.
+        self._notModified = False
 
         self._success = lambda : None
         self._failure = lambda : None
@@ -384,6 +1251,42 @@ class DownloadJob:
            if we know it."""
         return None
 
+    def getReadyTime(self):
+        """Return the time after which some mirror should be willing to
+           serve us our file, or 0 if one will now."""
+        return 0
+
+    def wasNotModified(self):
+        """Return true iff our last attempt succeeded because the mirror
+           told us that the copy we already had was current."""
+        return self._notModified
+
+    def _hasGzipSibling(self):
+        """Helper: return true iff the mirror we've chosen keeps a gzipped
+           copy of our file at our URL plus ".gz"."""
+        return False
+
+    def _getConditionalHeaders(self):
+        """Helper: if we can ask the mirror we've chosen to send our file
+           only if it differs from the copy we have, return the headers
+           to do so.  Otherwise return {}."""
+        return {}
+
+    def _noteValidators(self, xfer):
+        """Helper: we have just fetched our whole file with xfer.  Remember
+           what the mirror told us about its version of the file."""
+        pass
+
+    def getPriorityClass(self):
+        """Return how urgent this job is; see getPriorityClass()."""
+        if self._priorityClass is not None:
+            return self._priorityClass
+        return getPriorityClass(self.getRelativePath())
+
+    def setPriorityClass(self, priorityClass):
+        """Override how urgent this job is."""
+        self._priorityClass = priorityClass
+
     def getRelativePath(self):
         """Abstract. Returns a string representing this download, to
            keep two downloads of the same object from running at once.
@@ -406,26 +1309,52 @@ class DownloadJob:
         try:
             self._download()
             return None
-        except BadCompoundData, err:
+        except:
+            return self._getFailure(sys.exc_info()[1])
+
+    def _getFailure(self, err, mirror=None):
+        """Helper: return a DownloadFailure to describe the exception
+           'err', which made this download fail.  If 'mirror' is given,
+           it's the urlbase of the mirror we were using; otherwise, we
+           ask getMirror()."""
+        if mirror is None:
+            mirror = self.getMirror()
+        if isinstance(err, BadSegmentedData):
+            logging.warn("Download failed: %s", err)
+            # One of the mirrors that sent us part of the file sent us
+            # garbage; we don't know which.
+            return DownloadFailure.badSegmentedFile(err.mirrors,
+                                                    self.getRelativePath())
+        elif isinstance(err, BadCompoundData):
             logging.warn("Download failed: %s", err)
             # No way to apportion the blame.
             return DownloadFailure.badCompoundFile(self.getRelativePath())
-        except (urllib2.HTTPError, thandy.DownloadError), err:
+        elif isinstance(err, (urllib2.HTTPError, thandy.DownloadError)):
             # looks like we may have irreconcilable differences with a
             # particular mirror.
             logging.warn("Download failed: %s", err)
-            return DownloadFailure.mirrorFailed(self.getMirror(),
+            return DownloadFailure.mirrorFailed(mirror,
                                                 self.getRelativePath())
-        except (OSError, httplib.error, IOError, urllib2.URLError), err:
+        elif isinstance(err, (OSError, httplib.HTTPException, IOError,
+                              urllib2.URLError)):
             logging.warn("Download failed: %s", err)
             # Could be the mirror; could be the network.  Hard to say.
-            return DownloadFailure.connectionFailed(self.getMirror())
-        except:
-            tp, val, tb = sys.exc_info()
-            logging.exception("Internal error during download: %s", val)
+            return DownloadFailure.connectionFailed(mirror)
+        else:
+            logging.exception("Internal error during download: %s", err)
             # We have an exception!  Treat it like a network error, I guess.
             return DownloadFailure.connectionFailed(None)
 
+    def getTransferStats(self):
+        """Return a (latency, nBytes, seconds) tuple describing how fast
+           getMirror() sent us our file on our last attempt, or None if we
+           don't know."""
+        xfer = self._lastTransfer
+        if xfer is None or xfer.finished is None:
+            return None
+        return (xfer.connected - xfer.started, xfer.total,
+                xfer.finished - xfer.connected)
+
     def setDownloadStatusLog(self, log):
         """Base our URL-picking decisions on the DownloadStatusLog in
            'log'.  The caller is still responsible for invoking the
@@ -433,125 +1362,562 @@ class DownloadJob:
            design?"""
         pass
 
-    def _checkTmpFile(self):
+    def setConnectionPool(self, pool):
+        """Make HTTP requests over persistent connections from the
+           ConnectionPool 'pool'."""
+        self._connectionPool = pool
+
+    def _checkTmpFile(self, content=None, rawDigest=None):
         """Helper: check whether the downloaded temporary file matches
-           the hash and/or format we need."""
+           the hash and/or format we need.  If we have them, 'content' is
+           the contents of the file, and 'rawDigest' is their SHA256."""
         if self._wantHash and not self._repoFile:
-            gotHash = thandy.formats.getFileDigest(self._tmpPath)
-            with open(self._tmpPath, "r") as f:
-                data = f.read()
-                import json
-                obj = json.loads(data)
-                main_obj = obj['signed']
-                gotHash = thandy.formats.getDigest(main_obj)
-                #print self._tmpPath, "ObjHash:", thandy.formats.formatHash(jsonHash)
-
-            print self._tmpPath, "Got:", thandy.formats.formatHash(gotHash)
-            print self._tmpPath, "Expected:", thandy.formats.formatHash(self._wantHash)
+            if content is None:
+                f = open(self._tmpPath, "rb")
+                try:
+                    content = f.read()
+                finally:
+                    f.close()
+            try:
+                obj, gotHash = thandy.formats.decodeAndDigest(content)
+            except ValueError, e:
+                raise thandy.FormatException("Couldn't decode content: %s"%e)
+
             if gotHash != self._wantHash:
+                logging.debug("%s: expected hash %s", self._tmpPath,
+                              thandy.formats.formatHash(self._wantHash))
                 raise thandy.FormatException("File hash was not as expected.")
         elif self._repoFile:
-            self._repoFile.checkFile(self._tmpPath, self._wantHash)
+            self._repoFile.checkFile(self._tmpPath, self._wantHash,
+                                     content=content, rawDigest=rawDigest)
 
     def _removeTmpFile(self):
         """Helper: remove the temporary file so that we do not get stuck in
            a downloading-it-forever loop."""
         os.unlink(self._tmpPath)
+        self._removeCheckpoint()
+        self._removeEncodedFile()
 
-    def _download(self):
-        # Implementation function.  Unlike download(), can throw exceptions.
-        f_in = f_out = None
-
-        haveStalled = self.haveStalledFile()
-        if haveStalled and self._wantHash:
-            try:
-                self._checkTmpFile()
-            except thandy.Exception:
-                pass
-            else:
-                # What luck!  This stalled file was what we wanted.
-                # (This happens mostly when we have an internal error.)
-                thandy.util.ensureParentDir(self._destPath)
-                thandy.util.moveFile(self._tmpPath, self._destPath)
-                return
+    def _getEncodedPath(self):
+        """Return the file where we keep the part of our file's gzipped
+           sibling that we've received, so that we can resume it."""
+        return self._tmpPath + ".gzpart"
 
+    def _removeEncodedFile(self):
+        """Helper: remove the partial gzipped file, if there is one."""
         try:
-            url = self.getURL()
+            os.unlink(self._getEncodedPath())
+        except OSError:
+            pass
 
-            logging.info("Downloading %s", url)
-
-            if haveStalled:
-                have_length = os.stat(self._tmpPath).st_size
-                logging.info("Have stalled file for %s with %s bytes", url,
-                             have_length)
-                if self._wantLength != None:
-                    if self._wantLength <= have_length:
-                        logging.warn("Stalled file is too long; removing it")
-                        self._removeTmpFile()
-                        haveStalled = False
-                        have_length = None
-            else:
-                have_length = None
+    def _getCheckpointPath(self):
+        """Return the file where we checkpoint our hash of the temporary
+           file."""
+        return self._tmpPath + ".hashstate"
 
+    def _removeCheckpoint(self):
+        """Helper: remove our hash checkpoint, if there is one."""
+        try:
+            os.unlink(self._getCheckpointPath())
+        except OSError:
+            pass
+
+    def _getTailDigest(self, offset):
+        """Helper: return the SHA256 of the _CHECKPOINT_TAIL bytes of
+           the temporary file that come before 'offset'."""
+        start = max(0, offset - _CHECKPOINT_TAIL)
+        f = open(self._tmpPath, 'rb')
+        try:
+            f.seek(start)
+            return thandy.formats.getDigest(f.read(offset - start))
+        finally:
+            f.close()
+
+    def _saveCheckpoint(self, digestObj, offset):
+        """Helper: record that 'digestObj' holds the hash of the first
+           'offset' bytes of the temporary file, which must already be
+           flushed to disk."""
+        if not isinstance(digestObj, ResumableSHA256):
+            return
+        state = digestObj.getState()
+        obj = { 'v' : 2,
+                'impl' : ResumableSHA256.getImplementation(),
+                'offset' : offset,
+                'state' : thandy.formats.formatBase64(state),
+                'check' : thandy.formats.formatHash(
+                    thandy.formats.getDigest(state)),
+                'tail' : thandy.formats.formatHash(
+                    self._getTailDigest(offset)) }
+        try:
+            thandy.util.replaceFile(self._getCheckpointPath(), json.dumps(obj))
+        except (OSError, IOError), e:
+            logging.warn("Couldn't save hash checkpoint for %s: %s",
+                         self._tmpPath, e)
+
+    def _loadCheckpoint(self, haveLength):
+        """Helper: return a hash object for the first 'haveLength' bytes of
+           the temporary file, starting from our checkpoint if we have a
+           good one.  Return None if we don't."""
+        try:
+            f = open(self._getCheckpointPath(), 'r')
+        except IOError:
+            return None
+        try:
             try:
-                f_in = getConnection(url, self._useTor, have_length)
-            except urllib2.HTTPError, err:
-                if err.code == 416:
-                    # We asked for a range that couldn't be satisfied.
-                    # Usually, this means that the server thinks the file
-                    # is shorter than we think it is.  We need to start over.
-                    self._removeTmpFile()
-                raise
-
-            logging.info("Connected to %s", url)
+                obj = json.load(f)
+                _CHECKPOINT_SCHEMA.checkMatch(obj)
+            except (ValueError, thandy.FormatException), e:
+                logging.info("Ignoring bad hash checkpoint for %s: %s",
+                             self._tmpPath, e)
+                return None
+        finally:
+            f.close()
 
-            gotRange = f_in.info().get("Content-Range")
-            expectLength = f_in.info().get("Content-Length", "???")
-            if gotRange:
-                if gotRange.startswith("bytes %s-"%have_length):
-                    logging.info("Resuming download from %s"%url)
-                    f_out = open(self._tmpPath, 'ab')
-                else:
-                    raise thandy.DownloadError("Got an unexpected range %s"
-                                               %gotRange)
-            else:
-                f_out = open(self._tmpPath, 'wb')
+        offset = obj['offset']
+        if (obj['v'] != 2 or not ResumableSHA256.isAvailable() or
+            obj['impl'] != ResumableSHA256.getImplementation() or
+            offset > haveLength):
+            return None
+        state = thandy.formats.parseBase64(obj['state'])
+        if thandy.formats.getDigest(state) != \
+               thandy.formats.parseHash(obj['check']):
+            logging.info("Hash checkpoint for %s is corrupt.", self._tmpPath)
+            return None
+        if self._getTailDigest(offset) != \
+               thandy.formats.parseHash(obj['tail']):
+            logging.info("Hash checkpoint for %s doesn't match the file.",
+                         self._tmpPath)
+            return None
 
-            total = 0
+        # We load the state into a C struct, so check it even though its
+        # digest matched.
+        try:
+            digestObj = ResumableSHA256(state, offset)
+        except ValueError, e:
+            logging.info("Ignoring bad hash checkpoint for %s: %s",
+                         self._tmpPath, e)
+            return None
+        # Hash whatever we wrote after the checkpoint.
+        f = open(self._tmpPath, 'rb')
+        try:
+            f.seek(offset)
             while True:
-                c = f_in.read(1024)
+                c = f.read(_READ_SIZE)
                 if not c:
                     break
-                f_out.write(c)
-                total += len(c)
-                logging.debug("Got %s/%s bytes from %s",
-                              total, expectLength, url)
-                logCtrl("DOWNLOAD", TOTAL=str(total), EXPECT=str(expectLength), URL=url)
-                if self._wantLength != None and total > self._wantLength:
-                    logging.warn("Read too many bytes from %s; got %s, but "
-                                 "wanted %s", url, total, self._wantLength)
+                digestObj.update(c)
+                self._bytesRehashed += len(c)
+        finally:
+            f.close()
+        return digestObj
+
+    def _hashTmpFile(self):
+        """Helper: return a hash object for the whole temporary file,
+           reading it from disk."""
+        digestObj = _newDownloadDigest()
+        f = open(self._tmpPath, 'rb')
+        try:
+            while True:
+                c = f.read(_READ_SIZE)
+                if not c:
                     break
+                digestObj.update(c)
+                self._bytesRehashed += len(c)
+        finally:
+            f.close()
+        return digestObj
+
+    def _checkStalledFile(self):
+        """Helper: return true iff the temporary file left by an earlier
+           attempt is already the whole file we wanted."""
+        haveLength = os.stat(self._tmpPath).st_size
+        if self._wantLength != None and haveLength != self._wantLength:
+            # It can't be right.
+            return False
+        digestObj = self._loadCheckpoint(haveLength)
+        rawDigest = None
+        if digestObj is not None:
+            rawDigest = digestObj.digest()
+        try:
+            self._checkTmpFile(rawDigest=rawDigest)
+        except thandy.Exception:
+            return False
+        return True
+
+    def _getHedgeMirrors(self):
+        """Helper: if we should hedge our request, return the urlbases of
+           the mirrors to ask, in order.  Otherwise return None."""
+        return None
+
+    def _installContent(self, content):
+        """Helper: we received the whole file in memory as 'content'.
+           Check it, and move it into place if it's good."""
+        thandy.util.ensureParentDir(self._tmpPath)
+        f = open(self._tmpPath, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        try:
+            self._checkTmpFile(content, thandy.formats.getDigest(content))
+        except (thandy.FormatException, thandy.DownloadError):
+            self._removeTmpFile()
+            raise
+        self._installTmpFile()
 
-            if self._wantLength != None and total != self._wantLength:
-                logging.warn("Length wrong on file %s", url)
+    def _installTmpFile(self):
+        """Helper: move the finished temporary file to its destination."""
+        thandy.util.ensureParentDir(self._destPath)
+        thandy.util.moveFile(self._tmpPath, self._destPath)
+        self._removeCheckpoint()
+        self._removeEncodedFile()
+
+    def _prepareDownload(self):
+        """Helper: get ready to fetch this job's file, and return a
+           _Transfer for it.  Return None if a stalled file from an
+           earlier attempt turns out to be the whole file."""
+        self._bytesRehashed = 0
+        self._lastTransfer = None
+        self._notModified = False
+
+        haveStalled = self.haveStalledFile()
+        if haveStalled and self._wantHash and self._checkStalledFile():
+            # What luck!  This stalled file was what we wanted.
+            # (This happens mostly when we have an internal error.)
+            self._installTmpFile()
+            return None
 
+        url = self.getURL()
+        gzipped = self._hasGzipSibling()
+        encodedPath = self._getEncodedPath()
+
+        have_length = None
+        if haveStalled and gzipped and os.path.exists(encodedPath):
+            # We were fetching the gzipped file; pick up where we left off.
+            url += ".gz"
+            have_length = os.stat(encodedPath).st_size
+            logging.info("Have stalled file for %s with %s bytes", url,
+                         have_length)
+        elif haveStalled:
+            # We can resume the uncompressed file from the plain URL,
+            # whatever we were fetching before.
+            gzipped = False
+            self._removeEncodedFile()
+            have_length = os.stat(self._tmpPath).st_size
+            logging.info("Have stalled file for %s with %s bytes", url,
+                         have_length)
+            if self._wantLength != None:
+                if self._wantLength <= have_length:
+                    logging.warn("Stalled file is too long; removing it")
+                    self._removeTmpFile()
+                    have_length = None
+        else:
+            self._removeEncodedFile()
+            if gzipped:
+                url += ".gz"
+
+        logging.info("Downloading %s", url)
+
+        self._lastTransfer = xfer = _Transfer(url, have_length)
+        xfer.gzipped = gzipped
+        if have_length is None:
+            xfer.conditional = self._getConditionalHeaders()
+            # The server may compress the file on the fly, but then we
+            # couldn't resume it, so we only ask when starting afresh.
+            xfer.acceptGzip = not gzipped
+        return xfer
+
+    def _noteHTTPError(self, xfer, code):
+        """Helper: the server answered our request for xfer with the HTTP
+           status 'code', which isn't a success.  Return true iff that
+           means that the copy of our file we already have is current."""
+        if code == 304 and xfer.conditional:
+            logging.info("%s has not changed", xfer.url)
+            xfer.connected = xfer.finished = time.time()
+            self._notModified = True
+            return True
+        if code == 416:
+            # We asked for a range that couldn't be satisfied.
+            # Usually, this means that the server thinks the file
+            # is shorter than we think it is.  We need to start over.
+            self._removeTmpFile()
+        return False
+
+    def _beginBody(self, xfer, headers):
+        """Helper: the server has accepted our request for xfer, and sent
+           us the response headers 'headers'.  Open the temporary file to
+           hold the body."""
+        xfer.connected = time.time()
+        xfer.validators = (headers.get("ETag"), headers.get("Last-Modified"))
+        gotRange = headers.get("Content-Range")
+        xfer.expectLength = headers.get("Content-Length", "???")
+        encoding = headers.get("Content-Encoding", "identity").lower()
+        if encoding not in ("identity", "gzip", "x-gzip"):
+            raise thandy.DownloadError("Unexpected Content-Encoding %s "
+                                       "from %s" % (encoding, xfer.url))
+        if encoding != "identity" and not (xfer.acceptGzip or xfer.gzipped):
+            raise thandy.DownloadError("Unrequested Content-Encoding %s "
+                                       "from %s" % (encoding, xfer.url))
+        # Hash the file as it arrives, and keep it in memory if it's
+        # small enough, so that we don't need to read it back in
+        # order to check it.
+        if gotRange:
+            if gotRange.startswith("bytes %s-"%xfer.haveLength):
+                logging.info("Resuming download from %s"%xfer.url)
+            else:
+                raise thandy.DownloadError("Got an unexpected range %s"
+                                           %gotRange)
+            if xfer.gzipped:
+                self._replayEncodedFile(xfer)
+                return
+            # Our hash needs to cover the part we already had.  If we
+            # checkpointed it, we don't need to read it all again.
+            xfer.chunks = None
+            xfer.digestObj = self._loadCheckpoint(xfer.haveLength)
+            if xfer.digestObj is None:
+                xfer.digestObj = self._hashTmpFile()
+                logging.info("Rehashed %s bytes of %s", xfer.haveLength,
+                             self._tmpPath)
+            xfer.offset = xfer.haveLength
+            xfer.out = open(self._tmpPath, 'ab')
+        else:
+            self._removeCheckpoint()
+            xfer.digestObj = _newDownloadDigest()
+            xfer.offset = 0
+            xfer.out = open(self._tmpPath, 'wb')
+            if xfer.gzipped:
+                xfer.rawOut = open(self._getEncodedPath(), 'wb')
+            if xfer.gzipped or encoding != "identity":
+                xfer.decoder = _newGzipDecoder()
+        xfer.lastCheckpoint = xfer.offset
+
+    def _replayEncodedFile(self, xfer):
+        """Helper: we're resuming a download of our file's gzipped sibling.
+           We can't save the state of a decompressor, so decompress the
+           part of the gzipped file that we already have into a fresh
+           temporary file, so that xfer can carry on from there."""
+        self._removeCheckpoint()
+        xfer.chunks = None
+        xfer.digestObj = _newDownloadDigest()
+        xfer.decoder = _newGzipDecoder()
+        xfer.offset = xfer.lastCheckpoint = 0
+        xfer.out = open(self._tmpPath, 'wb')
+        f = open(self._getEncodedPath(), 'rb')
+        try:
+            while True:
+                c = f.read(_READ_SIZE)
+                if not c:
+                    break
+                self._decodeData(xfer, c)
+                self._bytesRehashed += len(c)
         finally:
-            if f_in is not None:
-                f_in.close()
-            if f_out is not None:
-                f_out.close()
+            f.close()
+        logging.info("Decompressed %s bytes of %s", xfer.haveLength,
+                     self._getEncodedPath())
+        xfer.rawOut = open(self._getEncodedPath(), 'ab')
+
+    def _gotData(self, xfer, c):
+        """Helper: handle the bytes 'c' from the body of xfer's response,
+           decompressing them if they're gzipped.  Return false if we now
+           have more than we wanted."""
+        xfer.total += len(c)
+        if xfer.rawOut is not None:
+            xfer.rawOut.write(c)
+        if xfer.decoder is not None:
+            ok = self._decodeData(xfer, c)
+        else:
+            ok = self._writeData(xfer, c)
+        logging.debug("Got %s/%s bytes from %s",
+                      xfer.total, xfer.expectLength, xfer.url)
+        logCtrl("DOWNLOAD", TOTAL=str(xfer.total),
+                EXPECT=str(xfer.expectLength), URL=xfer.url)
+        return ok
+
+    def _decodeData(self, xfer, c):
+        """Helper: decompress the bytes 'c' of xfer's gzipped body, and
+           write them out as _writeData does.  We decompress a piece at a
+           time, so that a small body can't make us hold a huge file in
+           memory.  Return false if we now have more than we wanted."""
+        while c:
+            try:
+                data = xfer.decoder.decompress(c, _READ_SIZE)
+            except zlib.error, e:
+                xfer.close()
+                self._removeTmpFile()
+                raise thandy.DownloadError("Bad gzipped data from %s: %s"
+                                           % (xfer.url, e))
+            c = xfer.decoder.unconsumed_tail
+            if data and not self._writeData(xfer, data):
+                return False
+        return True
+
+    def _writeData(self, xfer, c):
+        """Helper: write the bytes 'c' of our file to the temporary file.
+           Return false if we now have more than we wanted."""
+        xfer.out.write(c)
+        xfer.digestObj.update(c)
+        xfer.offset += len(c)
+        if xfer.chunks is not None:
+            xfer.chunks.append(c)
+            if xfer.offset > _MAX_BUFFERED_CHECK:
+                xfer.chunks = None
+        if xfer.offset - xfer.lastCheckpoint >= _CHECKPOINT_INTERVAL:
+            xfer.out.flush()
+            self._saveCheckpoint(xfer.digestObj, xfer.offset)
+            xfer.lastCheckpoint = xfer.offset
+        if self._wantLength != None and xfer.offset > self._wantLength:
+            logging.warn("Read too many bytes from %s; got %s, "
+                         "but wanted %s", xfer.url, xfer.offset,
+                         self._wantLength)
+            return False
+        return True
+
+    def _endBody(self, xfer):
+        """Helper: the server has sent all of xfer's response body that it
+           is going to send."""
+        xfer.finished = time.time()
+        if xfer.decoder is not None:
+            rest = xfer.decoder.flush()
+            if rest:
+                self._writeData(xfer, rest)
+        if self._wantLength != None and xfer.offset < self._wantLength:
+            # The connection closed early; we can resume later.
+            raise httplib.IncompleteRead("", self._wantLength-xfer.offset)
+        if self._wantLength != None and xfer.offset != self._wantLength:
+            logging.warn("Length wrong on file %s", xfer.url)
+
+    def _abortBody(self, xfer):
+        """Helper: xfer failed partway through.  Save what we have, so
+           that we can pick up where we left off next time."""
+        if xfer.out is not None and xfer.offset > xfer.lastCheckpoint:
+            try:
+                xfer.out.flush()
+                self._saveCheckpoint(xfer.digestObj, xfer.offset)
+            except (OSError, IOError):
+                pass
+
+    def _finishDownload(self, xfer):
+        """Helper: we have received all of xfer's body.  Check the
+           temporary file, and move it into place if it's good."""
+        xfer.close()
+        if xfer.chunks is not None:
+            content = "".join(xfer.chunks)
+            xfer.chunks = None
+        else:
+            content = None
 
         try:
-            self._checkTmpFile()
+            self._checkTmpFile(content, xfer.digestObj.digest())
         except (thandy.FormatException, thandy.DownloadError), err:
             self._removeTmpFile()
-            if haveStalled:
+            if xfer.haveLength is not None:
                 raise BadCompoundData(err)
             else:
                 raise
 
-        thandy.util.ensureParentDir(self._destPath)
-        thandy.util.moveFile(self._tmpPath, self._destPath)
+        self._installTmpFile()
+        self._noteValidators(xfer)
+
+    def _download(self):
+        # Implementation function.  Unlike download(), can throw exceptions.
+        xfer = self._prepareDownload()
+        if xfer is None:
+            return
+
+        f_in = None
+        try:
+            try:
+                f_in = getConnection(xfer.url, self._useTor, xfer.haveLength,
+                                     self._connectionPool,
+                                     headers=xfer.getRequestHeaders())
+            except urllib2.HTTPError, err:
+                if self._noteHTTPError(xfer, err.code):
+                    return
+                raise
+
+            logging.info("Connected to %s", xfer.url)
+
+            self._beginBody(xfer, f_in.info())
+            try:
+                while True:
+                    c = f_in.read(_READ_SIZE)
+                    if not c or not self._gotData(xfer, c):
+                        break
+                self._endBody(xfer)
+            except:
+                self._abortBody(xfer)
+                raise
+        finally:
+            if f_in is not None:
+                f_in.close()
+            xfer.close()
+
+        self._finishDownload(xfer)
+
+class _Transfer:
+    """Helper class: one attempt to fetch a DownloadJob's file, as its
+       body arrives."""
+    ## Fields:
+    #   url: the URL we're fetching.
+    #   gzipped: true iff url is for the gzipped sibling of our file.
+    #   haveLength: how many bytes of the file (or of its gzipped sibling,
+    #     if gzipped) we had from an earlier attempt, or None if we're
+    #     starting from scratch.
+    #   expectLength: the Content-Length the server gave us, or "???".
+    #   out: the open temporary file, or None if it isn't open.
+    #   rawOut: if gzipped, the open file where we save the gzipped body
+    #     as it arrives, or None.
+    #   decoder: a zlib decompression object for the body, or None if the
+    #     body isn't compressed.
+    #   digestObj: a hash object for everything in the temporary file.
+    #   chunks: a list of everything in the temporary file, or None if
+    #     we aren't keeping it in memory.
+    #   offset: how long the temporary file is.
+    #   lastCheckpoint: the offset of our last hash checkpoint.
+    #   total: how many bytes of body we've received on this attempt.
+    #   started, connected, finished: when we sent our request, got the
+    #     response headers, and got the whole body; or None if we haven't.
+    #   conditional: headers to send so that the server only sends the
+    #     file if it has changed; or {}.
+    #   acceptGzip: true iff we'll let the server compress the body.
+    #   validators: the (ETag, Last-Modified) headers the server sent with
+    #     the file, either of which may be None; or None if we haven't
+    #     got a response yet.
+    def __init__(self, url, haveLength):
+        self.url = url
+        self.gzipped = False
+        self.haveLength = haveLength
+        self.conditional = {}
+        self.acceptGzip = False
+        self.validators = None
+        self.started = time.time()
+        self.connected = None
+        self.finished = None
+        self.expectLength = "???"
+        self.out = None
+        self.rawOut = None
+        self.decoder = None
+        self.digestObj = None
+        self.chunks = []
+        self.offset = 0
+        self.lastCheckpoint = 0
+        self.total = 0
+
+    def getRequestHeaders(self):
+        """Return the extra HTTP headers to send with our request."""
+        headers = dict(self.conditional)
+        if self.acceptGzip:
+            headers['Accept-Encoding'] = "gzip"
+        return headers
+
+    def close(self):
+        """Close the temporary files, if they're open."""
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        if self.rawOut is not None:
+            self.rawOut.close()
+            self.rawOut = None
 
 
 class SimpleDownloadJob(DownloadJob):
@@ -562,7 +1928,7 @@ class SimpleDownloadJob(DownloadJob):
                  wantLength=None):
         DownloadJob.__init__(self, targetPath, targetPath+".tmp",
                                  wantHash=wantHash,
-                                 wantLength=length,
+                                 wantLength=wantLength,
                                  useTor=useTor)
         self._url = url
 
@@ -597,13 +1963,20 @@ class ThandyDownloadJob(DownloadJob):
        and Thandy's directory structure."""
     def __init__(self, relPath, destPath, mirrorList, wantHash=None,
                  supportedURLTypes=None, useTor=None, repoFile=None,
-                 downloadStatusLog=None, wantLength=None):
+                 downloadStatusLog=None, wantLength=None,
+                 hedge=False, hedgeDelay=None):
+        """As DownloadJob.  If 'hedge', and the file is small, ask a
+           second mirror for it if the first hasn't delivered it within
+           hedgeDelay seconds, or by the time most small downloads are
+           done if hedgeDelay is None."""
 
         DownloadJob.__init__(self, destPath, None, wantHash=wantHash,
                              wantLength=wantLength,
                              useTor=useTor, repoFile=repoFile)
         self._mirrorList = mirrorList
         self._relPath = relPath
+        self._hedge = hedge
+        self._hedgeDelay = hedgeDelay
 
         tmppath = thandy.util.userFilename("tmp")
         if relPath.startswith("/"):
@@ -621,16 +1994,43 @@ class ThandyDownloadJob(DownloadJob):
         self._usingMirror = None #DOCDOC
         self._downloadStatusLog = downloadStatusLog
 
+        # We fetch big files in segments from several mirrors ourselves,
+        # so an event loop can't drive us.
+        if self._getSegmentMirrors() is not None:
+            self._usesTransfers = False
+
     def setDownloadStatusLog(self, log):
         self._downloadStatusLog = log
 
-    def getURL(self):
-        usable = []
+    def _getMirrorURL(self, urlbase):
+        """Return the URL for our file on the mirror at urlbase."""
+        if urlbase[-1] == '/' and self._relPath[0] == '/':
+            return urlbase + self._relPath[1:]
+        else:
+            return urlbase + self._relPath
+
+    def _weighMirrors(self, mirrors):
+        """Helper: return a list of (weight, mirror) for every mirror in
+           'mirrors', favoring the ones that have served us best.  If we
+           already have as many connections as we allow to some of the
+           mirrors, leave those out unless they're all that's left."""
+        mirrors = list(mirrors)
+        pool = self._connectionPool
+        if pool is not None:
+            free = [ m for m in mirrors
+                     if not pool.isBusy(m['urlbase'], self._useTor) ]
+            if free:
+                mirrors = free
+        if self._downloadStatusLog is None:
+            return [ (m['weight'], m) for m in mirrors ]
+        return self._downloadStatusLog.weighMirrors(mirrors,
+                                                    self._wantLength)
 
-        for m in mirrorsThatSupport(self._mirrorList, self._relPath,
-                                    self._supportedURLTypes,
-                                    self._downloadStatusLog):
-            usable.append( (m['weight'], m) )
+    def getURL(self):
+        usable = self._weighMirrors(
+            mirrorsThatSupport(self._mirrorList, self._relPath,
+                               self._supportedURLTypes,
+                               self._downloadStatusLog))
 
         try:
             mirror = thandy.util.randChooseWeighted(usable)
@@ -639,10 +2039,142 @@ class ThandyDownloadJob(DownloadJob):
 
         self._usingMirror = mirror['urlbase']
 
-        if m['urlbase'][-1] == '/' and self._relPath[0] == '/':
-            return m['urlbase'] + self._relPath[1:]
+        return self._getMirrorURL(mirror['urlbase'])
+
+    def getReadyTime(self):
+        if self._downloadStatusLog is None:
+            return 0
+        readyAt = None
+        for m in mirrorsThatSupport(self._mirrorList, self._relPath,
+                                    self._supportedURLTypes):
+            r = self._downloadStatusLog.getDelayTime(m['urlbase'])
+            if readyAt is None or r < readyAt:
+                readyAt = r
+        return readyAt or 0
+
+    def _chooseMirrors(self, n, urlTypes=None):
+        """Helper: return the urlbases of up to n different mirrors that
+           can give us our file, chosen as getURL() would choose one.  If
+           urlTypes is given, only use mirrors with those URL types."""
+        usable = []
+        for w, m in self._weighMirrors(mirrorsThatSupport(
+                self._mirrorList, self._relPath, self._supportedURLTypes,
+                self._downloadStatusLog)):
+            if urlTypes is None or \
+                   urllib2.splittype(m['urlbase'])[0].lower() in urlTypes:
+                usable.append( (w, m['urlbase']) )
+        mirrors = []
+        while usable and len(mirrors) < n:
+            urlbase = thandy.util.randChooseWeighted(usable)
+            mirrors.append(urlbase)
+            usable = [ u for u in usable if u[1] != urlbase ]
+        return mirrors
+
+    def _getSegmentMirrors(self):
+        """Helper: if we should fetch our file in segments from several
+           mirrors at once, return a list of their urlbases.  Otherwise
+           return None."""
+        if self._wantLength is None or \
+               self._wantLength < _MIN_SEGMENTED_LENGTH:
+            return None
+        mirrors = self._chooseMirrors(_MAX_SEGMENT_MIRRORS,
+                                      ["http", "https"])
+        if len(mirrors) < 2:
+            return None
+        return mirrors
+
+    def _getValidators(self):
+        """Helper: return the validators (see
+           DownloadStatusLog.getValidators) for the copy of our file that
+           we have, if we might use them to ask for the file only if it
+           has changed.  Otherwise return None."""
+        if self._wantHash is not None or self._downloadStatusLog is None:
+            # We know exactly which version we want, and it isn't the one
+            # we have.
+            return None
+        v = self._downloadStatusLog.getValidators(self._relPath)
+        if v is None:
+            return None
+        try:
+            if thandy.formats.getFileDigest(self._destPath) != v[3]:
+                return None
+        except (OSError, IOError):
+            return None
+        return v
+
+    def _hasGzipSibling(self):
+        for m in self._mirrorList['mirrors']:
+            if m['urlbase'] != self._usingMirror:
+                continue
+            for c in m.get('compressed', ()):
+                if thandy.formats.rolePathMatches(c, self._relPath):
+                    return True
+        return False
+
+    def _getConditionalHeaders(self):
+        v = self._getValidators()
+        if v is None:
+            return {}
+        urlbase, etag, lastModified, _ = v
+        headers = {}
+        # An ETag only means something to the mirror that sent it.
+        if etag and urlbase == self._usingMirror:
+            headers['If-None-Match'] = etag
+        if lastModified:
+            headers['If-Modified-Since'] = lastModified
+        return headers
+
+    def _noteValidators(self, xfer):
+        if self._downloadStatusLog is None or xfer.validators is None:
+            return
+        etag, lastModified = xfer.validators
+        self._downloadStatusLog.setValidators(
+            self._relPath, self._usingMirror, etag, lastModified,
+            xfer.digestObj.digest())
+
+    def _getHedgeMirrors(self):
+        if not self._hedge or self.haveStalledFile():
+            return None
+        if self._getValidators() is not None:
+            # Asking one mirror whether our copy is current is cheap
+            # enough.
+            return None
+        if self._wantLength is None:
+            # We don't know how long the file is.  Our own metadata is
+            # always small, though.
+            if not self._relPath.startswith("/meta/"):
+                return None
+        elif self._wantLength > _MAX_HEDGED_LENGTH:
+            return None
+        mirrors = self._chooseMirrors(2)
+        if len(mirrors) < 2:
+            return None
+        return mirrors
+
+    def _getHedgeDelay(self):
+        """Helper: return how long to wait for the first mirror before we
+           ask the second one."""
+        if self._hedgeDelay is not None:
+            return self._hedgeDelay
+        t = None
+        if self._downloadStatusLog is not None:
+            t = self._downloadStatusLog.getSmallFileTime(_HEDGE_PERCENTILE)
+        if t is None:
+            return _DEFAULT_HEDGE_DELAY
+        return max(t, _MIN_HEDGE_DELAY)
+
+    def _download(self):
+        segmentMirrors = hedgeMirrors = None
+        if not self.haveStalledFile():
+            segmentMirrors = self._getSegmentMirrors()
+            hedgeMirrors = self._getHedgeMirrors()
+        if segmentMirrors is not None:
+            _SegmentedDownload(self, segmentMirrors).run()
+        elif hedgeMirrors is not None:
+            _ThreadedHedge(self, hedgeMirrors, self._getHedgeDelay()).run()
         else:
-            return m['urlbase'] + self._relPath
+            # Use a single mirror, and resume whatever we already have.
+            DownloadJob._download(self)
 
     def getRelativePath(self):
         return self._relPath
@@ -650,11 +2182,441 @@ class ThandyDownloadJob(DownloadJob):
     def getMirror(self):
         return self._usingMirror
 
+class _Segment:
+    """Helper class: a range of bytes that a _SegmentedDownload still
+       needs."""
+    ## Fields:
+    #   start: the offset of the first byte we still need.
+    #   end: the offset just after the last byte we need.
+    #   mirror: the urlbase of the mirror fetching this segment, or None.
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.mirror = None
+
+class _SegmentedDownload:
+    """Helper class: fetches a ThandyDownloadJob's file from several
+       mirrors at once, with a thread for each mirror.  The file is split
+       into segments, and each mirror takes the next unclaimed segment as
+       it finishes the last one.  Once none are left, a mirror that has
+       run out of work takes over the second half of whatever segment has
+       the most left to fetch, so that a slow mirror can't hold up the
+       end of the download.
+
+       We check the assembled file against the job's hash.  If it's bad,
+       we blame every mirror that sent us part of it.  A mirror that
+       fails while we're fetching a segment goes in the job's
+       DownloadStatusLog right away; the other mirrors finish its work.
+    """
+    ## Fields:
+    #   _job: the ThandyDownloadJob we're fetching for.
+    #   _mirrors: a list of the urlbases we're fetching from.
+    #   _cond: a Condition protecting the fields below, notified whenever
+    #     a segment is finished or given up on.
+    #   _todo: a list of unclaimed _Segments.
+    #   _active: a list of claimed _Segments.
+    #   _served: map from urlbase to how many bytes that mirror sent us.
+    #   _errors: map from urlbase to the exception that made us stop
+    #     using that mirror.
+    def __init__(self, job, mirrors):
+        self._job = job
+        self._mirrors = mirrors
+        self._cond = threading.Condition()
+        length = job._wantLength
+        self._todo = [ _Segment(start, min(start+_SEGMENT_SIZE, length))
+                       for start in xrange(0, length, _SEGMENT_SIZE) ]
+        self._active = []
+        self._served = {}
+        self._errors = {}
+
+    def run(self):
+        """Fetch the whole file, check it, and move it into place.  Raise
+           an exception if we can't."""
+        job = self._job
+        job._bytesRehashed = 0
+        logging.info("Downloading %s in %s segments from %s",
+                     job.getRelativePath(), len(self._todo),
+                     ", ".join(self._mirrors))
+        f = open(job._tmpPath, 'wb')
+        try:
+            f.truncate(job._wantLength)
+        finally:
+            f.close()
+
+        threads = [ threading.Thread(target=self._thread, args=[m])
+                    for m in self._mirrors ]
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+
+        if self._todo or self._active:
+            # Every mirror gave up.
+            job._removeTmpFile()
+            mirror, err = self._errors.items()[0]
+            job._usingMirror = mirror
+            raise err
+
+        served = [ (n, m) for m, n in self._served.items() if n ]
+        served.sort(reverse=True)
+        job._usingMirror = served[0][1]
+        logCtrl("SEGMENTS", RELPATH=job.getRelativePath(),
+                MIRRORS=",".join("%s:%s" % (m, n) for n, m in served))
+
+        try:
+            job._checkTmpFile(None, job._hashTmpFile().digest())
+        except (thandy.FormatException, thandy.DownloadError), err:
+            job._removeTmpFile()
+            if len(served) > 1:
+                raise BadSegmentedData(err, [ m for n, m in served ])
+            raise
+        job._installTmpFile()
+
+    def _nextSegment(self, mirror):
+        """Helper: return the next segment for 'mirror' to fetch, or None
+           if there's nothing left for it to do."""
+        self._cond.acquire()
+        try:
+            while True:
+                if self._todo:
+                    seg = self._todo.pop(0)
+                    break
+                # Take over half of the biggest segment someone else has.
+                biggest = None
+                for s in self._active:
+                    if biggest is None or \
+                           s.end - s.start > biggest.end - biggest.start:
+                        biggest = s
+                if biggest is not None and \
+                       biggest.end - biggest.start >= 2*_MIN_SEGMENT_SPLIT:
+                    mid = biggest.start + (biggest.end - biggest.start) // 2
+                    seg = _Segment(mid, biggest.end)
+                    biggest.end = mid
+                    logging.debug("Taking bytes %s-%s from %s for %s",
+                                  mid, seg.end, biggest.mirror, mirror)
+                    break
+                if not self._active:
+                    return None
+                # Someone else might fail and leave us their segment.
+                self._cond.wait()
+            seg.mirror = mirror
+            self._active.append(seg)
+            return seg
+        finally:
+            self._cond.release()
+
+    def _claim(self, seg, mirror, n):
+        """Helper: we've received 'n' more bytes of 'seg' from 'mirror'.
+           Return the offset where they go and how many of them we still
+           need, now that other mirrors may have taken part of 'seg'."""
+        self._cond.acquire()
+        try:
+            n = max(0, min(n, seg.end - seg.start))
+            offset = seg.start
+            seg.start += n
+            self._served[mirror] = self._served.get(mirror, 0) + n
+            return offset, n
+        finally:
+            self._cond.release()
+
+    def _release(self, seg):
+        """Helper: we're done fetching 'seg', because we got all of it or
+           because we gave up."""
+        self._cond.acquire()
+        try:
+            self._active.remove(seg)
+            if seg.start < seg.end:
+                seg.mirror = None
+                self._todo.append(seg)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _fetch(self, seg, mirror, f_out):
+        """Helper: fetch what's left of 'seg' from 'mirror' into the file
+           f_out."""
+        job = self._job
+        url = job._getMirrorURL(mirror)
+        started = time.time()
+        f_in = getConnection(url, job._useTor, seg.start,
+                             job._connectionPool, rangeEnd=seg.end)
+        connected = time.time()
+        nBytes = 0
+        try:
+            gotRange = f_in.info().get("Content-Range")
+            if not gotRange or \
+                   not gotRange.startswith("bytes %s-" % seg.start):
+                raise thandy.DownloadError("Got an unexpected range %s from %s"
+                                           % (gotRange, url))
+            while seg.start < seg.end:
+                c = f_in.read(_READ_SIZE)
+                if not c:
+                    raise httplib.IncompleteRead("", seg.end - seg.start)
+                offset, n = self._claim(seg, mirror, len(c))
+                f_out.seek(offset)
+                f_out.write(c[:n])
+                nBytes += len(c)
+        finally:
+            f_in.close()
+        log = job._downloadStatusLog
+        if log is not None:
+            log.noteTransfer(mirror, connected - started, nBytes,
+                             time.time() - connected)
+
+    def _thread(self, mirror):
+        # Run in the background for each mirror.
+        f_out = open(self._job._tmpPath, 'r+b')
+        try:
+            while True:
+                seg = self._nextSegment(mirror)
+                if seg is None:
+                    return
+                try:
+                    self._fetch(seg, mirror, f_out)
+                except Exception, err:
+                    self._release(seg)
+                    self._errors[mirror] = err
+                    log = self._job._downloadStatusLog
+                    if log is not None:
+                        log.failed(self._job._getFailure(err, mirror))
+                    return
+                self._release(seg)
+        finally:
+            f_out.close()
+
+class _HedgeCopy:
+    """Helper class: one copy of a file we're fetching from more than one
+       mirror at once for a _Hedge.  We keep it in memory until we know
+       whether it's the one we want.  It has the same _beginBody(),
+       _gotData(), ... interface as a DownloadJob, so that whatever
+       drives a DownloadJob's transfers can drive it too."""
+    ## Fields:
+    #   job: the DownloadJob we're fetching for.
+    #   mirror: the urlbase of the mirror we're fetching from.
+    #   xfer: our _Transfer.
+    #   chunks: a list of the parts of the file we have so far.
+    #   cancelled: true iff we no longer want this copy.
+    def __init__(self, job, mirror):
+        self.job = job
+        self.mirror = mirror
+        self.xfer = _Transfer(job._getMirrorURL(mirror), None)
+        self.chunks = []
+        self.cancelled = False
+        self._useTor = job._useTor
+
+    def getContent(self):
+        return "".join(self.chunks)
+
+    def _noteHTTPError(self, xfer, code):
+        return False
+
+    def _beginBody(self, xfer, headers):
+        xfer.connected = time.time()
+        xfer.expectLength = headers.get("Content-Length", "???")
+
+    def _gotData(self, xfer, c):
+        if self.cancelled:
+            return False
+        self.chunks.append(c)
+        xfer.total += len(c)
+        xfer.offset += len(c)
+        wantLength = self.job._wantLength
+        if wantLength != None and xfer.offset > wantLength:
+            logging.warn("Read too many bytes from %s; got %s, but wanted %s",
+                         xfer.url, xfer.offset, wantLength)
+            return False
+        return True
+
+    def _endBody(self, xfer):
+        xfer.finished = time.time()
+        wantLength = self.job._wantLength
+        if self.cancelled:
+            raise thandy.DownloadError("Cancelled")
+        if wantLength != None and xfer.offset < wantLength:
+            raise httplib.IncompleteRead("", wantLength-xfer.offset)
+
+    def _abortBody(self, xfer):
+        pass
+
+    def _finishDownload(self, xfer):
+        pass
+
+    def _getFailure(self, err):
+        return self.job._getFailure(err, self.mirror)
+
+class _Hedge:
+    """Abstract helper class: fetches a small file for a DownloadJob by
+       asking one mirror, and then asking another too if the first hasn't
+       delivered the file within 'delay' seconds or has failed.  We take
+       the first copy that turns out to be good, and cancel the other.
+       Subclasses say how to run the fetches.
+
+       A mirror that gives us a bad copy, or fails, goes in the job's
+       DownloadStatusLog right away.
+    """
+    ## Fields:
+    #   _job: the DownloadJob we're fetching for.
+    #   _mirrors: the urlbases of the mirrors to ask, in order.
+    #   _delay: how long to give each mirror before we ask the next.
+    #   _copies: a list of the _HedgeCopy we've started.
+    #   _nRunning: how many of them are still running.
+    #   _deadline: when to ask the next mirror.
+    #   winner: the _HedgeCopy we used, or None.
+    #   error: the exception that made our last copy fail, or None.
+    def __init__(self, job, mirrors, delay):
+        self._job = job
+        self._mirrors = mirrors
+        self._delay = delay
+        self._copies = []
+        self._nRunning = 0
+        self._deadline = None
+        self.winner = None
+        self.error = None
+
+    def _launch(self, copy):
+        """Abstract: start fetching 'copy'.  When it's done, call
+           copyDone()."""
+        raise NotImplemented()
+
+    def _cancel(self, copy):
+        """Stop fetching 'copy', which we don't need any more."""
+        copy.cancelled = True
+
+    def _startNext(self):
+        """Helper: start fetching from the next mirror."""
+        copy = _HedgeCopy(self._job, self._mirrors[len(self._copies)])
+        self._copies.append(copy)
+        self._nRunning += 1
+        self._deadline = time.time() + self._delay
+        if len(self._copies) > 1:
+            logging.info("Asking %s for %s too", copy.mirror,
+                         self._job.getRelativePath())
+            logCtrl("HEDGE", RELPATH=self._job.getRelativePath(),
+                    MIRROR=copy.mirror)
+        self._launch(copy)
+
+    def start(self):
+        """Start fetching from the first mirror."""
+        self._startNext()
+
+    def isDone(self):
+        """Return true iff we have a good copy, or have given up."""
+        return self.winner is not None or \
+               (self._nRunning == 0 and len(self._copies) == len(self._mirrors))
+
+    def getDeadline(self):
+        """Return when we will next need checkTimer() to be called, or
+           None if we won't."""
+        if self.isDone() or len(self._copies) == len(self._mirrors):
+            return None
+        return self._deadline
+
+    def checkTimer(self, now):
+        """Ask the next mirror if the last one has had too long."""
+        deadline = self.getDeadline()
+        if deadline is not None and deadline <= now:
+            self._startNext()
+
+    def copyDone(self, copy, err):
+        """Callback: we've finished fetching 'copy', which failed with the
+           exception 'err' unless err is None."""
+        self._nRunning -= 1
+        if self.winner is not None or copy.cancelled:
+            return
+        job = self._job
+        if err is None:
+            try:
+                job._installContent(copy.getContent())
+            except (thandy.FormatException, thandy.DownloadError), e:
+                err = e
+        if err is None:
+            self.winner = copy
+            job._usingMirror = copy.mirror
+            job._lastTransfer = copy.xfer
+            for c in self._copies:
+                if c is not copy and not c.cancelled:
+                    self._cancel(c)
+            return
+
+        self.error = err
+        job._usingMirror = copy.mirror
+        if self._nRunning == 0 and len(self._copies) < len(self._mirrors):
+            # Don't wait for the timer; nobody else is working on it.
+            self._startNext()
+        if not self.isDone():
+            # If this was our last hope, whoever is running the job will
+            # record the failure.  Otherwise, we do it now.
+            log = getattr(job, "_downloadStatusLog", None)
+            if log is not None:
+                log.failed(copy._getFailure(err))
+
+class _ThreadedHedge(_Hedge):
+    """A _Hedge that fetches each copy in its own thread."""
+    ## Fields:
+    #   _cond: a Condition protecting our fields, notified whenever a
+    #     copy is done.
+    def __init__(self, job, mirrors, delay):
+        _Hedge.__init__(self, job, mirrors, delay)
+        self._cond = threading.Condition()
+
+    def run(self):
+        """Fetch the file, and move it into place.  Raise an exception if
+           we can't."""
+        self._cond.acquire()
+        try:
+            self.start()
+            while not self.isDone():
+                deadline = self.getDeadline()
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    self._cond.wait(max(0, deadline - time.time()))
+                self.checkTimer(time.time())
+        finally:
+            self._cond.release()
+        if self.winner is None:
+            raise self.error
+
+    def _launch(self, copy):
+        t = threading.Thread(target=self._thread, args=[copy])
+        t.setDaemon(True)
+        t.start()
+
+    def _thread(self, copy):
+        # Run in the background for each copy.
+        err = None
+        f_in = None
+        try:
+            try:
+                xfer = copy.xfer
+                f_in = getConnection(xfer.url, copy._useTor, None,
+                                     self._job._connectionPool)
+                copy._beginBody(xfer, f_in.info())
+                while True:
+                    c = f_in.read(_READ_SIZE)
+                    if not c or not copy._gotData(xfer, c):
+                        break
+                copy._endBody(xfer)
+            finally:
+                if f_in is not None:
+                    f_in.close()
+        except Exception, e:
+            err = e
+        self._cond.acquire()
+        try:
+            self.copyDone(copy, err)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
 class ThandyBittorrentDownloadJob(DownloadJob):
     """Thandy's subtype of DownloadJob with BitTorrent support. Makes sure the
        file downloaded via BitTorrent is the file we wanted, and moves
        it into the right place.
     """
+    _usesTransfers = False
+
     def __init__(self, metaFile, relPath, destPath, wantHash=None,
                  supportedURLTypes=None, useTor=None, repoFile=None,
                  downloadStatusLog=None, wantLength=None):
@@ -700,18 +2662,270 @@ class ThandyBittorrentDownloadJob(DownloadJob):
 
 _socks_opener = thandy.socksurls.build_socks_opener()
 
-def getConnection(url, useTor, have_length=None):
+# The redirects we follow, and how many of them in a row, as urllib2 does.
+_REDIRECT_CODES = (301, 302, 303, 307)
+_MAX_REDIRECTS = 10
+
+def _getRedirectURL(url, code, headers, nRedirects):
+    """Helper: the server for 'url' answered with the redirect status
+       'code' and the headers 'headers', after we had already followed
+       'nRedirects' redirects.  Return the URL to fetch instead, or raise
+       urllib2.HTTPError if we shouldn't follow it."""
+    location = headers.get("Location") or headers.get("URI")
+    if not location:
+        raise urllib2.HTTPError(url, code, "Redirect with no location",
+                                headers, None)
+    if nRedirects >= _MAX_REDIRECTS:
+        raise urllib2.HTTPError(url, code, "Too many redirects",
+                                headers, None)
+    newURL = urlparse.urljoin(url, location)
+    urltype = urllib2.splittype(newURL)[0]
+    if urltype is None or urltype.lower() not in ("http", "https"):
+        raise urllib2.HTTPError(url, code, "Redirect to %s" % newURL,
+                                headers, None)
+    return newURL
+
+class ConnectionPool:
+    """Keeps HTTP/1.1 connections to mirrors open between requests, so
+       that fetching a lot of small files from one mirror doesn't pay for
+       a new TCP connection each time -- or, over Tor, for a new SOCKS
+       handshake and circuit stream.  Safe to share between threads.
+
+       We hold at most maxPerHost connections to any host at once, and
+       close connections that have been idle for idleTimeout seconds.
+    """
+    ## Fields:
+    #   _cond: a Condition protecting the fields below, notified whenever
+    #     a connection is released.
+    #   _idle: map from host key to a list of (connection, time it went
+    #     idle) for connections we can reuse, most recent last.
+    #   _nOpen: map from host key to the number of open connections,
+    #     idle or in use.
+    #   nCreated, nReused: how many connections we've opened, and how
+    #     many requests went over a connection we already had.
+    def __init__(self, maxPerHost=2, idleTimeout=60):
+        self._maxPerHost = maxPerHost
+        self._idleTimeout = idleTimeout
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._nOpen = {}
+        self.nCreated = 0
+        self.nReused = 0
+
+    @staticmethod
+    def _newConnection(key):
+        """Helper: return a new, unconnected connection object for the
+           host key 'key'."""
+        scheme, host, port, useTor = key
+        if scheme == "https":
+            if useTor:
+                cls = thandy.socksurls.SocksHTTPSConnection
+            else:
+                cls = httplib.HTTPSConnection
+        else:
+            if useTor:
+                cls = thandy.socksurls.SocksHTTPConnection
+            else:
+                cls = httplib.HTTPConnection
+        return cls(host, port)
+
+    def _expireIdle(self, now):
+        """Helper: close every connection that has been idle too long.
+           Caller must hold _cond."""
+        for key, idle in self._idle.items():
+            while idle and idle[0][1] + self._idleTimeout < now:
+                conn, _ = idle.pop(0)
+                conn.close()
+                self._nOpen[key] -= 1
+            if not idle:
+                del self._idle[key]
+
+    def _acquire(self, key):
+        """Helper: return a (connection, reused) tuple for the host key
+           'key', waiting if we already have too many connections open
+           to that host."""
+        self._cond.acquire()
+        try:
+            while True:
+                self._expireIdle(time.time())
+                idle = self._idle.get(key)
+                if idle:
+                    conn, _ = idle.pop()
+                    if not idle:
+                        del self._idle[key]
+                    self.nReused += 1
+                    return conn, True
+                if self._nOpen.get(key, 0) < self._maxPerHost:
+                    self._nOpen[key] = self._nOpen.get(key, 0) + 1
+                    self.nCreated += 1
+                    break
+                self._cond.wait()
+        finally:
+            self._cond.release()
+        return self._newConnection(key), False
+
+    def _release(self, key, conn, reusable):
+        """Helper: we're done with the connection 'conn' to 'key'.  Keep it
+           for later if 'reusable'; otherwise close it."""
+        self._cond.acquire()
+        try:
+            if reusable:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+            else:
+                conn.close()
+                self._nOpen[key] -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    @staticmethod
+    def _getKey(url, useTor):
+        """Helper: return the host key for connections to fetch 'url'."""
+        scheme, rest = urllib2.splittype(url)
+        hostport, path = urllib2.splithost(rest)
+        host, port = urllib2.splitport(hostport)
+        if port is not None:
+            port = int(port)
+        return (scheme.lower(), host, port, bool(useTor)), path
+
+    def isBusy(self, url, useTor):
+        """Return true iff fetching 'url' would have to wait for another
+           request to the same host to finish."""
+        key, _ = self._getKey(url, useTor)
+        self._cond.acquire()
+        try:
+            return (not self._idle.get(key) and
+                    self._nOpen.get(key, 0) >= self._maxPerHost)
+        finally:
+            self._cond.release()
+
+    def claim(self, url, useTor):
+        """Count a connection that we've opened to fetch 'url' some other
+           way than through this pool, so that isBusy() knows about it.
+           Close an idle connection to the same host if we need room for
+           it.  Call unclaim() when it closes."""
+        key, _ = self._getKey(url, useTor)
+        self._cond.acquire()
+        try:
+            idle = self._idle.get(key)
+            if idle and self._nOpen[key] >= self._maxPerHost:
+                conn, _ = idle.pop(0)
+                conn.close()
+                self._nOpen[key] -= 1
+                if not idle:
+                    del self._idle[key]
+            self._nOpen[key] = self._nOpen.get(key, 0) + 1
+        finally:
+            self._cond.release()
+
+    def unclaim(self, url, useTor):
+        """A connection that we told claim() about has closed."""
+        key, _ = self._getKey(url, useTor)
+        self._cond.acquire()
+        try:
+            self._nOpen[key] -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def closeAll(self):
+        """Close every idle connection."""
+        self._cond.acquire()
+        try:
+            self._expireIdle(float("inf"))
+        finally:
+            self._cond.release()
+
+    def open(self, url, useTor, headers):
+        """Send a GET request for the http or https URL 'url' with
+           'headers', over Tor if 'useTor', and return a response object
+           that works like the ones urllib2 returns.  Follow redirects to
+           other http and https URLs.  Raise urllib2.HTTPError if the
+           server gives us an error."""
+        nRedirects = 0
+        while True:
+            key, path = self._getKey(url, useTor)
+            conn, reused = self._acquire(key)
+            try:
+                conn.request("GET", path or "/", headers=headers)
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                self._release(key, conn, False)
+                if reused:
+                    # The server probably closed it while it was idle.
+                    continue
+                raise
+            if resp.status not in _REDIRECT_CODES:
+                break
+            resp.read()
+            self._release(key, conn, not resp.will_close)
+            newURL = _getRedirectURL(url, resp.status, resp.msg, nRedirects)
+            logging.info("Redirected from %s to %s", url, newURL)
+            url = newURL
+            nRedirects += 1
+
+        if resp.status not in (200, 206):
+            body = resp.read()
+            self._release(key, conn, not resp.will_close)
+            raise urllib2.HTTPError(url, resp.status, resp.reason, resp.msg,
+                                    cStringIO.StringIO(body))
+
+        return _PooledResponse(self, key, conn, resp, url)
+
+class _PooledResponse:
+    """A response to a request made over a ConnectionPool connection.  When
+       it's closed, its connection goes back to the pool if we read the
+       whole body; otherwise, the connection is closed."""
+    def __init__(self, pool, key, conn, resp, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+        self._url = url
+        self.code = resp.status
+
+    def info(self):
+        return self._resp.msg
+
+    def geturl(self):
+        return self._url
+
+    def read(self, n=None):
+        if n is None:
+            return self._resp.read()
+        return self._resp.read(n)
+
+    def close(self):
+        if self._conn is None:
+            return
+        reusable = self._resp.isclosed() and not self._resp.will_close
+        self._resp.close()
+        self._pool._release(self._key, self._conn, reusable)
+        self._conn = None
+
+def getConnection(url, useTor, have_length=None, pool=None, rangeEnd=None,
+                  headers=None):
     """Open a connection to 'url'.  We already have received
        have_length bytes of the file we're trying to fetch, so resume
-       if possible.
+       if possible.  If rangeEnd is set, we only want the bytes of the
+       file before offset rangeEnd.  If 'pool' is a ConnectionPool, use
+       it for http and https URLs.  Send any HTTP headers in 'headers'
+       along with our request.
 
     """
-    headers = {}
+    headers = dict(headers or {})
     urltype = urllib2.splittype(url)[0]
     is_http = urltype in ["http", "https"]
 
     if have_length is not None and is_http:
-        headers['Range'] = "bytes=%s-"%have_length
+        if rangeEnd is not None:
+            headers['Range'] = "bytes=%s-%s"%(have_length, rangeEnd-1)
+        else:
+            headers['Range'] = "bytes=%s-"%have_length
+
+    if pool is not None and is_http and (useTor or
+                                         urltype not in urllib.getproxies()):
+        return pool.open(url, useTor, headers)
 
     req = urllib2.Request(url, headers=headers)
 
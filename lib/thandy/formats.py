@@ -7,6 +7,7 @@ import calendar
 import os
 
 import thandy.checkJson
+import thandy.delta
 import thandy.util
 
 json = thandy.util.importJSON()
@@ -17,9 +18,18 @@ class KeyDB:
     """A KeyDB holds public keys, indexed by their key IDs."""
     ## Fields:
     #   _keys: a map from keyid to public key.
+    #   _roleIndex: a map from role name to a _RolePathIndex of the keys
+    #     with that role, or None if we need to rebuild it.
+    #   _roleIndexGeneration: the value of thandy.keys.getRoleGeneration()
+    #     when we built _roleIndex.
+    #   _authorized: bounded cache of (role, path) to the set of key IDs
+    #     allowed to sign it.
     def __init__(self):
         """Create a new empty KeyDB."""
         self._keys = {}
+        self._roleIndex = None
+        self._roleIndexGeneration = None
+        self._authorized = {}
     def addKey(self, k):
         """Insert a thandy.keys.PublicKey object, 'k', into this KeyDB.  If
            we already had this key, retain the old one, but add any roles in
@@ -34,6 +44,25 @@ class KeyDB:
         except KeyError:
             pass
         self._keys[k.getKeyID()] = k
+        self._roleIndex = None
+    def _refreshRoleIndex(self):
+        """Helper: if our keys or any key's roles have changed since we
+           last built _roleIndex, rebuild it and forget the results in
+           _authorized."""
+        gen = thandy.keys.getRoleGeneration()
+        if self._roleIndex is None or self._roleIndexGeneration != gen:
+            index = {}
+            for key in self._keys.itervalues():
+                for r, p in key.getRoles():
+                    index.setdefault(r, _RolePathIndex()).add(p, key)
+            self._roleIndex = index
+            self._roleIndexGeneration = gen
+            self._authorized = {}
+    def _getRoleIndex(self):
+        """Helper: return an up-to-date map from role name to
+           _RolePathIndex."""
+        self._refreshRoleIndex()
+        return self._roleIndex
     def getKey(self, keyid):
         """Return the key whose key ID is 'keyid'.  If there is no such key,
            raise KeyError."""
@@ -41,13 +70,27 @@ class KeyDB:
     def getKeysByRole(self, role, path):
         """Return a list of all keys that have the role 'role' set for files
            in 'path'."""
-        results = []
-        for key in self._keys.itervalues():
-            for r,p in key.getRoles():
-                if r == role:
-                    if rolePathMatches(p, path):
-                        results.append(key)
-        return results
+        try:
+            index = self._getRoleIndex()[role]
+        except KeyError:
+            return []
+        return index.lookup(path)
+
+    def getKeyIDsByRole(self, role, path):
+        """Return a set of the key IDs for all keys that have the role 'role'
+           set for files in 'path'."""
+        # Don't answer from _authorized if the roles have changed since
+        # we filled it in.
+        self._refreshRoleIndex()
+        try:
+            return self._authorized[(role, path)]
+        except KeyError:
+            pass
+        result = frozenset(k.getKeyID() for k in self.getKeysByRole(role, path))
+        if len(self._authorized) >= _MAX_CACHED_ROLE_PATHS:
+            self._authorized.clear()
+        self._authorized[(role, path)] = result
+        return result
 
     def getKeysFuzzy(self, keyid):
         """Return a list of all keys whose key IDs begin with 'keyid'."""
@@ -60,6 +103,125 @@ class KeyDB:
         """Return a new iterator of all the keys in this KeyDB."""
         return self._keys.itervalues()
 
+# How many entries to keep in the caches of role path regexes and
+# authorized keys before we throw them away and start over.
+_MAX_CACHED_ROLE_PATHS = 1024
+
+def _rolePathToRegex(rolePath):
+    """Helper: return a regular expression, without the terminating '$',
+       that matches the paths that the role path pattern 'rolePath'
+       allows.  'rolePath' must already have had duplicate slashes
+       removed."""
+    # escape, then ** becomes .*
+    rolePath = re.escape(rolePath).replace(r'\*\*', r'.*')
+    # * becomes [^/]*
+    return rolePath.replace(r'\*', r'[^/]*')
+
+class _RolePathIndex:
+    """Helper for KeyDB: indexes the path patterns that a set of keys are
+       allowed to sign for a single role.
+
+       Patterns with no wildcards go in a dict, so we can look them up
+       directly.  Wildcard patterns are filed in a trie under their
+       literal prefix (the part before the first '*').  When we look up
+       a path, we walk the trie along the path, and at every node with
+       patterns, a single combined regular expression tells us which of
+       those patterns match the rest of the path.
+    """
+    # Python's re module won't compile expressions with more than 100
+    # groups, so we split up combined matchers with more patterns.
+    _PATTERNS_PER_MATCHER = 90
+
+    def __init__(self):
+        # Map from literal path to list of keys.
+        self._literal = {}
+        # Trie of literal prefixes: each node is a dict from character to
+        # child node, and from None to a _TrieEntry for that prefix.
+        self._trie = {}
+
+    def add(self, rolePath, key):
+        """Note that 'key' may sign files matching 'rolePath'."""
+        rolePath = re.sub(r'/+', '/', rolePath)
+        star = rolePath.find('*')
+        if star < 0:
+            keys = self._literal.setdefault(rolePath, [])
+            if key not in keys:
+                keys.append(key)
+            return
+        node = self._trie
+        for c in rolePath[:star]:
+            node = node.setdefault(c, {})
+        entry = node.get(None)
+        if entry is None:
+            entry = node[None] = _TrieEntry(star)
+        entry.add(_rolePathToRegex(rolePath[star:]), key)
+
+    def lookup(self, path):
+        """Return a list of the keys that may sign 'path'."""
+        result = list(self._literal.get(path, ()))
+        node = self._trie
+        idx = 0
+        while True:
+            entry = node.get(None)
+            if entry is not None:
+                for key in entry.match(path):
+                    if key not in result:
+                        result.append(key)
+            if idx == len(path):
+                break
+            try:
+                node = node[path[idx]]
+            except KeyError:
+                break
+            idx += 1
+        return result
+
+class _TrieEntry:
+    """Helper for _RolePathIndex: holds all the wildcard patterns that
+       share a single literal prefix, and the keys that go with them."""
+    def __init__(self, prefixLen):
+        self._prefixLen = prefixLen
+        # List of (regex for the rest of the path, list of keys).
+        self._patterns = []
+        # List of compiled combined matchers, or None if we need to
+        # build them.
+        self._matchers = None
+
+    def add(self, regex, key):
+        for r, keys in self._patterns:
+            if r == regex:
+                if key not in keys:
+                    keys.append(key)
+                return
+        self._patterns.append((regex, [key]))
+        self._matchers = None
+
+    def _compile(self):
+        """Helper: build our combined matchers.  Each one is a series of
+           optional lookaheads, one per pattern, so that after a single
+           match() call, a pattern's group is set iff it matched."""
+        matchers = []
+        n = _RolePathIndex._PATTERNS_PER_MATCHER
+        for i in xrange(0, len(self._patterns), n):
+            chunk = self._patterns[i:i+n]
+            regex = "".join("(?:(?=(%s$)))?" % r for r, _ in chunk)
+            matchers.append((re.compile(regex), chunk))
+        self._matchers = matchers
+
+    def match(self, path):
+        """Return a list of the keys whose patterns match 'path', which
+           must start with our prefix."""
+        if self._matchers is None:
+            self._compile()
+        rest = path[self._prefixLen:]
+        result = []
+        for matcher, chunk in self._matchers:
+            groups = matcher.match(rest).groups()
+            for g, (_, keys) in zip(groups, chunk):
+                if g is not None:
+                    result.extend(keys)
+        return result
+
 # Internal cache that maps role paths to regex objects that parse them.
 _rolePathCache = {}
 def rolePathMatches(rolePath, path):
@@ -90,12 +252,10 @@ def rolePathMatches(rolePath, path):
         orig = rolePath
         # remove duplicate slashes.
         rolePath = re.sub(r'/+', '/', rolePath)
-        # escape, then ** becomes .*
-        rolePath = re.escape(rolePath).replace(r'\*\*', r'.*')
-        # * becomes [^/]*
-        rolePath = rolePath.replace(r'\*', r'[^/]*')
         # and no extra text is allowed.
-        rolePath += "$"
+        rolePath = _rolePathToRegex(rolePath) + "$"
+        if len(_rolePathCache) >= _MAX_CACHED_ROLE_PATHS:
+            _rolePathCache.clear()
         regex = _rolePathCache[orig] = re.compile(rolePath)
     return regex.match(path) != None
 
@@ -121,11 +281,158 @@ class SignatureStatus:
            signature status over to 'valid.'"""
         return len(self._unrecognized) or len(self._unauthorized)
 
-def checkSignatures(signed, keyDB, role=None, path=None):
+class SignatureCache:
+    """Remembers whether signatures we have checked were valid, so that we
+       don't need to redo the RSA operations for metadata that hasn't
+       changed.  Verdicts are keyed on the key ID, the digest of the
+       signed object, the signature method, and the signature itself.
+
+       We hold at most maxSize verdicts, and throw out the least recently
+       used ones when we fill up, so that a long-running client doesn't
+       keep a verdict for every version of every file it has seen.
+
+       A SignatureCache may be persisted to disk.  Anybody who can write
+       to that file can make us accept bad signatures, so it must live
+       somewhere no more writable than the repository cache itself.
+    """
+    ## Fields:
+    #   _fname: the file we persist ourself to, or None.
+    #   _maxSize: the largest number of verdicts we hold.
+    #   _verdicts: map from (keyid, digest, method, sig) to a
+    #     [last use, True or False] list.
+    #   _clock: counter incremented on every use of a verdict.
+    #   _used: set of the keys in _verdicts that we have looked up or
+    #     added since we were loaded.  We only save these, so that verdicts
+    #     about old metadata go away when a run doesn't use them.
+    #   hits, misses: number of lookups that we could and couldn't answer.
+    def __init__(self, fname=None, maxSize=8192):
+        """Create a new SignatureCache, persisted in 'fname' if provided."""
+        assert maxSize > 0
+        self._fname = fname
+        self._maxSize = maxSize
+        self._verdicts = {}
+        self._clock = 0
+        self._used = set()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._verdicts)
+
+    def load(self):
+        """Read the cache from disk.  A missing or malformed cache file
+           is treated as an empty cache."""
+        if self._fname is None:
+            return
+        try:
+            f = open(self._fname, 'r')
+        except IOError:
+            return
+        try:
+            try:
+                obj = json.load(f)
+                _SIGNATURE_CACHE_SCHEMA.checkMatch(obj)
+            except (ValueError, thandy.FormatException):
+                return
+        finally:
+            f.close()
+        if obj['v'] != 1:
+            return
+        for keyid, digest, method, sig, verdict in obj['verdicts']:
+            k = (keyid, parseHash(digest), method, sig)
+            self._add(k, verdict)
+
+    def save(self):
+        """Write the verdicts we have used to disk, if anything changed."""
+        if self._fname is None or not self._dirty:
+            return
+        verdicts = [ [ k[0], formatHash(k[1]), k[2], k[3],
+                       self._verdicts[k][1] ]
+                     for k in self._used ]
+        thandy.util.ensureParentDir(self._fname)
+        thandy.util.replaceFile(self._fname,
+                                json.dumps({ 'v' : 1, 'verdicts' : verdicts }))
+        self._dirty = False
+
+    def checkSignature(self, key, method, sig, digest):
+        """Return the result of key.checkSignature(method, sig,
+           digest=digest), using a cached verdict if we have one."""
+        k = (key.getKeyID(), digest, method, sig)
+        ent = self._verdicts.get(k)
+        if ent is None:
+            self.misses += 1
+            result = key.checkSignature(method, sig, digest=digest)
+            self._use(k, result)
+        else:
+            self.hits += 1
+            result = ent[1]
+            self._use(k, result)
+        return result
+
+    def getVerdicts(self):
+        """Return a new map from (keyid, digest, method, sig) to every
+           verdict we know, so that another cache can start with them."""
+        return dict((k, ent[1]) for k, ent in self._verdicts.iteritems())
+
+    def addVerdicts(self, verdicts, hits=0, misses=0):
+        """Add the verdicts in 'verdicts', a map like the ones that
+           getVerdicts and takeUsed return, as if we had used them.
+           Another cache made 'hits' and 'misses' lookups to get them;
+           count those as ours."""
+        for k, verdict in verdicts.iteritems():
+            self._use(k, verdict)
+        self.hits += hits
+        self.misses += misses
+
+    def takeUsed(self):
+        """Return a map from (keyid, digest, method, sig) to verdict for
+           every verdict we've looked up or added since we were loaded or
+           since the last call to takeUsed, and forget that we used them."""
+        used = dict((k, self._verdicts[k][1]) for k in self._used)
+        self._used = set()
+        return used
+
+    def _use(self, k, verdict):
+        """Helper: note that we have used the verdict 'verdict' for 'k'."""
+        ent = self._verdicts.get(k)
+        if ent is None or ent[1] != verdict or k not in self._used:
+            self._dirty = True
+        self._add(k, verdict)
+        self._used.add(k)
+
+    def _add(self, k, verdict):
+        """Helper: remember 'verdict' for 'k', as our most recently used
+           verdict."""
+        self._clock += 1
+        self._verdicts[k] = [ self._clock, verdict ]
+        if len(self._verdicts) > self._maxSize:
+            self._evict()
+
+    def _evict(self):
+        """Helper: throw out the least recently used quarter of our
+           verdicts, so that we don't need to sort on every insertion."""
+        keep = self._maxSize - self._maxSize // 4
+        byAge = sorted(self._verdicts.iteritems(), key=lambda kv: kv[1][0])
+        for k, _ in byAge[:len(byAge) - keep]:
+            del self._verdicts[k]
+            if k in self._used:
+                self._used.remove(k)
+                self._dirty = True
+
+def checkSignatures(signed, keyDB, role=None, path=None, digest=None,
+                    sigCache=None, threshold=None):
     """Given an object conformant to SIGNED_SCHEMA and a set of public keys
        in keyDB, verify the signed object is signed.  If 'role' and 'path'
        are provided, verify that the signing key has the correct role to
-       sign this document as stored in 'path'.
+       sign this document as stored in 'path'.  If 'digest' is provided,
+       it must be the digest of the signed part, as returned by getDigest.
+
+       If 'sigCache' is a SignatureCache, use it to avoid rechecking
+       signatures we've seen before.  If 'threshold' is provided, stop
+       checking signatures once we have found that many good ones; the
+       returned status will be valid for that threshold, but won't
+       describe the signatures we skipped.
 
        Returns a SignatureStatus.
     """
@@ -140,11 +447,17 @@ def checkSignatures(signed, keyDB, role=None, path=None):
     signable = signed['signed']
     signatures = signed['signatures']
 
-    d_obj = Crypto.Hash.SHA256.new()
-    getDigest(signable, d_obj)
-    digest = d_obj.digest()
+    if digest is None:
+        digest = getDigest(signable)
+
+    # The set of key IDs allowed to sign this document, if we've looked
+    # it up.
+    authorized = None
 
     for signature in signatures:
+        if threshold is not None and len(goodSigs) >= threshold:
+            break
+
         sig = signature['sig']
         keyid = signature['keyid']
         method = signature['method']
@@ -156,16 +469,18 @@ def checkSignatures(signed, keyDB, role=None, path=None):
             continue
 
         try:
-            result = key.checkSignature(method, sig, digest=digest)
+            if sigCache is not None:
+                result = sigCache.checkSignature(key, method, sig, digest)
+            else:
+                result = key.checkSignature(method, sig, digest=digest)
         except thandy.UnknownMethod:
             continue
 
         if result:
             if role is not None:
-                for r,p in key.getRoles():
-                    if r == role and rolePathMatches(p, path):
-                        break
-                else:
+                if authorized is None:
+                    authorized = keyDB.getKeyIDsByRole(role, path)
+                if keyid not in authorized:
                     tangentialSigs.append(sig)
                     continue
 
@@ -175,55 +490,104 @@ def checkSignatures(signed, keyDB, role=None, path=None):
 
     return SignatureStatus(goodSigs, badSigs, unknownSigs, tangentialSigs)
 
+_CANONICAL_STR_ESCAPE_RE = re.compile(r'(["\\])')
+
 def _canonical_str_encoder(s):
     """Helper for encodeCanonical: encodes a string as the byte sequence
        expected for canonical JSON format.
     """
-    s = '"%s"' % re.sub(r'(["\\])', r'\\\1', s)
+    # Most strings need no escaping at all; don't bother with the regex.
+    if '"' in s or '\\' in s:
+        s = _CANONICAL_STR_ESCAPE_RE.sub(r'\\\1', s)
+    s = '"%s"' % s
     if isinstance(s, unicode):
         return s.encode("utf-8")
     else:
         return s
 
-def _encodeCanonical(obj, outf):
+# How many pieces of output _encodeCanonical accumulates before passing
+# them to outf.
+_CANONICAL_CHUNK_PARTS = 4096
+
+def _encodeCanonical(obj, outf=None):
     # Helper for encodeCanonical.  Older versions of json.encoder don't
     # even let us replace the separators.
+    #
+    # We keep our own stack rather than recursing, and we collect output
+    # in a list that we only hand to outf once it has grown large: when
+    # outf is a digest's update method, many tiny calls are expensive.
+    # If outf is None, return the encoding as a string.
+
+    parts = []
+    append = parts.append
+    strenc = _canonical_str_encoder
+    # One (iterator, closing bracket, is-dict) entry for every list or
+    # dict we're inside.
+    stack = []
+    while True:
+        # Encode 'obj', or start encoding it if it's a nonempty container.
+        if isinstance(obj, basestring):
+            append(strenc(obj))
+        elif obj is True:
+            append("true")
+        elif obj is False:
+            append("false")
+        elif obj is None:
+            append("null")
+        elif isinstance(obj, (int,long)):
+            append(str(obj))
+        elif isinstance(obj, (tuple, list)):
+            if not obj:
+                append("[]")
+            else:
+                append("[")
+                it = iter(obj)
+                stack.append((it, "]", False))
+                obj = it.next()
+                continue
+        elif isinstance(obj, dict):
+            if not obj:
+                append("{}")
+            else:
+                append("{")
+                items = obj.items()
+                items.sort()
+                it = iter(items)
+                stack.append((it, "}", True))
+                k, obj = it.next()
+                append(strenc(k))
+                append(":")
+                continue
+        else:
+            raise thandy.FormatException("I can't encode %r"%obj)
 
-    if isinstance(obj, basestring):
-        outf(_canonical_str_encoder(obj))
-    elif obj is True:
-        outf("true")
-    elif obj is False:
-        outf("false")
-    elif obj is None:
-        outf("null")
-    elif isinstance(obj, (int,long)):
-        outf(str(obj))
-    elif isinstance(obj, (tuple, list)):
-        outf("[")
-        if len(obj):
-            for item in obj[:-1]:
-                _encodeCanonical(item, outf)
-                outf(",")
-            _encodeCanonical(obj[-1], outf)
-        outf("]")
-    elif isinstance(obj, dict):
-        outf("{")
-        if len(obj):
-            items = obj.items()
-            items.sort()
-            for k,v in items[:-1]:
-                outf(_canonical_str_encoder(k))
-                outf(":")
-                _encodeCanonical(v, outf)
-                outf(",")
-            k, v = items[-1]
-            outf(_canonical_str_encoder(k))
-            outf(":")
-            _encodeCanonical(v, outf)
-        outf("}")
-    else:
-        raise thandy.FormatException("I can't encode %r"%obj)
+        # We finished a value.  Move on to the next item in the innermost
+        # unfinished container, closing containers as they run out.
+        while stack:
+            it, close, isDict = stack[-1]
+            try:
+                obj = it.next()
+            except StopIteration:
+                append(close)
+                del stack[-1]
+                continue
+            append(",")
+            if isDict:
+                k, obj = obj
+                append(strenc(k))
+                append(":")
+            break
+        else:
+            break
+
+        if outf is not None and len(parts) >= _CANONICAL_CHUNK_PARTS:
+            outf("".join(parts))
+            del parts[:]
+
+    if outf is None:
+        return "".join(parts)
+    elif parts:
+        outf("".join(parts))
 
 def encodeCanonical(obj, outf=None):
     """Encode the object obj in canoncial JSon form, as specified at
@@ -231,8 +595,8 @@ def encodeCanonical(obj, outf=None):
        dialect of JSON in which keys are always lexically sorted,
        there is no whitespace, floats aren't allowed, and only quote
        and backslash get escaped.  The result is encoded in UTF-8, and
-       the resulting bytes are passed to outf (if provided) in several
-       calls, or joined into a string and returned.
+       the resulting bytes are passed to outf (if provided) in one or
+       more large chunks, or joined into a string and returned.
 
        >>> encodeCanonical("")
        '""'
@@ -254,15 +618,7 @@ def encodeCanonical(obj, outf=None):
        24
     """
 
-    result = None
-    if outf == None:
-        result = [ ]
-        outf = result.append
-
-    _encodeCanonical(obj, outf)
-
-    if result is not None:
-        return "".join(result)
+    return _encodeCanonical(obj, outf)
 
 def getDigest(obj, digestObj=None):
     """Update 'digestObj' (typically a SHA256 object) with the digest of
@@ -319,6 +675,44 @@ def getFileDigest(f, digestObj=None):
     if useTempDigestObj:
         return digestObj.digest()
 
+def decodeAndDigest(content, digestSigned=True):
+    """Parse the JSON document in 'content', and compute the SHA256
+       digest of the canonical encoding of its 'signed' member (or of
+       the whole document, if 'digestSigned' is false).  Return a tuple
+       of the parsed object and the digest; the digest is None if the
+       document has no 'signed' member.
+
+       Raises ValueError if 'content' is not valid JSON, and
+       FormatException if the digested part can't be canonically encoded.
+
+       >>> s = '{"signed": {"b": [1, "x\\\\"y"], "a": null}, "signatures": []}'
+       >>> obj, d = decodeAndDigest(s)
+       >>> obj == json.loads(s)
+       True
+       >>> d == getDigest(obj['signed'])
+       True
+       >>> decodeAndDigest('[1, "two", {}]', False)[1] == getDigest([1,"two",{}])
+       True
+       >>> decodeAndDigest('{"signatures": []}')[1] is None
+       True
+    """
+    # A tokenizer in Python that builds the canonical encoding while it
+    # parses only walks the document once.  That beat json.loads followed
+    # by the old recursive encoder, but the json module's C decoder
+    # followed by the current _encodeCanonical is faster than either: in
+    # one run of thandy.benchmarks, 0.72s against the tokenizer's 1.17s
+    # on the bundle, 0.39s against 0.55s on the keylist, and 0.31s
+    # against 0.34s on the timestamp.  So we parse once and encode once.
+    obj = json.loads(content)
+    if digestSigned:
+        try:
+            digested = obj['signed']
+        except (KeyError, TypeError):
+            return obj, None
+    else:
+        digested = obj
+    return obj, getDigest(digested)
+
 def makeSignable(obj):
     """Return a new JSON object of type 'signed' wrapping 'obj', and containing
        no signatures.
@@ -444,6 +838,12 @@ SIGNED_SCHEMA = S.Obj(
     signed=S.Any(),
     signatures=S.ListOf(SIGNATURE_SCHEMA))
 
+# The on-disk format of a SignatureCache.
+_SIGNATURE_CACHE_SCHEMA = S.Obj(
+    v=S.Int(),
+    verdicts=S.ListOf(S.Struct([KEYID_SCHEMA, HASH_SCHEMA, SIG_METHOD_SCHEMA,
+                                BASE64_SCHEMA, S.Bool()])))
+
 # The name of a role
 ROLENAME_SCHEMA = S.AnyStr()
 
@@ -466,6 +866,7 @@ MIRRORLIST_SCHEMA = S.Obj(
                            urlbase=URL_SCHEMA,
                            contents=S.ListOf(PATH_PATTERN_SCHEMA),
                            weight=S.Int(lo=0),
+                           compressed=S.Opt(S.ListOf(PATH_PATTERN_SCHEMA)),
                            )))
 
 # A timestamp: indicates the lastest versions of all top-level signed objects.
@@ -538,11 +939,30 @@ OBSOLETE_RPM_FORMAT_ITEM_SCHEMA = S.Obj(
 
 ITEM_INFO_SCHEMA = S.AllOf([CHECK_ITEM_SCHEMA, INSTALL_ITEM_SCHEMA])
 
+# A way to build an installable item from an older one:
+# [ FROMPATH, FROMHASH, DELTAPATH, DELTAHASH, DELTALENGTH ]
+DELTA_SCHEMA = S.Struct([RELPATH_SCHEMA, HASH_SCHEMA, RELPATH_SCHEMA,
+                         HASH_SCHEMA, LENGTH_SCHEMA], allowMore=True)
+# Where to find the chunk index for an installable item:
+# [ INDEXPATH, INDEXHASH, INDEXLENGTH ]
+CHUNKS_SCHEMA = S.Struct([RELPATH_SCHEMA, HASH_SCHEMA, LENGTH_SCHEMA],
+                         allowMore=True)
+FETCH_ITEM_SCHEMA = S.Obj(deltas=S.Opt(S.ListOf(DELTA_SCHEMA)),
+                          chunks=S.Opt(CHUNKS_SCHEMA))
+
+# The pieces of an installable item, in order, as [ HASH, LENGTH ].
+CHUNK_INDEX_SCHEMA = S.Obj(
+    _type=S.Str("ChunkIndex"),
+    chunks=S.ListOf(S.Struct([HASH_SCHEMA, LENGTH_SCHEMA], allowMore=True)))
+
 ITEM_SCHEMA = S.Struct([RELPATH_SCHEMA, HASH_SCHEMA],
                        [ITEM_INFO_SCHEMA, LENGTH_SCHEMA],
                        allowMore=True)
 
 def checkPackageFormatConsistency(obj):
+    for f in obj['files']:
+        if len(f) >= 3 and isinstance(f[2], dict):
+            FETCH_ITEM_SCHEMA.checkMatch(f[2])
     format = obj.get('format')
     if format:
         formatSchema = { 'exe' : OBSOLETE_EXE_FORMAT_ITEM_SCHEMA,
@@ -724,10 +1144,62 @@ def readConfigFile(fname, needKeys=(), optKeys=(), preload={}):
 
     return result
 
-def makePackageObj(config_fname, package_fname):
+# Limits on the size of the pieces we split installable items into for
+# chunk stores.  The average size is about 2**CHUNK_AVG_BITS bytes.
+CHUNK_MIN_SIZE = 16*1024
+CHUNK_AVG_BITS = 16
+CHUNK_MAX_SIZE = 256*1024
+
+def getChunkPath(digest):
+    """Return the relative path in a repository of the chunk whose SHA256
+       digest is 'digest'.
+
+       >>> getChunkPath("\\x12\\xab" + "\\0"*30)[:19]
+       '/chunks/12/12ab0000'
+    """
+    h = binascii.b2a_hex(digest)
+    return "/chunks/%s/%s" % (h[:2], h)
+
+def parseChunkPath(relPath):
+    """If 'relPath' is the relative path of a chunk, return the chunk's
+       digest.  Otherwise return None.
+
+       >>> parseChunkPath(getChunkPath("x"*32))
+       'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+       >>> parseChunkPath("/chunks/12/34") is None
+       True
+    """
+    m = re.match(r'/chunks/([0-9a-f]{2})/(\1[0-9a-f]{62})$', relPath)
+    if m is None:
+        return None
+    return binascii.a2b_hex(m.group(2))
+
+def makeChunkIndex(data):
+    """Split the string 'data' into pieces for a chunk store.  Return a
+       2-tuple of a new chunk index object, and a list of (relpath,
+       content) for the pieces.
+    """
+    chunks = []
+    entries = []
+    for offset, length in thandy.delta.splitChunks(
+        data, CHUNK_MIN_SIZE, CHUNK_AVG_BITS, CHUNK_MAX_SIZE):
+        content = data[offset:offset+length]
+        digest = getDigest(content)
+        entries.append([ formatHash(digest), length ])
+        chunks.append((getChunkPath(digest), content))
+    result = { '_type' : "ChunkIndex",
+               'chunks' : entries }
+    CHUNK_INDEX_SCHEMA.checkMatch(result)
+    return result, chunks
+
+def makePackageObj(config_fname, package_fname, deltas=(), chunkIndex=None):
     """Given a description of a thandy package in config_fname, and the
        name of the one file (only one is supported now!) in package_fname,
-       return a new unsigned package object.
+       return a new unsigned package object.  'deltas' is a list of
+       (from_relpath, from_fname, delta_relpath, delta_fname) tuples for
+       delta files that turn older versions of the file into this one.
+       If 'chunkIndex' is set, it is an (index_relpath, index_fname) tuple
+       for the file's chunk index.
     """
     preload = {}
     shortDescs = {}
@@ -815,6 +1287,27 @@ def makePackageObj(config_fname, package_fname):
         extra['item_version'] = r['db_val']
         extra['check_type'] = 'db'
 
+    if deltas:
+        extra['deltas'] = []
+    for fromRelpath, fromFname, deltaRelpath, deltaFname in deltas:
+        f = open(fromFname, 'rb')
+        fromDigest = getFileDigest(f)
+        f.close()
+        f = open(deltaFname, 'rb')
+        deltaDigest = getFileDigest(f)
+        f.close()
+        extra['deltas'].append([ fromRelpath, formatHash(fromDigest),
+                                 deltaRelpath, formatHash(deltaDigest),
+                                 os.stat(deltaFname).st_size ])
+
+    if chunkIndex is not None:
+        indexRelpath, indexFname = chunkIndex
+        f = open(indexFname, 'rb')
+        indexDigest = getFileDigest(f)
+        f.close()
+        extra['chunks'] = [ indexRelpath, formatHash(indexDigest),
+                            os.stat(indexFname).st_size ]
+
     PACKAGE_SCHEMA.checkMatch(result)
 
     return result
@@ -978,11 +1471,12 @@ def makeTimestampObj(mirrorlist_obj, mirrorlist_len,
 class MirrorInfo:
     """A MirrorInfo holds the parsed value of a thandy mirror list's entry
        for a single mirror."""
-    def __init__(self, name, urlbase, contents, weight):
+    def __init__(self, name, urlbase, contents, weight, compressed=None):
         self._name = name
         self._urlbase = urlbase
         self._contents = contents
         self._weight = weight
+        self._compressed = compressed
 
     def canServeFile(self, fname):
         for c in self._contents:
@@ -997,10 +1491,13 @@ class MirrorInfo:
             return "%s/%s" % (self._urlbase, fname)
 
     def format(self):
-        return { 'name' : self._name,
-                 'urlbase' : self._urlbase,
-                 'contents' : self._contents,
-                 'weight' : self._weight }
+        result = { 'name' : self._name,
+                   'urlbase' : self._urlbase,
+                   'contents' : self._contents,
+                   'weight' : self._weight }
+        if self._compressed is not None:
+            result['compressed'] = self._compressed
+        return result
 
 def makeMirrorListObj(mirror_fname):
     """Return a new unsigned mirrorlist object for the mirrors described in
@@ -23,6 +23,14 @@ import thandy.util
 
 json = thandy.util.importJSON()
 
+# Incremented whenever the roles on any key change, so that a KeyDB can
+# tell when its index of roles is out of date.
+_roleGeneration = 0
+
+def getRoleGeneration():
+    """Return a number that changes whenever any key's roles change."""
+    return _roleGeneration
+
 class PublicKey:
     """An abstract base class for public keys.  A public key object
        always implements some kind of public key, and may also contain
@@ -70,12 +78,16 @@ class PublicKey:
            (one of thandy.format.ALL_ROLES) at a given set of relative
            paths.
         """
+        global _roleGeneration
         assert role in thandy.formats.ALL_ROLES
         if (role, path) not in self._roles:
             self._roles.append((role, path))
+            _roleGeneration += 1
     def clearRoles(self):
         """Remove all roles from this key."""
+        global _roleGeneration
         del self._roles[:]
+        _roleGeneration += 1
     def hasRole(self, role, path):
         """Return true iff this key has a role that allows it to sign
            a document of type 'role' at location in the repository 'path'.
@@ -2,6 +2,8 @@
 
 import thandy.formats
 import thandy.util
+import thandy.checkJson
+import thandy.delta
 import thandy.packagesys.PackageSystem
 import thandy.bt_compat
 
@@ -14,8 +16,205 @@ import os
 import time
 import sys
 
+import Crypto.Hash.SHA256
+
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.5 and earlier.
+    multiprocessing = None
+
 MAX_TIMESTAMP_AGE = 3*60*60
 
+S = thandy.checkJson
+_DIGEST_CACHE_SCHEMA = S.Obj(
+    v=S.Int(),
+    files=S.DictOf(S.AnyStr(),
+                   S.Struct([S.Int(lo=0), S.Int(), S.Int(),
+                             thandy.formats.HASH_SCHEMA], allowMore=True)))
+_CHUNKED_FILES_SCHEMA = S.Obj(
+    v=S.Int(),
+    files=S.DictOf(S.AnyStr(), S.AnyStr()))
+del S
+
+def _statKey(st):
+    """Helper: return a (size, mtime_ns, inode) tuple for the os.stat()
+       result 'st'.  If any of these change, we must rehash the file."""
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = long(st.st_mtime * 1000000000)
+    return (long(st.st_size), long(mtime_ns), long(st.st_ino))
+
+class DigestCache:
+    """Remembers the SHA256 digests of installable files in a local
+       repository, so that we do not re-read every cached installer each
+       time we check whether it's up-to-date.
+
+       An entry is only used when the file's size, mtime, and inode
+       all match the values we saw when we hashed it; otherwise we
+       hash the file again and replace the entry.
+    """
+    ## Fields:
+    #   _fname: the file we persist ourself to, or None.
+    #   _entries: map from filename to [size, mtime_ns, inode, digest].
+    #   _dirty: true iff _entries has changed since we last saved.
+    #   hits, misses: how many lookups were answered from the cache, and
+    #     how many required us to hash the file.
+    #   bytesSaved: total length of files we didn't have to read.
+    def __init__(self, fname=None):
+        """Create a new DigestCache, persisted in 'fname' if provided."""
+        self._fname = fname
+        self._entries = {}
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.bytesSaved = 0
+
+    def load(self):
+        """Read the cache from disk.  A missing or malformed cache file
+           is treated as an empty cache."""
+        if self._fname is None:
+            return
+        try:
+            f = open(self._fname, 'r')
+        except IOError:
+            return
+        try:
+            try:
+                obj = json.load(f)
+                _DIGEST_CACHE_SCHEMA.checkMatch(obj)
+            except (ValueError, thandy.FormatException), e:
+                logging.warn("Ignoring corrupt digest cache %s: %s",
+                             self._fname, e)
+                return
+        finally:
+            f.close()
+
+        if obj['v'] != 1:
+            return
+        self._entries = dict((k, [ v[0], v[1], v[2],
+                                   thandy.formats.parseHash(v[3]) ])
+                             for k, v in obj['files'].iteritems())
+
+    def save(self):
+        """Write the cache to disk, if it has changed.  Entries for files
+           that are gone, or that have changed since we hashed them, are
+           dropped first."""
+        if self._fname is None:
+            return
+        self._prune()
+        if not self._dirty:
+            return
+        obj = { 'v' : 1,
+                'files' : dict((k, [ v[0], v[1], v[2],
+                                     thandy.formats.formatHash(v[3]) ])
+                               for k, v in self._entries.iteritems()) }
+        thandy.util.ensureParentDir(self._fname)
+        thandy.util.replaceFile(self._fname, json.dumps(obj))
+        self._dirty = False
+
+    def _prune(self):
+        """Helper: forget the entries for files whose size, mtime, or
+           inode no longer match, including files that are gone."""
+        for fname, ent in self._entries.items():
+            try:
+                key = _statKey(os.stat(fname))
+            except OSError:
+                key = None
+            if key != tuple(ent[:3]):
+                del self._entries[fname]
+                self._dirty = True
+
+    def clear(self):
+        """Forget every digest we know, so that every file gets rehashed."""
+        if self._entries:
+            self._dirty = True
+        self._entries = {}
+
+    def getFileDigest(self, fname):
+        """Return the SHA256 digest of the file 'fname', hashing it only
+           if it has changed since we last did so.  Raises OSError or
+           IOError if the file can't be read."""
+        st = os.stat(fname)
+        key = _statKey(st)
+        ent = self._entries.get(fname)
+        if ent is not None and tuple(ent[:3]) == key:
+            self.hits += 1
+            self.bytesSaved += key[0]
+            return ent[3]
+
+        self.misses += 1
+        digest = thandy.formats.getFileDigest(fname)
+        # Stat again: if the file changed while we were reading it, don't
+        # remember a digest that may not match either version.
+        if _statKey(os.stat(fname)) == key:
+            self._entries[fname] = list(key) + [ digest ]
+            self._dirty = True
+        return digest
+
+class ValidationCache:
+    """Remembers which file contents have already passed validation, so
+       that when we reload a file whose bytes haven't changed, we don't
+       check it against its schemas again.
+
+       Entries are keyed by the SHA256 of the file's bytes, the schema it
+       matched, and whether it was in signed format; each one holds the
+       digest of the file's (signed part of its) content.  We hold at
+       most maxSize entries, and throw out the least recently used ones
+       when we fill up.
+    """
+    ## Fields:
+    #   _maxSize: the largest number of entries we hold.
+    #   _entries: map from (raw digest, schema, signedFormat) to a
+    #     [last use, digest] list.
+    #   _clock: counter incremented on every use of an entry.
+    #   hits, misses: how many lookups found an entry, and how many didn't.
+    def __init__(self, maxSize=4096):
+        """Create a new empty ValidationCache."""
+        assert maxSize > 0
+        self._maxSize = maxSize
+        self._entries = {}
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, rawDigest, schema, signedFormat):
+        """Return the digest of the content whose bytes have SHA256 digest
+           'rawDigest', if that content has already matched 'schema' (in
+           signed format if 'signedFormat').  Otherwise return None."""
+        ent = self._entries.get((rawDigest, schema, signedFormat))
+        if ent is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._clock += 1
+        ent[0] = self._clock
+        return ent[1]
+
+    def add(self, rawDigest, schema, signedFormat, digest):
+        """Note that the content whose bytes have SHA256 digest 'rawDigest',
+           and whose digest is 'digest', has matched 'schema' (in signed
+           format if 'signedFormat')."""
+        self._clock += 1
+        self._entries[(rawDigest, schema, signedFormat)] = [self._clock, digest]
+        if len(self._entries) > self._maxSize:
+            self._evict()
+
+    def clear(self):
+        """Forget every entry."""
+        self._entries.clear()
+
+    def _evict(self):
+        """Helper: throw out the least recently used quarter of our entries,
+           so that we don't need to sort on every insertion."""
+        keep = self._maxSize - self._maxSize // 4
+        byAge = sorted(self._entries.iteritems(), key=lambda kv: kv[1][0])
+        for k, _ in byAge[:len(byAge) - keep]:
+            del self._entries[k]
+
 class RepositoryFile:
     """Represents information about a file stored in our local repository
        cache.  Used to validate and load files.
@@ -48,19 +247,31 @@ class RepositoryFile:
         # file.
         self._signed_obj = None
 
+        # The digest of the canonical encoding of _main_obj, or None if
+        # we haven't loaded the file.
+        self._digest = None
+
         # A SignatureStatus object, if we have checked signatures.
         self._sigStatus = None
+        # The repository's key version when we computed _sigStatus.
+        self._sigStatusKeys = None
         # The mtime of the file on disk, if we know it.
         self._mtime = None
+        # The (size, mtime_ns, inode) of the file on disk when we loaded
+        # it, as returned by _statKey.  None if we haven't loaded it.
+        self._stat = None
 
     def clear(self):
         """Clear all cached fields loaded from disk; the next time we need one,
            we'll reload the file entirely.
         """
         self._main_obj = self._signed_obj = None
+        self._digest = None
         self._sigStatus = None
+        self._sigStatusKeys = None
         self._mtime = None
         self._length = None
+        self._stat = None
 
     def getRelativePath(self):
         """Return the filename for this item relative to the top of the
@@ -71,39 +282,72 @@ class RepositoryFile:
         """Return the actual filename for this item."""
         return self._repository.getFilename(self._relativePath)
 
-    def _load(self):
-        """Helper: load and parse this item's contents."""
+    def _load(self, knownDigest=None):
+        """Helper: load and parse this item's contents.  If 'knownDigest' is
+           a (raw digest, digest) tuple, and the SHA256 of the file's bytes
+           is the raw digest, trust that the content's digest is the
+           second element instead of computing it."""
         fname = self.getPath()
 
         # Propagate OSError
         f = None
         fd = os.open(fname, os.O_RDONLY)
         try:
-            self._length = os.fstat(fd).st_size
+            st = os.fstat(fd)
             f = os.fdopen(fd, 'r')
         except:
             os.close(fd)
             raise
         try:
-            mtime = os.fstat(fd).st_mtime
             content = f.read()
         finally:
             f.close()
 
-        signed_obj,main_obj = self._checkContent(content)
+        rawDigest = thandy.formats.getDigest(content)
+        if knownDigest is not None and rawDigest == knownDigest[0]:
+            signed_obj,main_obj,digest = self._checkContent(
+                content, knownDigest[1], rawDigest)
+        else:
+            signed_obj,main_obj,digest = self._checkContent(content,
+                                                            rawDigest=rawDigest)
 
         self._signed_obj = signed_obj
         self._main_obj = main_obj
-        self._mtime = mtime
+        self._digest = digest
+        self._length = st.st_size
+        self._mtime = st.st_mtime
+        self._stat = _statKey(st)
 
-    def _checkContent(self, content):
+    def _checkContent(self, content, digest=None, rawDigest=None):
         """Helper.  Check whether 'content' matches SIGNED_SCHEMA, and
            self._schema (as appropraite).  Return a tuple of the
-           signed_schema match, and the schema match, or raise
-           FormatException."""
+           signed_schema match, the schema match, and the digest of the
+           schema match, or raise FormatException.  If 'digest' is
+           provided, don't recompute the digest.  If 'rawDigest' is
+           provided, it is the SHA256 of 'content'.
+
+           If byte-identical content has already passed these checks, we
+           skip them."""
+        cache = self._repository._validationCache
+        if rawDigest is None:
+            rawDigest = thandy.formats.getDigest(content)
+        knownDigest = cache.get(rawDigest, self._schema, self._signedFormat)
+        if knownDigest is not None:
+            try:
+                obj = json.loads(content)
+            except ValueError, e:
+                raise thandy.FormatException("Couldn't decode content: %s"%e)
+            if self._signedFormat:
+                return obj, obj['signed'], knownDigest
+            else:
+                return None, obj, knownDigest
 
         try:
-            obj = json.loads(content)
+            if digest is None:
+                obj, digest = thandy.formats.decodeAndDigest(
+                    content, self._signedFormat)
+            else:
+                obj = json.loads(content)
         except ValueError, e:
             raise thandy.FormatException("Couldn't decode content: %s"%e)
 
@@ -120,27 +364,60 @@ class RepositoryFile:
         if self._schema != None:
             self._schema.checkMatch(main_obj)
 
-        return signed_obj, main_obj
+        if digest is not None:
+            cache.add(rawDigest, self._schema, self._signedFormat, digest)
 
-    def checkFile(self, fname, needhash=None):
-        """DOCDOC"""
-        f = open(fname, 'r')
-        try:
-            s = f.read()
-        finally:
-            f.close()
+        return signed_obj, main_obj, digest
 
-        signed, main = self._checkContent(s)
+    def checkFile(self, fname, needhash=None, content=None, rawDigest=None):
+        """Check whether the file 'fname' is a well-formed version of this
+           item, whose digest is 'needhash' (if provided).  Raise
+           FormatException if it isn't.  If the caller already has the
+           file's contents in 'content', or their SHA256 in 'rawDigest',
+           we use those instead of reading the file."""
+        if content is None:
+            f = open(fname, 'r')
+            try:
+                content = f.read()
+            finally:
+                f.close()
+
+        signed, main, d = self._checkContent(content, rawDigest=rawDigest)
         if needhash:
-            d = thandy.formats.getDigest(main)
             if d != needhash:
                 raise thandy.FormatException("Content didn't match needed "
                                              "hash.")
 
     def load(self):
-        """Load this object from disk if it hasn't already been loaded."""
-        if self._main_obj == None:
-            self._load()
+        """Load this object from disk if it hasn't already been loaded, or
+           if the file's size, mtime, or inode have changed since we
+           loaded it.  Raise OSError if the file can't be read."""
+        if self._main_obj != None:
+            if self.isFresh():
+                return
+            self.clear()
+        self._load()
+
+    def isFresh(self):
+        """Return true iff this object is loaded, and the file on disk
+           seems not to have changed since we loaded it."""
+        if self._stat is None:
+            return False
+        try:
+            return _statKey(os.stat(self.getPath())) == self._stat
+        except OSError:
+            return False
+
+    def _loadVerified(self, rawDigest, digest, sigStatus):
+        """Helper: load this object from disk, using the digest and
+           SignatureStatus that a verification worker computed for a file
+           whose bytes had the SHA256 digest 'rawDigest'.  If the file
+           has changed since, we ignore them."""
+        self.clear()
+        self._load((rawDigest, digest))
+        if self._digest == digest:
+            self._sigStatus = sigStatus
+            self._sigStatusKeys = self._repository._keyDBVersion
 
     def get(self):
         """Return the object, or None if it isn't loaded."""
@@ -155,23 +432,126 @@ class RepositoryFile:
         self.load()
         return self._main_obj
 
+    def getDigest(self):
+        """Load this object as needed and return the digest of its
+           content, as computed by thandy.formats.getDigest."""
+        self.load()
+        return self._digest
+
     def _checkSignatures(self):
         """Helper: Try to verify all the signatures on this object, and
            cache the SignatureStatus object."""
         self.load()
         sigStatus = thandy.formats.checkSignatures(self._signed_obj,
                                      self._repository._keyDB,
-                                     self._needRole, self._relativePath)
+                                     self._needRole, self._relativePath,
+                                     digest=self._digest,
+                                     sigCache=self._repository._sigCache,
+                                     threshold=self._needSigs)
         self._sigStatus = sigStatus
+        self._sigStatusKeys = self._repository._keyDBVersion
 
     def checkSignatures(self):
         """Try to verify all the signatures on this object if we
-           haven't already done so, and return a SignatureStatus
+           haven't already done so since it was loaded and since the
+           repository's keys last changed, and return a SignatureStatus
            object."""
-        if self._sigStatus is None:
+        self.load()
+        if (self._sigStatus is None or
+            self._sigStatusKeys != self._repository._keyDBVersion):
             self._checkSignatures()
         return self._sigStatus
 
+# The KeyDB and SignatureCache that a verification worker process uses.
+_workerKeyDB = None
+_workerSigCache = None
+
+def _initVerifyWorker(keylist, verdicts):
+    """Set up a verification worker process: build a KeyDB from the master
+       keys and the keylist object 'keylist', and a SignatureCache holding
+       the signature verdicts in 'verdicts'."""
+    global _workerKeyDB, _workerSigCache
+    _workerKeyDB = thandy.util.getKeylist(None)
+    _workerKeyDB.addFromKeylist(keylist)
+    _workerSigCache = thandy.formats.SignatureCache()
+    _workerSigCache.addVerdicts(verdicts)
+    _workerSigCache.takeUsed()
+
+def _verifyInWorker(item):
+    """Run in a verification worker process.  Given a (relative path,
+       filename, role, needed signatures) tuple, parse the file and check
+       its signatures.  Return a tuple of the relative path, the SHA256
+       of the file's bytes, the digest of its signed part, a
+       SignatureStatus, and a (verdicts, hits, misses) tuple saying what
+       we got from our SignatureCache.  If we couldn't read or parse the
+       file, the digests and the SignatureStatus are None."""
+    relPath, fname, role, needSigs = item
+    cache = _workerSigCache
+    hits, misses = cache.hits, cache.misses
+    try:
+        f = open(fname, 'rb')
+        try:
+            content = f.read()
+        finally:
+            f.close()
+        obj, digest = thandy.formats.decodeAndDigest(content)
+        ss = thandy.formats.checkSignatures(obj, _workerKeyDB, role, relPath,
+                                            digest=digest, sigCache=cache,
+                                            threshold=needSigs)
+    except (IOError, OSError, ValueError, thandy.FormatException):
+        rawDigest = digest = ss = None
+    else:
+        rawDigest = thandy.formats.getDigest(content)
+    cacheUse = (cache.takeUsed(), cache.hits - hits, cache.misses - misses)
+    return relPath, rawDigest, digest, ss, cacheUse
+
+class _PlanNode:
+    """Helper for LocalRepository.getFilesToUpdate: records what we decided
+       about a single bundle or package file, along with everything that
+       decision depended on.  While none of those change, the next call
+       can reuse the decision without loading or checking the file, or
+       looking at what it lists."""
+    ## Fields:
+    #   relPath: the relative path of the file.
+    #   expected: the digest that the file was supposed to have.
+    #   keyVersion: the repository's key version when we checked it.
+    #   stat: the _statKey of the file as we loaded it, or None if it
+    #     was missing.
+    #   need: true iff we must fetch the file.
+    #   reason: if 'need', a message saying why.
+    #   valid: true iff the file is present, correct, and well-signed.
+    #   obj: if 'valid', the content of the file.
+    #   children: if 'valid', a list of (relative path, digest, length)
+    #     tuples for the files that this one lists.
+    def __init__(self, relPath, expected, keyVersion):
+        self.relPath = relPath
+        self.expected = expected
+        self.keyVersion = keyVersion
+        self.stat = None
+        self.need = False
+        self.reason = None
+        self.valid = False
+        self.obj = None
+        self.children = None
+
+    def setNeed(self, reason):
+        """Note that we must fetch this file, and log why."""
+        logging.info("%s", reason)
+        self.need = True
+        self.reason = reason
+
+    def isCurrent(self, expected, keyVersion, fname):
+        """Return true iff this node is still correct for a file on disk at
+           'fname' that should have the digest 'expected', given that
+           our keys have version 'keyVersion'."""
+        if expected != self.expected or keyVersion != self.keyVersion:
+            return False
+        try:
+            st = _statKey(os.stat(fname))
+        except OSError:
+            st = None
+        return st == self.stat
+
 class PkgFile:
     """DOCDOC"""
     def __init__(self, repository, relativePath, needHash):
@@ -203,21 +583,68 @@ class PkgFile:
         """DOCDOC"""
         return self._needHash
 
-    def checkFile(self, fname, needHash=None):
-        """DOCDOC"""
+    def checkFile(self, fname, needHash=None, content=None, rawDigest=None):
+        """Raise FormatException unless the file 'fname' has the SHA256
+           digest 'needHash' (if provided).  If the caller already knows
+           the file's SHA256, it can pass it as 'rawDigest'; if it has
+           the file's contents, it can pass them as 'content'."""
         if needHash:
-            if thandy.formats.getFileDigest(fname) != needHash:
-                raise thandy.FormatException("Digest for %s not as expected.", fname)
+            if rawDigest is None:
+                if content is not None:
+                    rawDigest = thandy.formats.getDigest(content)
+                else:
+                    rawDigest = thandy.formats.getFileDigest(fname)
+            if rawDigest != needHash:
+                raise thandy.FormatException("Digest for %s not as expected."
+                                             % fname)
 
 class LocalRepository:
     """Represents a client's partial copy of a remote mirrored repository."""
-    def __init__(self, root):
-        """Create a new local repository that stores its files under 'root'"""
+    def __init__(self, root, persistSignatureCache=False, verifyWorkers=0,
+                 useChunkStore=False):
+        """Create a new local repository that stores its files under 'root'.
+           If 'persistSignatureCache', remember which signatures we have
+           verified across runs, in a file under 'root'.  If 'verifyWorkers'
+           is more than 1, check bundles and packages in that many worker
+           processes.  If 'useChunkStore', build installable files from
+           the chunks we keep under 'root', when their packages let us."""
         # Top of our mirror.
         self._root = root
 
+        # True iff we fetch the pieces of installable files into a chunk
+        # store, and build the files from them.
+        self._useChunkStore = useChunkStore
+
+        # How many processes to use when verifying bundles and packages.
+        self._verifyWorkers = verifyWorkers
+        # A multiprocessing.Pool of verification workers, or None if we
+        # haven't started one.
+        self._verifyPool = None
+        # The keylist digest that _verifyPool's workers were set up with.
+        self._verifyPoolKeylist = None
+
+        # Digests of the installable files we have checked before.
+        self._digestCache = DigestCache(
+            os.path.join(root, ".thandy-digests.json"))
+        self._digestCache.load()
+
+        # File contents that have already passed validation.
+        self._validationCache = ValidationCache()
+
+        # Results of the signature checks we have done before.
+        if persistSignatureCache:
+            self._sigCache = thandy.formats.SignatureCache(
+                os.path.join(root, ".thandy-signatures.json"))
+            self._sigCache.load()
+        else:
+            self._sigCache = thandy.formats.SignatureCache()
+
         # A base keylist of master keys; we'll add others later.
         self._keyDB = thandy.util.getKeylist(None)
+        # The digest of the keylist whose keys we last added to _keyDB,
+        # and a counter that we increment whenever we add a new one.
+        self._keyDBKeylist = None
+        self._keyDBVersion = 0
 
         # Entries for the three invariant metafiles.
         self._keylistFile = RepositoryFile(
@@ -240,12 +667,110 @@ class LocalRepository:
         # Map from relative path to a RepositoryFile for bundles.
         self._bundleFiles = {}
 
+        # A (digest, TimestampFile) tuple for the last timestamp file we
+        # parsed, or None.
+        self._parsedTimestamp = None
+
+        # Map from the relative path of each bundle and package file we
+        # looked at in the last getFilesToUpdate call to a _PlanNode
+        # saying what we decided about it.
+        self._planNodes = {}
+        # How many _PlanNodes we evaluated and reused in the last
+        # getFilesToUpdate call.
+        self._nPlanEvaluated = self._nPlanReused = 0
+
+        # Relative paths of the deltas that didn't give us the installable
+        # files they should have.  We fetch those files whole instead.
+        self._failedDeltas = set()
+        # Relative paths of the chunk indices that didn't give us the
+        # installable files they should have.
+        self._failedChunkIndices = set()
+        # Map from the relative path of each installable file we built
+        # from our chunk store to the relative path of its chunk index.
+        # Once no package we track lists the file, we throw both away,
+        # along with any chunks that no other index uses.
+        self._chunkedFiles = {}
+        if useChunkStore:
+            self._loadChunkedFiles()
+
+    def _getChunkedFilesFilename(self):
+        """Return the file where we remember which installable files we
+           built from chunks."""
+        return os.path.join(self._root, ".thandy-chunked.json")
+
+    def _loadChunkedFiles(self):
+        """Helper: set _chunkedFiles from disk.  A missing or malformed
+           file means we built nothing from chunks."""
+        fname = self._getChunkedFilesFilename()
+        try:
+            f = open(fname, 'r')
+        except IOError:
+            return
+        try:
+            try:
+                obj = json.load(f)
+                _CHUNKED_FILES_SCHEMA.checkMatch(obj)
+            except (ValueError, thandy.FormatException), e:
+                logging.warn("Ignoring corrupt list of chunked files %s: %s",
+                             fname, e)
+                return
+        finally:
+            f.close()
+        if obj['v'] == 1:
+            self._chunkedFiles = obj['files']
+
+    def _saveChunkedFiles(self):
+        """Helper: write _chunkedFiles to disk."""
+        obj = { 'v' : 1, 'files' : self._chunkedFiles }
+        try:
+            thandy.util.replaceFile(self._getChunkedFilesFilename(),
+                                    json.dumps(obj))
+        except (OSError, IOError), e:
+            logging.warn("Couldn't save list of chunked files: %s", e)
+
     def getFilename(self, relativePath):
         """Return the file on disk that caches 'relativePath'."""
         if relativePath.startswith("/"):
             relativePath = relativePath[1:]
         return os.path.join(self._root, relativePath)
 
+    def getQuarantineFilename(self, relativePath):
+        """Return the file on disk where we keep a prefetched copy of
+           'relativePath' until we know whether to trust it."""
+        if relativePath.startswith("/"):
+            relativePath = relativePath[1:]
+        return os.path.join(self._root, ".thandy-quarantine", relativePath)
+
+    def getDigestCache(self):
+        """Return the DigestCache we use for installable files."""
+        return self._digestCache
+
+    def getValidationCache(self):
+        """Return the ValidationCache we use when loading files."""
+        return self._validationCache
+
+    def getSignatureCache(self):
+        """Return the SignatureCache we use when checking signatures."""
+        return self._sigCache
+
+    def saveCaches(self):
+        """Save our digest and signature caches to disk, if they are
+           persistent and have changed."""
+        for cache in (self._digestCache, self._sigCache):
+            try:
+                cache.save()
+            except (OSError, IOError), e:
+                logging.warn("Couldn't save cache: %s", e)
+
+    def close(self):
+        """Stop any worker processes we started to verify files.  We start
+           new ones if we need them again."""
+        if self._verifyPool is not None:
+            self._verifyPool.terminate()
+            self._verifyPool.join()
+            self._verifyPool = None
+            self._verifyPoolKeylist = None
+
     def getKeylistFile(self):
         """Return a RepositoryFile for our keylist."""
         return self._keylistFile
@@ -280,8 +805,62 @@ class LocalRepository:
                 needRole='bundle')
             return pkg
 
+    def _getVerifyPool(self):
+        """Helper: return a multiprocessing.Pool whose workers know the keys
+           in our current keylist, or None if we aren't using one."""
+        if self._verifyWorkers <= 1 or multiprocessing is None:
+            return None
+        h = self._keylistFile.getDigest()
+        if self._verifyPoolKeylist != h:
+            self.close()
+        if self._verifyPool is None:
+            # The workers start with the verdicts we know now; we add the
+            # ones they find to our own cache as they report them.
+            self._verifyPool = multiprocessing.Pool(
+                self._verifyWorkers, _initVerifyWorker,
+                (self._keylistFile.get(), self._sigCache.getVerdicts()))
+            self._verifyPoolKeylist = h
+        return self._verifyPool
+
+    def _verifyInParallel(self, files):
+        """Helper: given a list of RepositoryFile objects, parse and check
+           the signatures on the ones we haven't loaded yet using our
+           worker processes, if we have any.  The files are left loaded
+           and checked, exactly as if we had called load() and
+           checkSignatures() on them."""
+        todo = [ f for f in files if not f.isLoaded() ]
+        if len(todo) < 2:
+            return
+        pool = self._getVerifyPool()
+        if pool is None:
+            return
+
+        byPath = dict((f.getRelativePath(), f) for f in todo)
+        items = [ (f.getRelativePath(), f.getPath(), f._needRole, f._needSigs)
+                  for f in todo ]
+        try:
+            results = pool.map(_verifyInWorker, items)
+        except Exception, e:
+            logging.warn("Parallel verification failed (%s); checking files "
+                         "one at a time.", e)
+            self.close()
+            return
+
+        for rp, rawDigest, digest, sigStatus, cacheUse in results:
+            self._sigCache.addVerdicts(*cacheUse)
+            if digest is None:
+                # Let the serial code notice and report the problem.
+                continue
+            try:
+                byPath[rp]._loadVerified(rawDigest, digest, sigStatus)
+            except (OSError, thandy.FormatException):
+                byPath[rp].clear()
+
     def getRequestedFile(self, relPath):
         """DOCDOC"""
+        digest = thandy.formats.parseChunkPath(relPath)
+        if digest is not None:
+            return PkgFile(self, relPath, digest)
         for f in self._metaFiles:
             if f.getRelativePath() == relPath:
                 return f
@@ -297,11 +876,468 @@ class LocalRepository:
                     rp, h = item[:2]
                     if rp == relPath:
                         return PkgFile(self, rp, thandy.formats.parseHash(h))
+                    if len(item) > 2 and isinstance(item[2], dict):
+                        for d in item[2].get('deltas', ()):
+                            if d[2] == relPath:
+                                return PkgFile(self, d[2],
+                                               thandy.formats.parseHash(d[3]))
+                        c = item[2].get('chunks')
+                        if c and c[0] == relPath:
+                            return PkgFile(self, c[0],
+                                           thandy.formats.parseHash(c[1]))
             except:
                 return None
 
         return None
 
+    def _readUnchecked(self, fname):
+        """Helper: return a tuple of the parsed contents of the metadata
+           file 'fname' and the digest of its signed part, without checking
+           anything else about it.  Return (None, None) if we can't."""
+        try:
+            f = open(fname, 'rb')
+            try:
+                content = f.read()
+            finally:
+                f.close()
+            return thandy.formats.decodeAndDigest(content)
+        except (IOError, OSError, ValueError, thandy.FormatException):
+            return None, None
+
+    def _promoteQuarantined(self, rp, h_expected):
+        """Helper for _planFile: if we prefetched 'rp' into quarantine, and
+           the copy there has the digest 'h_expected' that a checked file
+           lists for it, move it into our cache.  Otherwise throw the
+           copy away."""
+        qname = self.getQuarantineFilename(rp)
+        if not os.path.exists(qname):
+            return
+        _, digest = self._readUnchecked(qname)
+        if digest == h_expected:
+            logging.info("Using prefetched copy of %s.", rp)
+            logCtrl("PROMOTE", FILENAME=rp)
+            fname = self.getFilename(rp)
+            try:
+                thandy.util.ensureParentDir(fname)
+                thandy.util.moveFile(qname, fname)
+            except OSError, e:
+                logging.warn("Couldn't use prefetched copy of %s: %s", rp, e)
+        else:
+            logging.info("Prefetched copy of %s is not the one we need; "
+                         "discarding it.", rp)
+            try:
+                os.unlink(qname)
+            except OSError, e:
+                logging.warn("Couldn't discard prefetched copy of %s: %s",
+                             rp, e)
+
+    def _planFile(self, rfile, h_expected, kind):
+        """Helper for _planBundle and _planPackage: return a _PlanNode for
+           the RepositoryFile 'rfile', which should have the digest
+           'h_expected'.  Reuse the one from our last plan if nothing it
+           depends on has changed.  'kind' names the file's type in log
+           messages."""
+        rp = rfile.getRelativePath()
+        node = self._planNodes.get(rp)
+        if node is None or not node.valid:
+            self._promoteQuarantined(rp, h_expected)
+        if node is not None and node.isCurrent(h_expected, self._keyDBVersion,
+                                               rfile.getPath()):
+            self._nPlanReused += 1
+            if node.need:
+                logging.info("%s", node.reason)
+            return node
+
+        self._nPlanEvaluated += 1
+        node = _PlanNode(rp, h_expected, self._keyDBVersion)
+        try:
+            rfile.load()
+        except OSError:
+            node.setNeed("Can't find %s %s on disk; must fetch." % (kind, rp))
+            return node
+        node.stat = rfile._stat
+
+        if rfile.getDigest() != h_expected:
+            node.setNeed("Hash for %s %s not as expected; must fetch." %
+                         (kind, rp))
+            return node
+
+        if not rfile.checkSignatures().isValid():
+            # Can't actually use it.
+            logging.warn("Hash for %s %s was as expected, but signatures did "
+                         "not match.", kind, rp)
+            return node
+
+        node.valid = True
+        node.obj = rfile.get()
+        return node
+
+    def _planBundle(self, rp, h_expected):
+        """Helper for getFilesToUpdate: return a _PlanNode for the bundle
+           at 'rp', which should have the digest 'h_expected'.  If it's
+           valid, its children are the packages it lists."""
+        node = self._planFile(self.getBundleFile(rp), h_expected, "bundle")
+        if node.valid and node.children is None:
+            node.children = [ (p['path'], thandy.formats.parseHash(p['hash']),
+                               p.get('length'))
+                              for p in node.obj['packages'] ]
+        return node
+
+    def _planPackage(self, rp, h_expected):
+        """Helper for getFilesToUpdate: return a _PlanNode for the package
+           at 'rp', which should have the digest 'h_expected'.  If it's
+           valid, its children are its installable files."""
+        node = self._planFile(self.getPackageFile(rp), h_expected, "package")
+        if node.valid and node.children is None:
+            children = []
+            for f in node.obj['files']:
+                length = None
+                if len(f) > 3:
+                    length = f[3]
+                children.append((f[0], thandy.formats.parseHash(f[1]), length))
+            node.children = children
+        return node
+
+    def _applyDelta(self, rp, h_expected, fromPath, deltaPath):
+        """Helper for _planDelta: build the installable file 'rp' by
+           applying the delta we have at 'deltaPath' to our file at
+           'fromPath'.  Return true iff the result has the digest
+           'h_expected'.  Either way, we're done with the delta."""
+        fname = self.getFilename(rp)
+        tmpName = fname + ".thandy-delta"
+        dname = self.getFilename(deltaPath)
+        ok = False
+        files = []
+        try:
+            try:
+                for name, mode in ((self.getFilename(fromPath), 'rb'),
+                                   (dname, 'rb'), (tmpName, 'wb')):
+                    files.append(open(name, mode))
+                digest = thandy.delta.applyDelta(*files)
+            finally:
+                for f in files:
+                    f.close()
+            ok = (digest == h_expected)
+            if not ok:
+                logging.warn("Applying %s gave the wrong file for %s.",
+                             deltaPath, rp)
+        except (OSError, IOError, thandy.FormatException), e:
+            logging.warn("Couldn't build %s from %s: %s", rp, deltaPath, e)
+
+        if ok:
+            logging.info("Built %s from %s and %s.", rp, fromPath, deltaPath)
+            logCtrl("DELTA", FILENAME=rp, DELTA=deltaPath)
+            thandy.util.moveFile(tmpName, fname)
+        else:
+            self._failedDeltas.add(deltaPath)
+            try:
+                os.unlink(tmpName)
+            except OSError:
+                pass
+        try:
+            os.unlink(dname)
+        except OSError:
+            pass
+        return ok
+
+    def _planDelta(self, rp, h_expected, deltas, hashDict, lengthDict):
+        """Helper for getFilesToUpdate: we need the installable file 'rp',
+           which should have the digest 'h_expected', and its package
+           lists the deltas in 'deltas'.  If we have an older version of
+           the file that one of them starts from, and the delta too, build
+           the file and return None.  If we only lack the delta, return its
+           relative path, and set its digest and length in hashDict and
+           lengthDict.  Otherwise return 'rp': we need the whole file."""
+        dc = self._digestCache
+        for fromPath, fromHash, deltaPath, deltaHash, length in deltas:
+            if deltaPath in self._failedDeltas:
+                continue
+            try:
+                if dc.getFileDigest(self.getFilename(fromPath)) != \
+                       thandy.formats.parseHash(fromHash):
+                    continue
+            except (OSError, IOError):
+                continue
+            deltaHash = thandy.formats.parseHash(deltaHash)
+            try:
+                haveDelta = dc.getFileDigest(
+                    self.getFilename(deltaPath)) == deltaHash
+            except (OSError, IOError):
+                haveDelta = False
+            if not haveDelta:
+                logging.info("Can build %s from %s; must load delta %s.",
+                             rp, fromPath, deltaPath)
+                hashDict[deltaPath] = deltaHash
+                lengthDict[deltaPath] = length
+                return deltaPath
+            if self._applyDelta(rp, h_expected, fromPath, deltaPath):
+                return None
+        return rp
+
+    def _buildFromChunks(self, rp, h_expected, indexPath, chunks):
+        """Helper for _planChunks: build the installable file 'rp' out of
+           the list of (digest, length) for the 'chunks' in its chunk index
+           at 'indexPath', which we have in our chunk store.  Return true
+           iff the result has the digest 'h_expected'.  We throw away any
+           chunk that turns out to be bad, so that we fetch it again; if
+           they were all good, the index was wrong.  If we can't write the
+           file, we give up on the index, so that we fetch the file whole."""
+        fname = self.getFilename(rp)
+        tmpName = fname + ".thandy-chunks"
+        digestObj = Crypto.Hash.SHA256.new()
+        badChunks = 0
+        writeFailed = False
+        try:
+            thandy.util.ensureParentDir(tmpName)
+            out = open(tmpName, 'wb')
+        except (OSError, IOError), e:
+            logging.warn("Couldn't build %s from chunks: %s", rp, e)
+            self._failedChunkIndices.add(indexPath)
+            return False
+        try:
+            for digest, length in chunks:
+                cname = self.getFilename(thandy.formats.getChunkPath(digest))
+                try:
+                    f = open(cname, 'rb')
+                    try:
+                        content = f.read()
+                    finally:
+                        f.close()
+                except IOError, e:
+                    logging.warn("Couldn't read chunk %s: %s", cname, e)
+                    badChunks += 1
+                    continue
+                if thandy.formats.getDigest(content) != digest:
+                    logging.warn("Chunk %s was corrupt; discarding it.",
+                                 cname)
+                    try:
+                        os.unlink(cname)
+                    except OSError:
+                        pass
+                    badChunks += 1
+                    continue
+                digestObj.update(content)
+                try:
+                    out.write(content)
+                except IOError, e:
+                    logging.warn("Couldn't build %s from chunks: %s", rp, e)
+                    self._failedChunkIndices.add(indexPath)
+                    writeFailed = True
+                    break
+        finally:
+            out.close()
+
+        ok = not (badChunks or writeFailed) and \
+             digestObj.digest() == h_expected
+        if ok:
+            logging.info("Built %s from %s chunks.", rp, len(chunks))
+            logCtrl("CHUNKS", FILENAME=rp, INDEX=indexPath,
+                    CHUNKS=str(len(chunks)))
+            thandy.util.moveFile(tmpName, fname)
+            self._chunkedFiles[rp] = indexPath
+            self._saveChunkedFiles()
+        else:
+            if not (badChunks or writeFailed):
+                logging.warn("Chunks in %s gave the wrong file for %s.",
+                             indexPath, rp)
+                self._failedChunkIndices.add(indexPath)
+            try:
+                os.unlink(tmpName)
+            except OSError:
+                pass
+        return ok
+
+    def _readChunkIndex(self, indexPath):
+        """Helper: return the list of (digest, length) for the chunks in
+           the chunk index we have at 'indexPath'.  Raises OSError, IOError,
+           ValueError, or FormatException if we can't read it."""
+        f = open(self.getFilename(indexPath), 'rb')
+        try:
+            index = json.load(f)
+        finally:
+            f.close()
+        thandy.formats.CHUNK_INDEX_SCHEMA.checkMatch(index)
+        return [ (thandy.formats.parseHash(h), length)
+                 for h, length in (c[:2] for c in index['chunks']) ]
+
+    def _pruneChunkStore(self, chunkInfos):
+        """Helper for getFilesToUpdate: we have every file we need, and
+           'chunkInfos' maps each installable file that our packages list
+           with a chunk index to its chunk info.  Throw away the files we
+           built from chunks that no package lists any more, and their
+           indices, and then every chunk that no remaining index uses.
+           Without this, we would keep every old version as a whole file
+           as well as in chunks."""
+        nFiles = nChunks = 0
+        for rp, indexPath in self._chunkedFiles.items():
+            if rp in chunkInfos:
+                continue
+            for p in (rp, indexPath):
+                try:
+                    os.unlink(self.getFilename(p))
+                    nFiles += 1
+                except OSError:
+                    pass
+            del self._chunkedFiles[rp]
+        if nFiles:
+            self._saveChunkedFiles()
+
+        keep = set()
+        for rp, chunkInfo in chunkInfos.iteritems():
+            try:
+                chunks = self._readChunkIndex(chunkInfo[0])
+            except (OSError, IOError, ValueError, thandy.FormatException):
+                continue
+            keep.update(self.getFilename(thandy.formats.getChunkPath(digest))
+                        for digest, length in chunks)
+        chunkRoot = self.getFilename("/chunks")
+        for dirpath, dirnames, filenames in os.walk(chunkRoot):
+            for fn in filenames:
+                fname = os.path.join(dirpath, fn)
+                if fname in keep:
+                    continue
+                try:
+                    os.unlink(fname)
+                    nChunks += 1
+                except OSError:
+                    pass
+
+        if nFiles or nChunks:
+            logging.info("Pruned %s old files and %s unused chunks.",
+                         nFiles, nChunks)
+            logCtrl("PRUNE", FILES=str(nFiles), CHUNKS=str(nChunks))
+
+    def _planChunks(self, rp, h_expected, chunkInfo, hashDict, lengthDict):
+        """Helper for getFilesToUpdate: we need the installable file 'rp',
+           which should have the digest 'h_expected', and its package
+           gives its chunk index as 'chunkInfo'.  Return a set of the
+           relative paths we must fetch to build it from our chunk store,
+           and set their digests and lengths in hashDict and lengthDict.
+           If we built it, return an empty set.  If we can't build it from
+           chunks, return None."""
+        indexPath, indexHash, indexLength = chunkInfo[:3]
+        if indexPath in self._failedChunkIndices:
+            return None
+        indexHash = thandy.formats.parseHash(indexHash)
+        fname = self.getFilename(indexPath)
+        try:
+            haveIndex = self._digestCache.getFileDigest(fname) == indexHash
+        except (OSError, IOError):
+            haveIndex = False
+        if not haveIndex:
+            logging.info("Can build %s from chunks; must load index %s.",
+                         rp, indexPath)
+            hashDict[indexPath] = indexHash
+            lengthDict[indexPath] = indexLength
+            return set([indexPath])
+
+        try:
+            chunks = self._readChunkIndex(indexPath)
+        except (OSError, IOError, ValueError, thandy.FormatException), e:
+            logging.warn("Couldn't read chunk index %s: %s", indexPath, e)
+            self._failedChunkIndices.add(indexPath)
+            return None
+
+        def missingChunks():
+            missing = set()
+            for digest, length in chunks:
+                cp = thandy.formats.getChunkPath(digest)
+                try:
+                    if os.stat(self.getFilename(cp)).st_size == length:
+                        continue
+                except OSError:
+                    pass
+                missing.add(cp)
+                hashDict[cp] = digest
+                lengthDict[cp] = length
+            return missing
+
+        missing = missingChunks()
+        if not missing:
+            if self._buildFromChunks(rp, h_expected, indexPath, chunks):
+                return missing
+            if indexPath in self._failedChunkIndices:
+                return None
+            missing = missingChunks()
+        logging.info("Can build %s from chunks; must load %s of %s.",
+                     rp, len(missing), len(chunks))
+        return missing
+
+    def _findUnchecked(self, rp, h_expected):
+        """Helper for getSpeculativeFiles: return the signed part of our
+           cached or quarantined copy of 'rp', if either has the digest
+           'h_expected'.  Otherwise return None."""
+        for fname in (self.getFilename(rp), self.getQuarantineFilename(rp)):
+            obj, digest = self._readUnchecked(fname)
+            if digest is not None and digest == h_expected:
+                return obj['signed']
+        return None
+
+    def getSpeculativeFiles(self, trackingBundles=(), hashDict=None,
+                            lengthDict=None):
+        """Return a set of relative paths for the bundle and package files
+           that getFilesToUpdate will probably ask for once our metadata
+           is up to date, so that the caller can fetch them now, to their
+           quarantine filenames.  Assumes that we care about the bundles
+           'trackingBundles'.  Set the expected digest and length of each
+           file in hashDict and lengthDict.
+
+           We guess from whatever timestamp file and bundles we have,
+           without checking their signatures -- often we can't, yet.  So
+           nothing fetched this way is used until getFilesToUpdate finds
+           it listed, with the same digest, in a file that it has checked.
+        """
+        if hashDict == None:
+            hashDict = {}
+        if lengthDict == None:
+            lengthDict = {}
+        want = set()
+
+        try:
+            self._timestampFile.load()
+        except (OSError, thandy.FormatException):
+            return want
+        ts = thandy.formats.TimestampFile.fromJSon(self._timestampFile.get())
+        if len(trackingBundles) == 1 and trackingBundles[0] == "**":
+            trackingBundles = ts.getBundleInfos()
+
+        def isSafe(rp, prefix):
+            # Don't let an unchecked file point us outside our cache.
+            return (isinstance(rp, basestring) and rp.startswith(prefix) and
+                    ".." not in rp.split("/"))
+        def wantFile(rp, h, length):
+            if not isinstance(length, (int, long)):
+                length = None
+            want.add(rp)
+            hashDict[rp] = h
+            lengthDict[rp] = length
+
+        for b in trackingBundles:
+            try:
+                binfo = ts.getBundleInfo(b)
+            except KeyError:
+                continue
+            rp = binfo.getRelativePath()
+            if not isSafe(rp, "/bundleinfo/"):
+                continue
+            bundle = self._findUnchecked(rp, binfo.getHash())
+            if bundle is None:
+                wantFile(rp, binfo.getHash(), binfo.getLength())
+                continue
+            try:
+                packages = [ (p['path'], thandy.formats.parseHash(p['hash']),
+                              p.get('length'))
+                             for p in bundle['packages'] ]
+            except (KeyError, TypeError, ValueError, AttributeError,
+                    thandy.FormatException):
+                continue
+            for prp, h, length in packages:
+                if isSafe(prp, "/pkginfo/") and \
+                       self._findUnchecked(prp, h) is None:
+                    wantFile(prp, h, length)
+
+        return want
+
     def getFilesToUpdate(self, now=None, trackingBundles=(), hashDict=None,
                          lengthDict=None, usePackageSystem=True,
                          installableDict=None, btMetadataDict=None,
@@ -353,12 +1389,18 @@ class LocalRepository:
         ts = self._timestampFile.get()
         if ts:
             age = now - thandy.formats.parseTime(ts['at'])
+            rp = self._timestampFile.getRelativePath()
             if age > MAX_TIMESTAMP_AGE:
                 logging.info("Timestamp file from %s is out of "
                              "date; must fetch it.", ts['at'])
-                need.add(self._timestampFile.getRelativePath())
+                need.add(rp)
 
-            ts = thandy.formats.TimestampFile.fromJSon(ts)
+            h_ts = self._timestampFile.getDigest()
+            if self._parsedTimestamp is None or \
+                   self._parsedTimestamp[0] != h_ts:
+                self._parsedTimestamp = (
+                    h_ts, thandy.formats.TimestampFile.fromJSon(ts))
+            ts = self._parsedTimestamp[1]
 
         # If the keylist isn't signed right, we can't check the
         # signatures on anything else.
@@ -372,8 +1414,12 @@ class LocalRepository:
         if need:
             return need, False
 
-        # Import the keys from the keylist.
-        self._keyDB.addFromKeylist(self._keylistFile.get())
+        # Import the keys from the keylist, unless we already have.
+        h_kf = self._keylistFile.getDigest()
+        if h_kf != self._keyDBKeylist:
+            self._keyDB.addFromKeylist(self._keylistFile.get())
+            self._keyDBKeylist = h_kf
+            self._keyDBVersion += 1
 
         # If the timestamp isn't signed right, get a new timestamp and a
         # new keylist.
@@ -397,7 +1443,7 @@ class LocalRepository:
         lengthDict[self._mirrorlistFile.getRelativePath()] = \
             ts.getMirrorlistInfo().getLength()
 
-        h_kf = thandy.formats.getDigest(self._keylistFile.get())
+        h_kf = self._keylistFile.getDigest()
         h_expected = ts.getKeylistInfo().getHash()
         if h_kf != h_expected:
             logging.info("Keylist file hash did not match.  Must fetch it.")
@@ -411,7 +1457,7 @@ class LocalRepository:
             logging.info("Mirrorlist file signatures not valid. Must fetch.")
             need.add(self._mirrorlistFile.getRelativePath())
 
-        h_mf = thandy.formats.getDigest(self._mirrorlistFile.get())
+        h_mf = self._mirrorlistFile.getDigest()
         h_expected = ts.getMirrorlistInfo().getHash()
         if h_mf != h_expected:
             logging.info("Mirrorlist file hash did not match. Must fetch.")
@@ -422,94 +1468,67 @@ class LocalRepository:
 
         # Okay; that's it for the metadata.  Do we have the right
         # bundles?
-        bundles = {}
         if len(trackingBundles) == 1 and trackingBundles[0] == "**":
             trackingBundles = ts.getBundleInfos()
 
+        bundleInfos = []
         for b in trackingBundles:
             try:
-                binfo = ts.getBundleInfo(b)
+                bundleInfos.append(ts.getBundleInfo(b))
             except KeyError:
                 logging.warn("Bundle %s not listed in timestamp file."%b)
-                continue
 
+        self._verifyInParallel([ self.getBundleFile(binfo.getRelativePath())
+                                 for binfo in bundleInfos ])
+
+        # Check the bundles, then the packages they list.  We only look
+        # inside the ones that have changed since the last time.
+        planNodes = {}
+        self._nPlanEvaluated = self._nPlanReused = 0
+        bundles = []
+        for binfo in bundleInfos:
             rp = binfo.getRelativePath()
-            h_expected = binfo.getHash()
-            hashDict[rp] = h_expected
+            hashDict[rp] = binfo.getHash()
             lengthDict[rp] = binfo.getLength()
-            bfile = self.getBundleFile(rp)
-            try:
-                bfile.load()
-            except OSError:
-                logging.info("Can't find bundle %s on disk; must fetch.", rp)
+            node = planNodes[rp] = self._planBundle(rp, binfo.getHash())
+            if node.need:
                 need.add(rp)
-                continue
-
-            h_b = thandy.formats.getDigest(bfile.get())
-            if h_b != h_expected:
-                logging.info("Bundle hash for %s not as expected; must fetch.",
-                             rp)
-                need.add(rp)
-                continue
-
-            s = bfile.checkSignatures()
-            if not s.isValid():
-                # Can't actually use it.
-                logging.warn("Bundle hash was as expected, but signatures did "
-                             "not match.")
-                continue
-
-            bundles[rp] = bfile
-
-        # Okay.  So we have some bundles.  See if we have their packages.
-        packages = {}
-        for bfile in bundles.values():
-            bundle = bfile.get()
-            for pkginfo in bundle['packages']:
-                rp = pkginfo['path']
-                pfile = self.getPackageFile(rp)
-                h_expected = thandy.formats.parseHash(pkginfo['hash'])
+            elif node.valid:
+                bundles.append(node)
+
+        self._verifyInParallel([ self.getPackageFile(prp)
+                                 for bnode in bundles
+                                 for prp, _, _ in bnode.children ])
+        packages = []
+        for bnode in bundles:
+            bundleName = bnode.obj['name']
+            for rp, h_expected, length in bnode.children:
                 hashDict[rp] = h_expected
-                lengthDict[rp] = pkginfo.get('length')
-                try:
-                    pfile.load()
-                except OSError:
-                    logging.info("Can't find package %s on disk; must fetch.",
-                                 rp)
+                lengthDict[rp] = length
+                node = planNodes[rp] = self._planPackage(rp, h_expected)
+                if node.need:
                     need.add(rp)
-                    continue
-
-                h_p = thandy.formats.getDigest(pfile.get())
-                if h_p != h_expected:
-                    logging.info("Wrong hash for package %s; must fetch.", rp)
-                    need.add(rp)
-                    continue
-
-                s = pfile.checkSignatures()
-                if not s.isValid():
-                    logging.warn("Package hash was as expected, but signature "
-                                 "did not match")
-                    # Can't use it.
-                    continue
-
-                # We assume that if there is one thp package then all the rest
-                # are thp too. But we continue with the loop to check every
-                # package digest and signature
-                pfile_data = pfile.get()
-
-                packages[rp] = pfile
-
-                transactions.setdefault(pfile_data["format"], {})\
-                            .setdefault(bundle["name"], {})[pfile_data["name"]] = pfile_data
+                elif node.valid:
+                    packages.append(node)
+                    pfile_data = node.obj
+                    transactions.setdefault(pfile_data["format"], {})\
+                        .setdefault(bundleName, {})[pfile_data["name"]] = pfile_data
+
+        # Forget about the files we no longer track.
+        self._planNodes = planNodes
+        logging.info("Update plan: re-checked %s metadata files; %s were "
+                     "unchanged", self._nPlanEvaluated, self._nPlanReused)
+        logCtrl("PLAN", EVALUATED=str(self._nPlanEvaluated),
+                REUSED=str(self._nPlanReused))
 
         # We have the packages. If we're downloading via bittorrent, we need
         # the .torrent metafiles, as well.
         if thandy.bt_compat.BtCompat.shouldUseBt():
             btcomp = thandy.bt_compat.BtCompat()
-            for pfile in packages.values():
-                package = pfile.get()
+            for pnode in packages:
+                package = pnode.obj
                 for f in package['files']:
-                    rp = btcomp.getBtMetadataLocation(pfile.getRelativePath(),f[:1][0])
+                    rp = btcomp.getBtMetadataLocation(pnode.relPath,f[:1][0])
                     try:
                         l = btcomp.getFileLength(self.getFilename(rp))
                     except IOError:
@@ -527,9 +1546,10 @@ class LocalRepository:
             return need, False
 
         # Finally, we have some packages.  Do we have their underlying
-        # files?
-        for pfile in packages.values():
-            package = pfile.get()
+        # files?  Remember the chunk index of each one that has one.
+        chunkInfos = {}
+        for pnode in packages:
+            package = pnode.obj
 
             pkgItems = {}
 
@@ -550,31 +1570,66 @@ class LocalRepository:
                             logging.warn("Can't check installed-ness of %s: %s",
                                          f[0], err)
 
-            pkg_rp = pfile.getRelativePath()
-
+            deltas = {}
             for f in package['files']:
-                rp, h = f[:2]
+                if len(f) > 2 and isinstance(f[2], dict):
+                    deltas[f[0]] = f[2].get('deltas', ())
+                    if f[2].get('chunks'):
+                        chunkInfos[f[0]] = f[2]['chunks']
+
+            for rp, h_expected, length in pnode.children:
                 if rp in alreadyInstalledSet:
                     logging.info("%s is already installed; no need to download",
                                  rp)
                     logCtrl("ALREADY", PKG=rp)
                     continue
 
-                h_expected = thandy.formats.parseHash(h)
                 hashDict[rp] = h_expected
-                if len(f) > 3:
-                    lengthDict[rp] = f[3]
+                if length is not None:
+                    lengthDict[rp] = length
                 fn = self.getFilename(rp)
                 try:
-                    h_got = thandy.formats.getFileDigest(fn)
+                    h_got = self._digestCache.getFileDigest(fn)
                 except (OSError, IOError):
                     logging.info("Installable file %s not found on disk; "
                                  "must load", rp)
-                    need.add(rp)
-                    continue
+                    h_got = None
+                else:
+                    if h_got != h_expected:
+                        logging.info("Hash for %s not as expected; must load.",
+                                     rp)
                 if h_got != h_expected:
-                    logging.info("Hash for %s not as expected; must load.", rp)
-                    need.add(rp)
+                    # A delta is the least we could fetch, if we have the
+                    # file it starts from.  Otherwise we fetch whatever
+                    # pieces of the file our chunk store lacks.
+                    fetch = self._planDelta(rp, h_expected, deltas.get(rp, ()),
+                                            hashDict, lengthDict)
+                    if fetch == rp and self._useChunkStore and \
+                           rp in chunkInfos:
+                        chunkPaths = self._planChunks(rp, h_expected,
+                                                      chunkInfos[rp],
+                                                      hashDict, lengthDict)
+                        if chunkPaths is not None:
+                            need.update(chunkPaths)
+                            continue
+                    if fetch is not None:
+                        need.add(fetch)
+
+        dc = self._digestCache
+        logging.info("Digest cache: %s hits, %s misses, %s bytes not reread",
+                     dc.hits, dc.misses, dc.bytesSaved)
+        logCtrl("DIGESTCACHE", HITS=str(dc.hits), MISSES=str(dc.misses),
+                SAVED=str(dc.bytesSaved))
+        sc = self._sigCache
+        logging.info("Signature cache: %s hits, %s misses", sc.hits, sc.misses)
+        logCtrl("SIGCACHE", HITS=str(sc.hits), MISSES=str(sc.misses))
+        vc = self._validationCache
+        logging.info("Validation cache: %s hits, %s misses",
+                     vc.hits, vc.misses)
+        logCtrl("VALIDATIONCACHE", HITS=str(vc.hits), MISSES=str(vc.misses))
+
+        if len(need) == 0 and self._useChunkStore:
+            self._pruneChunkStore(chunkInfos)
 
         if len(need) == 0:
             # We have done everything, lets see if we have thp bundles,
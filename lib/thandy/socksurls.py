@@ -31,6 +31,29 @@ def _recvall(sock, n):
         if n <= 0:
             return result
 
+# Length of a SOCKS4 reply.
+SOCKS4_REPLY_LEN = 8
+
+def socks4aRequest(host, port):
+    """Return the SOCKS4a request asking the proxy to connect us to
+       host:port."""
+    version = 4 # socks 4
+    command = 1 # connect
+    addr    = 1   # 0.0.0.1, signals socks4a.
+    userid  = ""
+
+    messageheader = struct.pack("!BBHL", version, command, port, addr)
+    return "%s%s\x00%s\x00" % (messageheader, userid, host)
+
+def checkSocks4Reply(reply):
+    """Raise socket.error unless 'reply' is a SOCKS4 reply saying that the
+       proxy has connected us."""
+    if len(reply) < SOCKS4_REPLY_LEN:
+        raise socket.error("Truncated reply from SOCKS proxy")
+    code = ord(reply[1])
+    if code != 0x5a:
+        raise socket.error("Bad SOCKS response code from proxy: %d" % code)
+
 def socks_connect(host, port):
     """Helper: use the SOCKS proxy to open a connection to host:port.
        Uses the simple and Tor-friendly SOCKS4a protocol."""
@@ -40,24 +63,12 @@ def socks_connect(host, port):
         sock.connect((SOCKS_HOST, SOCKS_PORT))
 
         # Now, the handshake!  We just do socks4a, since that's the simplest.
-        version = 4 # socks 4
-        command = 1 # connect
-        addr    = 1   # 0.0.0.1, signals socks4a.
-        userid  = ""
-
-        messageheader = struct.pack("!BBHL", version, command, port, addr)
-        message = "%s%s\x00%s\x00" % (messageheader, userid, host)
-
-        sock.sendall(message)
+        sock.sendall(socks4aRequest(host, port))
 
         logging.debug("Waiting for reply from SOCKS proxy")
-        reply = _recvall(sock, 8)
-        code = ord(reply[1])
-        if code == 0x5a:
-            logging.debug("SOCKS proxy is connected.")
-            return sock
-        else:
-            raise socket.error("Bad SOCKS response code from proxy: %d", code)
+        checkSocks4Reply(_recvall(sock, SOCKS4_REPLY_LEN))
+        logging.debug("SOCKS proxy is connected.")
+        return sock
     except:
         sock.close()
         raise
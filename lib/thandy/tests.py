@@ -3,13 +3,27 @@
 import unittest
 import doctest
 import os
+import random
+import re
+import socket
+import struct
 import tempfile
+import threading
+import time
+import Queue
+import SocketServer
+import cStringIO
 
 import thandy.keys
 import thandy.formats
 import thandy.repository
 import thandy.checkJson
 import thandy.encodeToXML
+import thandy.benchmarks
+import thandy.download
+import thandy.asyncdownload
+import thandy.delta
+import thandy.socksurls
 import thandy.util
 import thandy.packagesys
 import thandy.packagesys.PackageSystem
@@ -19,6 +33,8 @@ import thandy.packagesys.ExePackages
 
 import thandy.tests
 
+json = thandy.util.importJSON()
+
 def deltree(top):
     for dirpath, dirnames, filenames in os.walk(top, topdown=False):
         for f in filenames:
@@ -27,6 +43,14 @@ def deltree(top):
             os.rmdir(os.path.join(dirpath, d))
     os.rmdir(top)
 
+_testKeys = []
+def getTestKey(n=0):
+    """Return the n'th of a set of RSA keys that we share between tests,
+       since generating them is slow."""
+    while len(_testKeys) <= n:
+        _testKeys.append(thandy.keys.RSAKey.generate(1024))
+    return _testKeys[n]
+
 def contents(fn, mode='rb'):
     f = open(fn, mode)
     try:
@@ -34,6 +58,263 @@ def contents(fn, mode='rb'):
     finally:
         f.close()
 
+class TestRepository:
+    """Builds a small signed repository on disk, in the layout a mirror
+       would serve, for testing LocalRepository against."""
+    def __init__(self, serverRoot, thandyHome):
+        self.root = serverRoot
+        self.master = thandy.keys.RSAKey.fromJSon(
+            getTestKey(0).format(private=True))
+        self.master.addRole("master", "/meta/keys.txt")
+        self.signer = thandy.keys.RSAKey.fromJSon(
+            getTestKey(1).format(private=True))
+        for role, path in [ ("timestamp", "/meta/timestamp.txt"),
+                            ("mirrors", "/meta/mirrors.txt"),
+                            ("bundle", "/bundleinfo/**"),
+                            ("package", "/pkginfo/**") ]:
+            self.signer.addRole(role, path)
+
+        # Clients trust our master key because it's in their preload_keys.
+        thandy.util.replaceFile(os.path.join(thandyHome, "preload_keys"),
+            "Key(%r)\n" % self.master.format(includeRoles=True))
+
+        self.writeKeylist(0)
+        self.writeSigned("/meta/mirrors.txt", self.signer, {
+                '_type' : 'Mirrorlist',
+                'ts' : thandy.formats.formatTime(0),
+                'mirrors' : [ { 'name' : 'm1',
+                                'urlbase' : 'http://example.com/',
+                                'contents' : [ '**' ],
+                                'weight' : 1 } ] })
+        self.bundles = []
+
+    def writeFile(self, relPath, content):
+        fn = os.path.join(self.root, relPath[1:])
+        thandy.util.ensureParentDir(fn)
+        thandy.util.replaceFile(fn, content)
+        return len(content)
+
+    def writeSigned(self, relPath, key, obj):
+        signable = thandy.formats.makeSignable(obj)
+        thandy.formats.sign(signable, key)
+        return self.writeFile(relPath, json.dumps(signable, indent=1))
+
+    def writeKeylist(self, when):
+        self.writeSigned("/meta/keys.txt", self.master, {
+                '_type' : 'Keylist',
+                'ts' : thandy.formats.formatTime(when),
+                'keys' : [ { 'key' : k.format(), 'roles' : k.getRoles() }
+                           for k in (self.master, self.signer) ] })
+
+    def readSigned(self, relPath):
+        return json.loads(contents(os.path.join(self.root, relPath[1:])))
+
+    def addBundle(self, name, nPackages=2, version=1, deltaFrom=None,
+                  chunked=False):
+        """Add a bundle with nPackages packages, each holding one
+           installable file.  If deltaFrom is set, each package also lists
+           a delta from that version of its file.  If chunked is set, the
+           files are big, differ only a little from version to version, and
+           have chunk indices."""
+        packages = []
+        for i in xrange(nPackages):
+            data = "Contents of package %s/%d, version %d" % (name, i, version)
+            if chunked:
+                r = random.Random("%s/%d" % (name, i))
+                filler = "".join(chr(r.randrange(256))
+                                 for _ in xrange(200*1024))
+                data = filler[:100000] + data + filler[100000:]
+            dataPath = "/data/%s-%d-%d.bin" % (name, i, version)
+            self.writeFile(dataPath, data)
+            info = { 'rpm_version' : str(version) }
+            if chunked:
+                index, chunks = thandy.formats.makeChunkIndex(data)
+                for chunkPath, content in chunks:
+                    self.writeFile(chunkPath, content)
+                indexPath = dataPath + ".chunks"
+                info['chunks'] = [ indexPath, thandy.formats.formatHash(
+                                       thandy.formats.getDigest(
+                                           json.dumps(index))),
+                                   self.writeFile(indexPath,
+                                                  json.dumps(index)) ]
+            if deltaFrom is not None:
+                fromPath = "/data/%s-%d-%d.bin" % (name, i, deltaFrom)
+                old = contents(os.path.join(self.root, fromPath[1:]))
+                delta = thandy.delta.makeDelta(old, data)
+                deltaPath = dataPath + ".delta"
+                info['deltas'] = [ [ fromPath, thandy.formats.formatHash(
+                                         thandy.formats.getDigest(old)),
+                                     deltaPath, thandy.formats.formatHash(
+                                         thandy.formats.getDigest(delta)),
+                                     self.writeFile(deltaPath, delta) ] ]
+            pkgPath = "/pkginfo/%s/p%d-%d.txt" % (name, i, version)
+            pkg = { '_type' : 'Package',
+                    'name' : '%s-p%d' % (name, i),
+                    'location' : pkgPath,
+                    'version' : [ version ],
+                    'format' : 'rpm',
+                    'ts' : thandy.formats.formatTime(0),
+                    'files' : [ [ dataPath, thandy.formats.formatHash(
+                                    thandy.formats.getDigest(data)),
+                                  info, len(data) ] ],
+                    'shortdesc' : {}, 'longdesc' : {} }
+            length = self.writeSigned(pkgPath, self.signer, pkg)
+            packages.append({ 'name' : pkg['name'],
+                              'version' : [ version ],
+                              'path' : pkgPath,
+                              'hash' : thandy.formats.formatHash(
+                                  thandy.formats.getDigest(pkg)),
+                              'length' : length,
+                              'order' : [ 1, 1, 1 ],
+                              'gloss' : {}, 'longgloss' : {} })
+        bundlePath = "/bundleinfo/%s/%s-%d.txt" % (name, name, version)
+        bundle = { '_type' : 'Bundle',
+                   'at' : thandy.formats.formatTime(0),
+                   'name' : name,
+                   'os' : 'linux',
+                   'version' : [ version ],
+                   'location' : bundlePath,
+                   'packages' : packages }
+        length = self.writeSigned(bundlePath, self.signer, bundle)
+        self.bundles = [ b for b in self.bundles if b[0]['name'] != name ]
+        self.bundles.append((bundle, length))
+        return bundlePath
+
+    def writeTimestamp(self, when=None):
+        if when is None:
+            when = time.time()
+        fname = os.path.join(self.root, "meta/keys.txt")
+        kLen = os.stat(fname).st_size
+        fname = os.path.join(self.root, "meta/mirrors.txt")
+        mLen = os.stat(fname).st_size
+        ts = thandy.formats.makeTimestampObj(
+            self.readSigned("/meta/mirrors.txt")['signed'], mLen,
+            self.readSigned("/meta/keys.txt")['signed'], kLen,
+            self.bundles)
+        ts['at'] = thandy.formats.formatTime(when)
+        self.writeSigned("/meta/timestamp.txt", self.signer, ts)
+
+    def fetch(self, client, relPath):
+        """Copy relPath from this repository into the client's cache, as
+           if we had downloaded it."""
+        fn = client.getFilename(relPath)
+        thandy.util.ensureParentDir(fn)
+        thandy.util.replaceFile(fn,
+                    contents(os.path.join(self.root, relPath[1:])))
+        rf = client.getRequestedFile(relPath)
+        if rf is not None:
+            rf.clear()
+
+class SocksProxy(SocketServer.ThreadingTCPServer):
+    """A SOCKS4a proxy on localhost, for testing."""
+    ## Fields:
+    #   connections: a list of the (host, port) we've been asked to
+    #     connect to.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                                 _SocksProxyHandler)
+        self.connections = []
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class _SocksProxyHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        request = ""
+        while request.count("\x00") < 2:
+            request += sock.recv(1024)
+        _, _, port, _ = struct.unpack("!BBHL", request[:8])
+        host = request[8:].split("\x00")[1]
+        self.server.connections.append((host, port))
+        out = socket.create_connection((host, port))
+        sock.sendall(struct.pack("!BBHL", 0, 0x5a, 0, 0))
+        # Our clients send their whole request before reading anything.
+        out.sendall(sock.recv(65536))
+        while True:
+            s = out.recv(65536)
+            if not s:
+                break
+            sock.sendall(s)
+        out.close()
+
+class RepositoryTestCase(unittest.TestCase):
+    """Base class for tests that need a server-side TestRepository and a
+       client-side LocalRepository."""
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._oldHome = os.environ.get("THANDY_HOME")
+        os.environ["THANDY_HOME"] = os.path.join(self._dir, "home")
+        os.mkdir(os.environ["THANDY_HOME"])
+        self.server = TestRepository(os.path.join(self._dir, "server"),
+                                     os.environ["THANDY_HOME"])
+        self.cacheRoot = os.path.join(self._dir, "cache")
+        self.httpServer = None
+
+    def tearDown(self):
+        if self.httpServer is not None:
+            self.httpServer.stop()
+        if self._oldHome is None:
+            del os.environ["THANDY_HOME"]
+        else:
+            os.environ["THANDY_HOME"] = self._oldHome
+        deltree(self._dir)
+
+    def update(self, client, bundles=("**",), **kwargs):
+        """Run getFilesToUpdate on the client, fetching what it asks
+           for from the server, until it needs nothing.  Return the list
+           of sets of files that it asked for."""
+        rounds = []
+        while True:
+            need, _ = client.getFilesToUpdate(trackingBundles=list(bundles),
+                                              usePackageSystem=False,
+                                              **kwargs)
+            if not need:
+                return rounds
+            rounds.append(need)
+            self.assert_(len(rounds) < 10)
+            for rp in need:
+                self.server.fetch(client, rp)
+
+    def startHTTPServer(self):
+        """Start serving the test repository over HTTP."""
+        self.httpServer = thandy.benchmarks.LocalMirror(self.server.root)
+        return self.httpServer
+
+    def mirrorlist(self, urlbase=None):
+        """Return a mirrorlist with a single mirror that serves the test
+           repository from 'urlbase', or from a file: URL."""
+        if urlbase is None:
+            urlbase = 'file://' + self.server.root
+        return { 'mirrors' : [ { 'name' : 'local', 'weight' : 1,
+                                 'urlbase' : urlbase,
+                                 'contents' : [ '/**' ] } ] }
+
+    def download(self, client, files, hashDict, lengthDict):
+        """Download every file in 'files' from the test repository into
+           the client's cache, one at a time, as ClientCLI would.
+           Return a list of the files that failed."""
+        failed = []
+        for rp in files:
+            job = thandy.download.ThandyDownloadJob(
+                rp, client.getFilename(rp), self.mirrorlist(),
+                wantHash=hashDict.get(rp), wantLength=lengthDict.get(rp),
+                repoFile=client.getRequestedFile(rp))
+            if job.download() is None:
+                rf = client.getRequestedFile(rp)
+                if rf is not None:
+                    rf.clear()
+            else:
+                failed.append(rp)
+        return failed
+
 class CanonicalEncodingTest(unittest.TestCase):
     def test_encode(self):
         enc = thandy.formats.encodeCanonical
@@ -42,6 +323,62 @@ class CanonicalEncodingTest(unittest.TestCase):
         self.assertEquals(enc('\t\\\n"\r'),
                           '"\t\\\\\n\\"\r"')
 
+    def test_encodeMatchesRecursiveEncoder(self):
+        # This is the simple recursive encoder that encodeCanonical
+        # replaced; the output must not change.
+        def encStr(s):
+            s = '"%s"' % re.sub(r'(["\\])', r'\\\1', s)
+            if isinstance(s, unicode):
+                return s.encode("utf-8")
+            return s
+        def oldEnc(obj):
+            if isinstance(obj, basestring):
+                return encStr(obj)
+            elif obj is True:
+                return "true"
+            elif obj is False:
+                return "false"
+            elif obj is None:
+                return "null"
+            elif isinstance(obj, (int, long)):
+                return str(obj)
+            elif isinstance(obj, (tuple, list)):
+                return "[%s]" % ",".join(oldEnc(o) for o in obj)
+            else:
+                items = obj.items()
+                items.sort()
+                return "{%s}" % ",".join("%s:%s" % (encStr(k), oldEnc(v))
+                                         for k, v in items)
+
+        objs = [ [], {}, "", u"\u00e9\"\\", [[[]], {"a": {}}],
+                 {"b": [1, -2, 10**30, True, False, None], "a": u"x\ty"},
+                 thandy.benchmarks.makeBundle(300),
+                 thandy.benchmarks.makeKeylist(300) ]
+        for obj in objs:
+            self.assertEquals(thandy.formats.encodeCanonical(obj), oldEnc(obj))
+            pieces = []
+            thandy.formats.encodeCanonical(obj, pieces.append)
+            self.assertEquals("".join(pieces), oldEnc(obj))
+            self.assert_(len(pieces) < 10)
+
+        self.assertRaises(thandy.FormatException,
+                          thandy.formats.encodeCanonical, [1.5])
+
+    def test_decodeAndDigest(self):
+        docs = [ '{"signed": {"_type": "Bundle", "z": [], "a": {"q": null}},'
+                 ' "signatures": [{"keyid": "x", "sig": "y"}]}',
+                 '{"signatures": [], "signed": ["\\u00e9\\"", -3, true]}',
+                 ' {"signed" : {"b" : 1, "a" : "\xc3\xa9\\\\"} } ' ]
+        for d in docs:
+            obj, digest = thandy.formats.decodeAndDigest(d)
+            self.assertEquals(obj, json.loads(d))
+            self.assertEquals(digest, thandy.formats.getDigest(obj['signed']))
+
+        self.assertRaises(ValueError, thandy.formats.decodeAndDigest, '[1,')
+        self.assertRaises(ValueError, thandy.formats.decodeAndDigest, '{} {}')
+        self.assertRaises(thandy.FormatException,
+                          thandy.formats.decodeAndDigest, '{"signed": [1.5]}')
+
 class CryptoTests(unittest.TestCase):
     def test_encrypt(self):
         s = "The Secret words are marzipan habidashery zeugma."
@@ -130,6 +467,1544 @@ class UtilTests(unittest.TestCase):
         self.assertEquals(os.listdir(d), ["subdir"])
         self.assertEquals(os.listdir(os.path.join(d, "subdir")), ["f3"])
 
+class SchemaTests(unittest.TestCase):
+    def test_compiledMatchesInterpreted(self):
+        bundle = thandy.benchmarks.makeBundle(20)['signed']
+        schema = thandy.formats.BUNDLE_SCHEMA
+        def interpreted(obj):
+            try:
+                schema._checkMatch(obj)
+            except thandy.FormatException, e:
+                return str(e)
+        def compiled(obj):
+            try:
+                schema.checkMatch(obj)
+            except thandy.FormatException, e:
+                return str(e)
+
+        self.assert_(schema.matches(bundle))
+        self.assertEquals(compiled(bundle), None)
+        self.assertEquals(interpreted(bundle), None)
+
+        pkg = bundle['packages'][7]
+        for key, badValue in [ ('name', 3), ('version', 'x'),
+                               ('length', -1), ('length', True),
+                               ('order', [1, 2]), ('optional', 'no'),
+                               ('hash', 'short'), ('gloss', { 'en' : 2 }),
+                               ('path', None) ]:
+            orig = pkg[key]
+            pkg[key] = badValue
+            self.assertFalse(schema.matches(bundle))
+            msg = compiled(bundle)
+            self.assert_(msg)
+            self.assertEquals(msg, interpreted(bundle))
+            pkg[key] = orig
+        del pkg['gloss']
+        self.assertEquals(compiled(bundle), interpreted(bundle))
+        self.assertEquals(compiled(bundle),
+                          "Missing key gloss in object in list in object.packages")
+
+class DigestCacheTests(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+    def tearDown(self):
+        deltree(self._dir)
+
+    def test_digestCache(self):
+        fn = os.path.join(self._dir, "installer")
+        cacheFn = os.path.join(self._dir, "digests.json")
+        thandy.util.replaceFile(fn, "Version 1 of the installer")
+        h1 = thandy.formats.getFileDigest(fn)
+
+        dc = thandy.repository.DigestCache(cacheFn)
+        self.assertEquals(dc.getFileDigest(fn), h1)
+        self.assertEquals(dc.getFileDigest(fn), h1)
+        self.assertEquals((dc.hits, dc.misses), (1, 1))
+        dc.save()
+
+        # A new cache loaded from disk remembers the digest.
+        dc = thandy.repository.DigestCache(cacheFn)
+        dc.load()
+        self.assertEquals(dc.getFileDigest(fn), h1)
+        self.assertEquals((dc.hits, dc.misses), (1, 0))
+
+        # Replacing the file changes its inode, so we rehash.
+        thandy.util.replaceFile(fn, "Version 2 of the installer!")
+        h2 = thandy.formats.getFileDigest(fn)
+        self.assertEquals(dc.getFileDigest(fn), h2)
+        self.assertEquals((dc.hits, dc.misses), (1, 1))
+
+        dc.clear()
+        self.assertEquals(dc.getFileDigest(fn), h2)
+        self.assertEquals((dc.hits, dc.misses), (1, 2))
+
+        self.assertRaises(OSError, dc.getFileDigest,
+                          os.path.join(self._dir, "missing"))
+
+        # Saving drops the entries for files that are gone or changed.
+        fn2 = os.path.join(self._dir, "other")
+        thandy.util.replaceFile(fn2, "Another installer")
+        dc.getFileDigest(fn2)
+        dc.save()
+        os.unlink(fn)
+        thandy.util.replaceFile(fn2, "Another installer, changed")
+        dc.save()
+        self.assertEquals(dc._entries, {})
+        dc = thandy.repository.DigestCache(cacheFn)
+        dc.load()
+        self.assertEquals(dc._entries, {})
+
+class SignatureCacheTests(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+    def tearDown(self):
+        deltree(self._dir)
+
+    def test_sigCache(self):
+        key1, key2 = getTestKey(0), getTestKey(1)
+        keydb = thandy.formats.KeyDB()
+        for k in key1, key2:
+            k.clearRoles()
+            k.addRole("bundle", "/bundleinfo/**")
+            keydb.addKey(k)
+        signed = thandy.formats.makeSignable({ 'x' : 'y' })
+        thandy.formats.sign(signed, key1)
+        thandy.formats.sign(signed, key2)
+        check = thandy.formats.checkSignatures
+
+        fn = os.path.join(self._dir, "sigs")
+        cache = thandy.formats.SignatureCache(fn)
+        ss = check(signed, keydb, "bundle", "/bundleinfo/a", sigCache=cache)
+        self.assert_(ss.isValid(2))
+        self.assertEquals((cache.hits, cache.misses), (0, 2))
+        ss = check(signed, keydb, "bundle", "/bundleinfo/a", sigCache=cache)
+        self.assert_(ss.isValid(2))
+        self.assertEquals((cache.hits, cache.misses), (2, 2))
+
+        # Once we have enough good signatures, we stop looking.
+        cache = thandy.formats.SignatureCache(fn)
+        ss = check(signed, keydb, "bundle", "/bundleinfo/a", sigCache=cache,
+                   threshold=1)
+        self.assert_(ss.isValid(1))
+        self.assertFalse(ss.isValid(2))
+        self.assertEquals((cache.hits, cache.misses), (0, 1))
+        cache.save()
+
+        cache = thandy.formats.SignatureCache(fn)
+        cache.load()
+        ss = check(signed, keydb, "bundle", "/bundleinfo/a", sigCache=cache)
+        self.assert_(ss.isValid(2))
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+        # A changed object doesn't get a cached verdict.
+        signed['signed']['x'] = 'z'
+        ss = check(signed, keydb, "bundle", "/bundleinfo/a", sigCache=cache)
+        self.assertFalse(ss.isValid())
+        self.assertEquals((cache.hits, cache.misses), (1, 3))
+
+    def test_sigCacheBounded(self):
+        fn = os.path.join(self._dir, "sigs")
+        cache = thandy.formats.SignatureCache(fn, maxSize=8)
+        digest = "\x00"*32
+        keys = [ (thandy.formats.formatHash(chr(n)*32), digest,
+                  "sha256-pkcs1", "sig") for n in xrange(20) ]
+        for k in keys:
+            cache.addVerdicts({ k : True })
+            # Keep using the first verdict, so that it stays recent.
+            cache.addVerdicts({ keys[0] : True })
+            self.assert_(len(cache) <= 8)
+        verdicts = cache.getVerdicts()
+        self.assert_(keys[0] in verdicts)
+        self.assert_(keys[-1] in verdicts)
+        self.assert_(keys[1] not in verdicts)
+        self.assertEquals(sorted(cache.takeUsed()), sorted(verdicts))
+
+        # Only the verdicts we still hold get written out.
+        cache.addVerdicts(verdicts)
+        cache.save()
+        cache = thandy.formats.SignatureCache(fn)
+        cache.load()
+        self.assertEquals(cache.getVerdicts(), verdicts)
+
+class KeyDBTests(unittest.TestCase):
+    def test_getKeysByRole(self):
+        key1, key2 = getTestKey(0), getTestKey(1)
+        keydb = thandy.formats.KeyDB()
+        for k in key1, key2:
+            k.clearRoles()
+            keydb.addKey(k)
+        roles1 = [ ("bundle", "/bundleinfo/**"),
+                   ("package", "/pkginfo/tor/*"),
+                   ("package", "//pkginfo/a*b/x.txt"),
+                   ("mirrors", "/meta/mirrors.txt") ]
+        roles2 = [ ("package", "/pkginfo/**/*.txt"),
+                   ("package", "/pkginfo/tor/tor-0.2.txt"),
+                   ("package", "/pkginfo/*"),
+                   ("bundle", "**") ]
+        for r,p in roles1:
+            key1.addRole(r,p)
+        for r,p in roles2:
+            key2.addRole(r,p)
+
+        paths = [ "/bundleinfo/tor/tor-0.2.txt", "/bundleinfo", "",
+                  "/pkginfo/tor/tor-0.2.txt", "/pkginfo/tor/x/y.txt",
+                  "/pkginfo/tor/", "/pkginfo/tor", "/pkginfo/axyzb/x.txt",
+                  "/pkginfo/ab/x.txt", "/pkginfo/a/b/x.txt",
+                  "/meta/mirrors.txt", "/meta/mirrors.txt2", "/pkginfo/.txt",
+                  "/pkginfo/ab/x" ]
+        def bruteForce(role, path):
+            result = set()
+            for k in key1, key2:
+                for r,p in k.getRoles():
+                    if r == role and thandy.formats.rolePathMatches(p, path):
+                        result.add(k.getKeyID())
+            return result
+        def check():
+            for role in thandy.formats.ALL_ROLES:
+                for path in paths:
+                    expected = bruteForce(role, path)
+                    got = keydb.getKeysByRole(role, path)
+                    self.assertEquals(len(got), len(expected))
+                    self.assertEquals(set(k.getKeyID() for k in got),
+                                      expected)
+                    self.assertEquals(keydb.getKeyIDsByRole(role, path),
+                                      expected)
+        check()
+        self.assertEquals(keydb.getKeyIDsByRole("package", "/pkginfo/ab/x"),
+                          set())
+
+        # Changing a key's roles invalidates the index.
+        key1.clearRoles()
+        key1.addRole("package", "/pkginfo/ab/*")
+        check()
+        self.assertEquals(keydb.getKeyIDsByRole("package", "/pkginfo/ab/x"),
+                          set([key1.getKeyID()]))
+
+class LocalRepositoryTests(RepositoryTestCase):
+    def test_update(self):
+        self.server.addBundle("tor", 2)
+        self.server.writeTimestamp()
+
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        rounds = self.update(client)
+        self.assertEquals(rounds[0], set([ "/meta/keys.txt",
+                                           "/meta/timestamp.txt",
+                                           "/meta/mirrors.txt" ]))
+        self.assertEquals(rounds[1], set([ "/bundleinfo/tor/tor-1.txt" ]))
+        self.assertEquals(rounds[2], set([ "/pkginfo/tor/p0-1.txt",
+                                           "/pkginfo/tor/p1-1.txt" ]))
+        self.assertEquals(rounds[3], set([ "/data/tor-0-1.bin",
+                                           "/data/tor-1-1.bin" ]))
+        self.assertEquals(len(rounds), 4)
+
+        # A new version of the bundle needs only the changed files.
+        self.server.addBundle("tor", 1, version=2)
+        self.server.writeTimestamp()
+        self.server.fetch(client, "/meta/timestamp.txt")
+        rounds = self.update(client)
+        self.assertEquals(rounds, [ set(["/bundleinfo/tor/tor-2.txt"]),
+                                    set(["/pkginfo/tor/p0-2.txt"]),
+                                    set(["/data/tor-0-2.bin"]) ])
+
+    def test_staleTimestamp(self):
+        self.server.addBundle("tor", 1)
+        self.server.writeTimestamp()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        self.update(client)
+
+        # A stale timestamp must be fetched again, and keeps us from
+        # going on to anything else.  A mirror that has nothing newer
+        # (or says so) can't change that: otherwise it could freeze us
+        # at an old version.
+        later = time.time() + 2*thandy.repository.MAX_TIMESTAMP_AGE
+        for _ in xrange(2):
+            need, _ = client.getFilesToUpdate(now=later,
+                                              trackingBundles=["**"],
+                                              usePackageSystem=False)
+            self.assertEquals(need, set([ "/meta/timestamp.txt" ]))
+            self.server.fetch(client, "/meta/timestamp.txt")
+
+        # A fresh one is fine.
+        need, _ = client.getFilesToUpdate(trackingBundles=["**"],
+                                          usePackageSystem=False)
+        self.assertEquals(need, set())
+
+    def test_delta(self):
+        self.server.addBundle("tor", 2)
+        self.server.writeTimestamp()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        self.update(client)
+
+        # We build the new version of each file from the old one and a
+        # delta, instead of fetching it.
+        self.server.addBundle("tor", 2, version=2, deltaFrom=1)
+        self.server.writeTimestamp()
+        self.server.fetch(client, "/meta/timestamp.txt")
+        rounds = self.update(client)
+        self.assertEquals(rounds, [ set(["/bundleinfo/tor/tor-2.txt"]),
+                                    set(["/pkginfo/tor/p0-2.txt",
+                                         "/pkginfo/tor/p1-2.txt"]),
+                                    set(["/data/tor-0-2.bin.delta",
+                                         "/data/tor-1-2.bin.delta"]) ])
+        for i in xrange(2):
+            rp = "/data/tor-%d-2.bin" % i
+            self.assertEquals(contents(client.getFilename(rp)),
+                              "Contents of package tor/%d, version 2" % i)
+            self.assertFalse(os.path.exists(client.getFilename(rp + ".delta")))
+        self.assert_(isinstance(client.getRequestedFile(
+                    "/data/tor-0-2.bin.delta"), thandy.repository.PkgFile))
+
+        # If a delta doesn't work, we fetch the whole file.
+        rp = "/data/tor-0-2.bin"
+        os.unlink(client.getFilename(rp))
+        thandy.util.replaceFile(client.getFilename(rp + ".delta"),
+                                "Not a delta")
+        h = thandy.formats.getDigest(contents(os.path.join(
+                    self.server.root, rp[1:])))
+        self.assertFalse(client._applyDelta(rp, h, "/data/tor-0-1.bin",
+                                            rp + ".delta"))
+        self.assertFalse(os.path.exists(client.getFilename(rp)))
+        self.assertFalse(os.path.exists(client.getFilename(rp + ".delta")))
+        self.assertEquals(self.update(client), [ set([ rp ]) ])
+
+        # And if we don't have the old version, we don't try.
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        os.unlink(client.getFilename("/data/tor-1-1.bin"))
+        os.unlink(client.getFilename("/data/tor-1-2.bin"))
+        self.assertEquals(self.update(client),
+                          [ set([ "/data/tor-1-2.bin" ]) ])
+
+    def test_chunks(self):
+        self.server.addBundle("tor", 2, chunked=True)
+        self.server.writeTimestamp()
+        client = thandy.repository.LocalRepository(self.cacheRoot,
+                                                   useChunkStore=True)
+        rounds = self.update(client)
+        self.assertEquals(rounds[-2], set([ "/data/tor-0-1.bin.chunks",
+                                            "/data/tor-1-1.bin.chunks" ]))
+        chunks = rounds[-1]
+        self.assert_(len(chunks) > 4)
+        for rp in chunks:
+            self.assert_(rp.startswith("/chunks/"))
+            self.assert_(isinstance(client.getRequestedFile(rp),
+                                    thandy.repository.PkgFile))
+        for i in xrange(2):
+            rp = "/data/tor-%d-1.bin" % i
+            self.assertEquals(contents(client.getFilename(rp)),
+                              contents(os.path.join(self.server.root, rp[1:])))
+
+        # The next version shares most of its chunks with this one, so we
+        # only fetch the few that changed.
+        self.server.addBundle("tor", 2, version=2, chunked=True)
+        self.server.writeTimestamp()
+        self.server.fetch(client, "/meta/timestamp.txt")
+        rounds = self.update(client)
+        self.assertEquals(len(rounds), 4)
+        self.assertEquals(rounds[2], set([ "/data/tor-0-2.bin.chunks",
+                                           "/data/tor-1-2.bin.chunks" ]))
+        newChunks = rounds[3]
+        self.assert_(0 < len(newChunks) <= 6)
+        self.assertFalse(newChunks & chunks)
+        for i in xrange(2):
+            rp = "/data/tor-%d-2.bin" % i
+            self.assertEquals(contents(client.getFilename(rp)),
+                              contents(os.path.join(self.server.root, rp[1:])))
+
+        # Once we have the new version, we throw away the old one, and the
+        # chunks that only it used.
+        for i in xrange(2):
+            rp = "/data/tor-%d-1.bin" % i
+            self.assertFalse(os.path.exists(client.getFilename(rp)))
+            self.assertFalse(os.path.exists(client.getFilename(rp +
+                                                               ".chunks")))
+        used = set()
+        for i in xrange(2):
+            used.update(thandy.formats.getChunkPath(d) for d, _ in
+                        client._readChunkIndex("/data/tor-%d-2.bin.chunks" % i))
+        have = set()
+        for dirpath, _, filenames in os.walk(client.getFilename("/chunks")):
+            have.update("/chunks/%s/%s" % (os.path.basename(dirpath), fn)
+                        for fn in filenames)
+        self.assertEquals(have, used)
+        self.assertEquals(sorted(client._chunkedFiles),
+                          [ "/data/tor-0-2.bin", "/data/tor-1-2.bin" ])
+
+        # If we can't write the file we build, we fetch it whole.
+        rp = "/data/tor-1-2.bin"
+        os.unlink(client.getFilename(rp))
+        tmpName = client.getFilename(rp) + ".thandy-chunks"
+        os.mkdir(tmpName)
+        self.assertEquals(self.update(client), [ set([ rp ]) ])
+        os.rmdir(tmpName)
+
+        # A corrupt chunk gets fetched again.
+        rp = "/data/tor-0-2.bin"
+        os.unlink(client.getFilename(rp))
+        badChunk = sorted(newChunks)[0]
+        fname = client.getFilename(badChunk)
+        thandy.util.replaceFile(fname, "X" * os.stat(fname).st_size)
+        rounds = self.update(client)
+        self.assert_(badChunk in rounds[0])
+        self.assertEquals(contents(client.getFilename(rp)),
+                          contents(os.path.join(self.server.root, rp[1:])))
+
+        # Without the chunk store, we fetch files whole.
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        os.unlink(client.getFilename(rp))
+        self.assertEquals(self.update(client), [ set([ rp ]) ])
+
+    def test_parallelVerification(self):
+        for i in xrange(3):
+            self.server.addBundle("b%d" % i, 3)
+        self.server.writeTimestamp()
+
+        results = []
+        for workers in (0, 2):
+            client = thandy.repository.LocalRepository(
+                os.path.join(self.cacheRoot, str(workers)),
+                verifyWorkers=workers)
+            hashes, lengths = {}, {}
+            rounds = self.update(client, hashDict=hashes, lengthDict=lengths)
+            client.close()
+            # Check everything again from scratch.
+            client = thandy.repository.LocalRepository(
+                os.path.join(self.cacheRoot, str(workers)),
+                verifyWorkers=workers)
+            self.assertEquals(self.update(client), [])
+            results.append((rounds, hashes, lengths))
+            if workers:
+                self.assertNotEquals(client._verifyPool, None)
+            client.close()
+            self.assertEquals(client._verifyPool, None)
+            client.close()
+
+        self.assertEquals(results[0], results[1])
+
+    def test_persistentSignatureCache(self):
+        self.server.addBundle("tor", 2)
+        self.server.writeTimestamp()
+        # Verification workers use the cache too.
+        for workers in (0, 2):
+            root = os.path.join(self.cacheRoot, str(workers))
+            client = thandy.repository.LocalRepository(root,
+                persistSignatureCache=True, verifyWorkers=workers)
+            self.update(client)
+            client.saveCaches()
+            client.close()
+            sc = client.getSignatureCache()
+            # The keylist is checked again once its keys are imported.
+            self.assertEquals(sc.hits, 1)
+            nChecked = sc.misses
+
+            client = thandy.repository.LocalRepository(root,
+                persistSignatureCache=True, verifyWorkers=workers)
+            self.assertEquals(self.update(client), [])
+            if workers:
+                self.assertNotEquals(client._verifyPool, None)
+            client.close()
+            sc = client.getSignatureCache()
+            self.assertEquals((sc.hits, sc.misses), (nChecked, 0))
+
+    def test_validationCache(self):
+        self.server.addBundle("tor", 2)
+        self.server.writeTimestamp()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        self.update(client)
+        vc = client.getValidationCache()
+        nFiles = len(vc)
+        self.assertEquals(nFiles, 6)
+
+        # Reloading unchanged files doesn't validate them again.
+        allFiles = (client._metaFiles + client._bundleFiles.values() +
+                    client._packageFiles.values())
+        def clearAll():
+            for f in allFiles:
+                f.clear()
+        clearAll()
+        hits, misses = vc.hits, vc.misses
+        for f in allFiles:
+            f.load()
+        self.assertEquals((vc.hits, vc.misses), (hits + nFiles, misses))
+
+        # A changed file is validated, and a bad one is rejected.
+        fname = client.getFilename("/bundleinfo/tor/tor-1.txt")
+        content = open(fname).read()
+        open(fname, 'w').write(content + "\n")
+        clearAll()
+        client.getBundleFile("/bundleinfo/tor/tor-1.txt").load()
+        self.assertEquals(vc.misses, misses + 1)
+        self.assertEquals(len(vc), nFiles + 1)
+        open(fname, 'w').write(content.replace('"name"', '"nom"'))
+        clearAll()
+        self.assertRaises(thandy.FormatException,
+                          client.getBundleFile("/bundleinfo/tor/tor-1.txt").load)
+
+    def test_revalidation(self):
+        self.server.addBundle("tor", 2)
+        self.server.writeTimestamp()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        self.update(client)
+
+        # With nothing changed, we don't reload or recheck anything.
+        vc = client.getValidationCache()
+        sc = client.getSignatureCache()
+        counts = vc.hits, vc.misses, sc.hits, sc.misses
+        self.assertEquals(self.update(client), [])
+        self.assertEquals((vc.hits, vc.misses, sc.hits, sc.misses), counts)
+
+        # But we notice when a file changes on disk.
+        bfile = client.getBundleFile("/bundleinfo/tor/tor-1.txt")
+        obj = bfile.get()
+        self.assert_(bfile.isFresh())
+        fname = bfile.getPath()
+        content = open(fname).read()
+        thandy.util.replaceFile(fname, content + "\n")
+        self.assertFalse(bfile.isFresh())
+        self.assertEquals(self.update(client), [])
+        self.assert_(bfile.isFresh())
+        self.assertEquals(bfile.get(), obj)
+        self.assertEquals(vc.misses, counts[1] + 1)
+
+        os.unlink(fname)
+        self.assertEquals(self.update(client),
+                          [ set(["/bundleinfo/tor/tor-1.txt"]) ])
+
+    def test_incrementalPlan(self):
+        for i in xrange(10):
+            self.server.addBundle("b%d" % i, 2)
+        self.server.writeTimestamp()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        self.update(client)
+
+        self.assertEquals(self.update(client), [])
+        self.assertEquals((client._nPlanEvaluated, client._nPlanReused),
+                          (0, 30))
+
+        # A new version of one bundle only gets that bundle and its
+        # new package looked at.
+        self.server.addBundle("b3", 1, version=2)
+        self.server.writeTimestamp()
+        self.server.fetch(client, "/meta/timestamp.txt")
+        hashes = {}
+        self.assertEquals(self.update(client, hashDict=hashes),
+                          [ set(["/bundleinfo/b3/b3-2.txt"]),
+                            set(["/pkginfo/b3/p0-2.txt"]),
+                            set(["/data/b3-0-2.bin"]) ])
+        self.assertEquals((client._nPlanEvaluated, client._nPlanReused),
+                          (0, 29))
+        self.assert_("/pkginfo/b3/p0-2.txt" in hashes)
+        self.assertFalse("/pkginfo/b3/p0-1.txt" in hashes)
+
+        # A new keylist means checking everything again.
+        self.server.writeKeylist(time.time())
+        self.server.writeTimestamp()
+        self.server.fetch(client, "/meta/timestamp.txt")
+        self.server.fetch(client, "/meta/keys.txt")
+        self.assertEquals(self.update(client), [])
+        self.assertEquals((client._nPlanEvaluated, client._nPlanReused),
+                          (29, 0))
+
+    def test_speculativeFiles(self):
+        self.server.addBundle("tor", 2)
+        self.server.writeTimestamp()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        self.assertEquals(client.getSpeculativeFiles(["**"]), set())
+        def quarantine(rp, content=None):
+            if content is None:
+                content = contents(os.path.join(self.server.root, rp[1:]))
+            fn = client.getQuarantineFilename(rp)
+            thandy.util.ensureParentDir(fn)
+            thandy.util.replaceFile(fn, content)
+            return fn
+
+        # Once we have a timestamp, we can guess which bundles we'll need,
+        # before we can check it; and from those, which packages.
+        self.server.fetch(client, "/meta/timestamp.txt")
+        hashes, lengths = {}, {}
+        self.assertEquals(client.getSpeculativeFiles(["**"], hashes, lengths),
+                          set([ "/bundleinfo/tor/tor-1.txt" ]))
+        self.assertEquals(lengths["/bundleinfo/tor/tor-1.txt"],
+                          self.server.bundles[0][1])
+        quarantine("/bundleinfo/tor/tor-1.txt")
+        self.assertEquals(client.getSpeculativeFiles(["**"]),
+                          set([ "/pkginfo/tor/p0-1.txt",
+                                "/pkginfo/tor/p1-1.txt" ]))
+        quarantine("/pkginfo/tor/p0-1.txt")
+        bad = quarantine("/pkginfo/tor/p1-1.txt", "{}")
+        self.assertEquals(client.getSpeculativeFiles(["**"]),
+                          set([ "/pkginfo/tor/p1-1.txt" ]))
+
+        # Prefetched files are used only once checked files vouch for
+        # them; the rest are thrown away.
+        self.server.fetch(client, "/meta/keys.txt")
+        self.server.fetch(client, "/meta/mirrors.txt")
+        self.assertEquals(self.update(client),
+                          [ set([ "/pkginfo/tor/p1-1.txt" ]),
+                            set([ "/data/tor-0-1.bin",
+                                  "/data/tor-1-1.bin" ]) ])
+        self.assertFalse(os.path.exists(bad))
+        self.assertEquals(os.listdir(client.getQuarantineFilename("/pkginfo")),
+                          [ "tor" ])
+        self.assertEquals(os.listdir(client.getQuarantineFilename(
+                    "/pkginfo/tor")), [])
+        self.assertEquals(client.getSpeculativeFiles(["**"]), set())
+
+class DownloadTests(RepositoryTestCase):
+    def test_download(self):
+        self.server.addBundle("tor", 2)
+        self.server.writeTimestamp()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        # Prime the cache with the metadata we need to start.
+        for rp in ("/meta/keys.txt", "/meta/timestamp.txt",
+                   "/meta/mirrors.txt"):
+            self.server.fetch(client, rp)
+
+        # Downloads are checked as they arrive, without reading them back.
+        fileDigests = []
+        getFileDigest = thandy.formats.getFileDigest
+        def countingGetFileDigest(*args):
+            fileDigests.append(args[0])
+            return getFileDigest(*args)
+        rounds = []
+        while True:
+            hashes, lengths = {}, {}
+            need, _ = client.getFilesToUpdate(hashDict=hashes,
+                                              lengthDict=lengths,
+                                              trackingBundles=["**"],
+                                              usePackageSystem=False)
+            if not need:
+                break
+            rounds.append(need)
+            self.assert_(len(rounds) < 5)
+            thandy.formats.getFileDigest = countingGetFileDigest
+            try:
+                self.assertEquals(self.download(client, need, hashes,
+                                                lengths), [])
+            finally:
+                thandy.formats.getFileDigest = getFileDigest
+        self.assertEquals(len(rounds), 3)
+        self.assertEquals(fileDigests, [])
+        self.assertEquals(contents(client.getFilename("/data/tor-1-1.bin")),
+                          "Contents of package tor/1, version 1")
+
+        # A file with the wrong hash is rejected and removed.
+        rp = "/data/tor-0-1.bin"
+        job = thandy.download.ThandyDownloadJob(
+            rp, os.path.join(self._dir, "out"), self.mirrorlist(),
+            wantHash="X"*32, repoFile=client.getRequestedFile(rp))
+        self.assertNotEquals(job.download(), None)
+        self.assertFalse(os.path.exists(job._tmpPath))
+        self.assertFalse(os.path.exists(os.path.join(self._dir, "out")))
+
+    def test_resumeFromCheckpoint(self):
+        if not thandy.download.ResumableSHA256.isAvailable():
+            return
+        http = self.startHTTPServer()
+        mirrors = self.mirrorlist(http.getURL())
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        data = os.urandom(300*1024)
+        rp = "/data/big.bin"
+        self.server.writeFile(rp, data)
+        h = thandy.formats.getDigest(data)
+        dest = client.getFilename(rp)
+        def job():
+            return thandy.download.ThandyDownloadJob(
+                rp, dest, mirrors, wantHash=h, wantLength=len(data),
+                repoFile=thandy.repository.PkgFile(client, rp, h))
+
+        oldInterval = thandy.download._CHECKPOINT_INTERVAL
+        thandy.download._CHECKPOINT_INTERVAL = 64*1024
+        try:
+            # The connection drops partway through.
+            http.failAfter = 200*1024
+            j = job()
+            self.assertNotEquals(j.download(), None)
+            self.assertEquals(os.stat(j._tmpPath).st_size, 200*1024)
+            self.assert_(os.path.exists(j._getCheckpointPath()))
+
+            # We resume without rehashing what we had.
+            http.failAfter = None
+            j = job()
+            self.assertEquals(j.download(), None)
+            self.assertEquals(contents(dest), data)
+            self.assertEquals(j._bytesRehashed, 0)
+            self.assertEquals(http.requests[-1][1].get("range"),
+                              "bytes=%d-" % (200*1024))
+            self.assertFalse(os.path.exists(j._tmpPath))
+            self.assertFalse(os.path.exists(j._getCheckpointPath()))
+
+            # If the checkpoint doesn't match the file, we rehash it all.
+            os.unlink(dest)
+            http.failAfter = 100*1024
+            j = job()
+            self.assertNotEquals(j.download(), None)
+            f = open(j._tmpPath, 'r+b')
+            f.seek(100*1024 - 1)
+            f.write(chr(ord(data[100*1024 - 1]) ^ 1))
+            f.close()
+            http.failAfter = None
+            j = job()
+            # The corrupt byte gets caught.
+            self.assertNotEquals(j.download(), None)
+            self.assertEquals(j._bytesRehashed, 100*1024)
+            self.assertFalse(os.path.exists(j._tmpPath))
+            j = job()
+            self.assertEquals(j.download(), None)
+            self.assertEquals(contents(dest), data)
+        finally:
+            thandy.download._CHECKPOINT_INTERVAL = oldInterval
+
+    def test_connectionPool(self):
+        self.server.addBundle("tor", 3)
+        http = self.startHTTPServer()
+        mirrors = self.mirrorlist(http.getURL())
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        pool = thandy.download.ConnectionPool(maxPerHost=1)
+        def fetch(rp):
+            job = thandy.download.ThandyDownloadJob(rp, client.getFilename(rp),
+                                                    mirrors)
+            job.setConnectionPool(pool)
+            return job.download()
+
+        # Several downloads share a single connection, even after an error.
+        for i in xrange(3):
+            self.assertEquals(fetch("/data/tor-%d-1.bin" % i), None)
+        self.assertNotEquals(fetch("/data/missing"), None)
+        self.assertEquals(fetch("/pkginfo/tor/p0-1.txt"), None)
+        self.assertEquals(len(set(r[2] for r in http.requests)), 1)
+        self.assertEquals((pool.nCreated, pool.nReused), (1, 4))
+
+        # Idle connections time out.
+        pool._idleTimeout = 0
+        time.sleep(0.01)
+        self.assertEquals(fetch("/data/tor-0-1.bin"), None)
+        self.assertEquals(len(set(r[2] for r in http.requests)), 2)
+        self.assertEquals((pool.nCreated, pool.nReused), (2, 4))
+        pool._idleTimeout = 60
+
+        # We don't open more than maxPerHost connections to a host.
+        url = http.getURL() + "/data/tor-1-1.bin"
+        resp1 = pool.open(url, False, {})
+        opened = []
+        t = threading.Thread(target=lambda: opened.append(
+                pool.open(url, False, {})))
+        t.start()
+        time.sleep(0.1)
+        self.assertEquals(opened, [])
+        resp1.read()
+        resp1.close()
+        t.join()
+        self.assertEquals(opened[0].read(), "Contents of package tor/1, "
+                          "version 1")
+        opened[0].close()
+        self.assertEquals((pool.nCreated, pool.nReused), (2, 6))
+        pool.closeAll()
+        self.assertEquals(pool._nOpen.values(), [0])
+
+    def test_redirects(self):
+        self.server.addBundle("tor", 2)
+        http1 = self.startHTTPServer()
+        http2 = thandy.benchmarks.LocalMirror(self.server.root)
+        try:
+            http1.redirects = {
+                "/data/tor-0-1.bin" : "/moved/tor-0-1.bin",
+                "/moved/tor-0-1.bin" : http2.getURL() + "/data/tor-0-1.bin",
+                "/data/tor-1-1.bin" : "ftp://example.com/tor-1-1.bin",
+                "/data/loop" : "/data/loop" }
+            mirrors = self.mirrorlist(http1.getURL())
+            client = thandy.repository.LocalRepository(self.cacheRoot)
+            pool = thandy.download.ConnectionPool()
+            manager = thandy.asyncdownload.EventLoopDownloadManager()
+            manager.start()
+            results = {}
+            for rp, ok in [ ("/data/tor-0-1.bin", True),
+                            ("/data/tor-1-1.bin", False),
+                            ("/data/loop", False) ]:
+                # We follow redirects to http URLs, but not forever.
+                job = thandy.download.ThandyDownloadJob(
+                    rp, client.getFilename(rp), mirrors)
+                job.setConnectionPool(pool)
+                self.assertEquals(job.download() is None, ok)
+                if ok:
+                    os.unlink(client.getFilename(rp))
+
+                # So does the event loop.
+                manager.statusLog = thandy.download.DownloadStatusLog()
+                job = thandy.download.ThandyDownloadJob(
+                    rp, client.getFilename(rp), mirrors)
+                job.setCallbacks(lambda rp=rp: results.__setitem__(rp, True),
+                                 lambda rp=rp: results.__setitem__(rp, False))
+                manager.addDownloadJob(job)
+                manager.wait()
+                self.assertEquals(results[rp], ok)
+            self.assertEquals(manager.nThreaded, 0)
+            self.assertEquals(contents(client.getFilename("/data/tor-0-1.bin")),
+                              "Contents of package tor/0, version 1")
+            self.assertEquals(len(http2.requests), 2)
+            self.assertEquals(len([ r for r in http1.requests
+                                    if r[0] == "/data/loop" ]),
+                              2 * (thandy.download._MAX_REDIRECTS + 1))
+            pool.closeAll()
+        finally:
+            http2.stop()
+
+    def test_mirrorLimit(self):
+        self.server.addBundle("tor", 1)
+        http1 = self.startHTTPServer()
+        http2 = self.startHTTPServer()
+        mirrors = { 'mirrors' : [] }
+        for h in http1, http2:
+            mirrors['mirrors'].extend(self.mirrorlist(h.getURL())['mirrors'])
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        pool = thandy.download.ConnectionPool(maxPerHost=1)
+        url = http1.getURL() + "/data/tor-0-1.bin"
+        resp = pool.open(url, False, {})
+        self.assert_(pool.isBusy(url, False))
+        self.assertFalse(pool.isBusy(http2.getURL() + "/x", False))
+
+        # While we're using our only connection to one mirror, downloads
+        # go to the other one.
+        for i in xrange(5):
+            rp = "/pkginfo/tor/p0-1.txt"
+            job = thandy.download.ThandyDownloadJob(rp, client.getFilename(rp),
+                                                    mirrors)
+            job.setConnectionPool(pool)
+            self.assertEquals(job.download(), None)
+        self.assertEquals(len(http2.requests), 5)
+        resp.read()
+        resp.close()
+        self.assertFalse(pool.isBusy(url, False))
+        pool.closeAll()
+
+    def test_workerPool(self):
+        manager = thandy.download.DownloadManager(n_threads=1, maxThreads=3)
+        for i in xrange(10):
+            manager.downloadQueue.put(thandy.download.SimpleDownloadJob(
+                    "/tmp/x", "http://example.com/%d" % i))
+        now = manager._sampleStart
+        interval = thandy.download._POOL_SAMPLE_INTERVAL
+        def sample(nBytes):
+            manager._adjustPool(nBytes, now + interval)
+            return manager._target
+
+        # We add threads while they help, up to maxThreads ...
+        self.assertEquals(sample(1000), 2)
+        now += interval
+        self.assertEquals(sample(2000), 3)
+        now += interval
+        self.assertEquals(sample(3000), 3)
+        # ... and drop one when throughput gets worse ...
+        now += interval
+        self.assertEquals(sample(1000), 2)
+        now += interval
+        self.assertEquals(sample(1000), 2)
+        # ... and drop to the minimum when nothing is queued.
+        while not manager.downloadQueue.empty():
+            manager.downloadQueue.get()
+        now += interval
+        self.assertEquals(sample(1000), 1)
+        self.assertEquals(manager.threads, [])
+
+        # Threads that are waiting for work retire when the pool shrinks.
+        manager._target = manager._minThreads = 3
+        manager.start()
+        self.assertEquals(len(manager.threads), 3)
+        manager._lock.acquire()
+        try:
+            manager._minThreads = 1
+            manager._adjustPool(0, manager._sampleStart + interval)
+        finally:
+            manager._lock.release()
+        self.assertEquals(manager._target, 1)
+        deadline = time.time() + 10
+        while len(manager.threads) > 1 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEquals(len(manager.threads), 1)
+
+    def test_waitForAny(self):
+        self.server.addBundle("tor", 3)
+        http = self.startHTTPServer()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        for manager in (thandy.download.DownloadManager(),
+                        thandy.asyncdownload.EventLoopDownloadManager()):
+            manager.start()
+            done = []
+            for i in xrange(3):
+                rp = "/data/tor-%d-1.bin" % i
+                job = thandy.download.ThandyDownloadJob(
+                    rp, client.getFilename(rp), self.mirrorlist(http.getURL()))
+                job.setCallbacks(lambda rp=rp: done.append(rp),
+                                 lambda: None)
+                manager.addDownloadJob(job)
+            # We can stop waiting as soon as one job is done, and plan
+            # what to fetch next.
+            manager.wait(anyJob=True)
+            self.assert_(len(done) >= 1)
+            manager.wait()
+            self.assertEquals(len(done), 3)
+            self.assert_(manager.finished())
+
+    def test_retryScheduler(self):
+        self.server.addBundle("tor", 3)
+        http1 = self.startHTTPServer()
+        http2 = thandy.benchmarks.LocalMirror(self.server.root)
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        try:
+            for manager in (thandy.download.DownloadManager(),
+                            thandy.asyncdownload.EventLoopDownloadManager()):
+                log = manager.statusLog
+                log.failed(thandy.download.DownloadFailure.mirrorFailed(
+                        http1.getURL(), "/data/x"))
+                manager.start()
+                done = []
+                for i, h in enumerate((http1, http1, http2)):
+                    rp = "/data/tor-%d-1.bin" % i
+                    job = thandy.download.ThandyDownloadJob(
+                        rp, client.getFilename(rp),
+                        self.mirrorlist(h.getURL()))
+                    job.setCallbacks(lambda rp=rp: done.append(rp),
+                                     lambda: None)
+                    manager.addDownloadJob(job)
+
+                # The files on the mirror we're waiting to retry are held
+                # back; the other one isn't held up by them.
+                manager.wait(anyJob=True)
+                self.assertEquals(done, [ "/data/tor-2-1.bin" ])
+                self.assertEquals(len(manager._delayed), 2)
+                self.assertFalse(manager.finished())
+
+                # Once we're willing to retry the mirror, they go ahead.
+                log._mirrorFailures[http1.getURL()][1] -= 3600
+                manager._delayed = [ (t - 3600, n, j)
+                                     for t, n, j in manager._delayed ]
+                manager.wait()
+                self.assertEquals(sorted(done),
+                                  [ "/data/tor-%d-1.bin" % i
+                                    for i in xrange(3) ])
+                self.assertEquals(manager._delayed, [])
+                for i in xrange(3):
+                    os.unlink(client.getFilename("/data/tor-%d-1.bin" % i))
+        finally:
+            http2.stop()
+
+    def test_conditionalGet(self):
+        self.server.addBundle("tor", 1)
+        http = self.startHTTPServer()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        rp = "/data/tor-0-1.bin"
+        fname = client.getFilename(rp)
+        for manager in (thandy.download.DownloadManager(),
+                        thandy.asyncdownload.EventLoopDownloadManager()):
+            manager.start()
+            log = manager.statusLog
+            def fetch():
+                job = thandy.download.ThandyDownloadJob(
+                    rp, fname, self.mirrorlist(http.getURL()))
+                done = []
+                job.setCallbacks(lambda: done.append(True),
+                                 lambda: done.append(False))
+                manager.addDownloadJob(job)
+                manager.wait()
+                self.assertEquals(done, [ True ])
+                return job, http.requests[-1][1]
+
+            # The first time, we remember what the mirror told us.
+            job, headers = fetch()
+            self.assertFalse(job.wasNotModified())
+            self.assertFalse("if-none-match" in headers)
+            urlbase, etag, lastModified, _ = log.getValidators(rp)
+            self.assertEquals(urlbase, http.getURL())
+            self.assert_(etag and lastModified)
+
+            # The next time, the mirror tells us we have it already.
+            job, headers = fetch()
+            self.assert_(job.wasNotModified())
+            self.assertEquals(headers["if-none-match"], etag)
+            self.assertEquals(contents(fname),
+                              "Contents of package tor/0, version 1")
+
+            # If it changes on the mirror, we get the new version.
+            self.server.writeFile(rp, "New contents")
+            job, headers = fetch()
+            self.assertFalse(job.wasNotModified())
+            self.assertEquals(contents(fname), "New contents")
+            self.assertNotEquals(log.getValidators(rp)[1], etag)
+
+            # If our copy doesn't match what we fetched, we ask for the
+            # whole file.
+            thandy.util.replaceFile(fname, "Garbage")
+            job, headers = fetch()
+            self.assertFalse(job.wasNotModified())
+            self.assertFalse("if-none-match" in headers)
+            self.assertEquals(contents(fname), "New contents")
+
+            self.server.writeFile(rp, "Contents of package tor/0, version 1")
+            os.unlink(fname)
+
+        # Validators survive a restart.
+        log2 = thandy.download.DownloadStatusLog.fromJSON(
+            json.loads(json.dumps(log.toJSON())))
+        self.assertEquals(log2.getValidators(rp), log.getValidators(rp))
+
+    def test_compressed(self):
+        # Random hex digits: big, but compressible.
+        data = os.urandom(300*1024).encode("hex")
+        h = thandy.formats.getDigest(data)
+        rp = "/data/big.bin"
+        self.server.writeFile(rp, data)
+        gzData = thandy.util.gzipString(data)
+        self.server.writeFile(rp + ".gz", gzData)
+        http = self.startHTTPServer()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        fname = client.getFilename(rp)
+        plain = self.mirrorlist(http.getURL())
+        compressed = self.mirrorlist(http.getURL())
+        compressed['mirrors'][0]['compressed'] = [ "/data/**" ]
+        thandy.formats.MIRRORLIST_SCHEMA.checkMatch(
+            dict(compressed, _type="Mirrorlist", ts="2008-09-13 00:19:32"))
+
+        for manager in (thandy.download.DownloadManager(),
+                        thandy.asyncdownload.EventLoopDownloadManager()):
+            manager.start()
+            def fetch(mirrors):
+                job = thandy.download.ThandyDownloadJob(
+                    rp, fname, mirrors, wantHash=h, wantLength=len(data),
+                    repoFile=thandy.repository.PkgFile(client, rp, h))
+                done = []
+                job.setCallbacks(lambda: done.append(True),
+                                 lambda: done.append(False))
+                manager.addDownloadJob(job)
+                manager.wait()
+                manager.statusLog = thandy.download.DownloadStatusLog()
+                return job, done[0], http.requests[-1]
+
+            # A mirror can compress the file on the fly.
+            http.gzip = True
+            job, ok, (path, headers, _) = fetch(plain)
+            self.assert_(ok)
+            self.assertEquals(headers.get("accept-encoding"), "gzip")
+            self.assertEquals(job.getTransferStats()[1], len(gzData))
+            self.assertEquals(contents(fname), data)
+            os.unlink(fname)
+            http.gzip = False
+
+            # Or keep a gzipped copy, which we can resume.
+            http.failAfter = 100*1024
+            job, ok, (path, headers, _) = fetch(compressed)
+            self.assertFalse(ok)
+            self.assertEquals(path, rp + ".gz")
+            self.assertEquals(os.stat(job._getEncodedPath()).st_size,
+                              100*1024)
+            http.failAfter = None
+            job, ok, (path, headers, _) = fetch(compressed)
+            self.assert_(ok)
+            self.assertEquals((path, headers.get("range")),
+                              (rp + ".gz", "bytes=%d-" % (100*1024)))
+            self.assertEquals(job.getTransferStats()[1],
+                              len(gzData) - 100*1024)
+            self.assertEquals(contents(fname), data)
+            self.assertFalse(os.path.exists(job._getEncodedPath()))
+            os.unlink(fname)
+
+            # If the next mirror has no gzipped copy, we resume the file
+            # itself, from what we decompressed.
+            http.failAfter = 100*1024
+            job, ok, _ = fetch(compressed)
+            self.assertFalse(ok)
+            have = os.stat(job._tmpPath).st_size
+            self.assert_(have > 100*1024)
+            http.failAfter = None
+            job, ok, (path, headers, _) = fetch(plain)
+            self.assert_(ok)
+            self.assertEquals((path, headers.get("range")),
+                              (rp, "bytes=%d-" % have))
+            self.assertEquals(contents(fname), data)
+            self.assertFalse(os.path.exists(job._getEncodedPath()))
+            os.unlink(fname)
+
+        # A gzipped copy that doesn't decompress is no good, and neither
+        # is one that decompresses to something too long.
+        for bad in ("X" * 1000, thandy.util.gzipString(data + "X")):
+            self.server.writeFile(rp + ".gz", bad)
+            job = thandy.download.ThandyDownloadJob(
+                rp, fname, compressed, wantHash=h, wantLength=len(data),
+                repoFile=thandy.repository.PkgFile(client, rp, h))
+            self.assert_(job.download() is not None)
+            self.assertFalse(os.path.exists(fname))
+            if os.path.exists(job._tmpPath):
+                job._removeTmpFile()
+
+    def test_eventLoopMirrorLimit(self):
+        self.server.addBundle("tor", 4)
+        http1 = self.startHTTPServer()
+        http1.delay = 0.3
+        http2 = thandy.benchmarks.LocalMirror(self.server.root, 0.3)
+        try:
+            mirrors = { 'mirrors' : [] }
+            for h in http1, http2:
+                mirrors['mirrors'].extend(
+                    self.mirrorlist(h.getURL())['mirrors'])
+            client = thandy.repository.LocalRepository(self.cacheRoot)
+            manager = thandy.asyncdownload.EventLoopDownloadManager(
+                maxPerMirror=1)
+            manager.start()
+            for i in xrange(4):
+                rp = "/data/tor-%d-1.bin" % i
+                manager.addDownloadJob(thandy.download.ThandyDownloadJob(
+                    rp, client.getFilename(rp), mirrors))
+
+            # With one connection per mirror, the jobs take turns: two at
+            # a time, one on each mirror.
+            t = time.time()
+            manager.wait()
+            self.assert_(time.time() - t >= 0.55)
+            self.assertEquals((len(http1.requests), len(http2.requests)),
+                              (2, 2))
+            self.assertEquals(manager.nEventLoop, 4)
+            for i in xrange(4):
+                self.assert_(os.path.exists(
+                    client.getFilename("/data/tor-%d-1.bin" % i)))
+            self.assertEquals(manager.connectionPool._nOpen.values(),
+                              [0, 0])
+        finally:
+            http2.stop()
+
+    def test_eventLoopResolver(self):
+        self.server.addBundle("tor", 2)
+        http = self.startHTTPServer()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        manager = thandy.asyncdownload.EventLoopDownloadManager()
+        manager.start()
+        done = []
+        # Looking up "localhost" is slow, but it doesn't hold up a
+        # download from a numeric address.  The first address we get
+        # for it refuses connections, so we try the next one.
+        port = int(http.getURL().split(":")[-1])
+        dead = socket.socket()
+        dead.bind(("127.0.0.1", 0))
+        deadAddress = dead.getsockname()
+        dead.close()
+        realGetaddrinfo = socket.getaddrinfo
+        def slowGetaddrinfo(host, *args):
+            if host != "localhost" or len(args) >= 5:
+                return realGetaddrinfo(host, *args)
+            time.sleep(1)
+            return [ (socket.AF_INET, socket.SOCK_STREAM, 0, '',
+                      deadAddress) ] + realGetaddrinfo(host, *args)
+        socket.getaddrinfo = slowGetaddrinfo
+        try:
+            for i, url in enumerate(("http://localhost:%d" % port,
+                                     http.getURL())):
+                rp = "/data/tor-%d-1.bin" % i
+                job = thandy.download.ThandyDownloadJob(
+                    rp, client.getFilename(rp), self.mirrorlist(url))
+                job.setCallbacks(lambda rp=rp: done.append(rp),
+                                 lambda: None)
+                manager.addDownloadJob(job)
+            start = time.time()
+            manager.wait(anyJob=True)
+            self.assertEquals(done, [ "/data/tor-1-1.bin" ])
+            self.assert_(time.time() - start < 0.5)
+            manager.wait()
+        finally:
+            socket.getaddrinfo = realGetaddrinfo
+        self.assertEquals(done, [ "/data/tor-1-1.bin", "/data/tor-0-1.bin" ])
+        self.assert_(("localhost", port) in manager._resolver._cache)
+
+    def test_eventLoop(self):
+        self.server.addBundle("tor", 3)
+        data = os.urandom(300*1024)
+        self.server.writeFile("/data/big.bin", data)
+        bigHash = thandy.formats.getDigest(data)
+        http = self.startHTTPServer()
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        manager = thandy.asyncdownload.EventLoopDownloadManager()
+        manager.start()
+        results = {}
+        def fetch(rp, mirrors, **kwargs):
+            job = thandy.download.ThandyDownloadJob(
+                rp, client.getFilename(rp), mirrors, **kwargs)
+            job.setCallbacks(lambda: results.__setitem__(rp, True),
+                             lambda: results.__setitem__(rp, False))
+            manager.addDownloadJob(job)
+            return job
+
+        # Several HTTP downloads run at once in the event loop; others
+        # go to the worker thread.
+        for i in xrange(3):
+            fetch("/data/tor-%d-1.bin" % i, self.mirrorlist(http.getURL()))
+        fetch("/data/missing", self.mirrorlist(http.getURL()))
+        fetch("/pkginfo/tor/p0-1.txt", self.mirrorlist())
+        manager.wait()
+        self.assertEquals(results, { "/data/tor-0-1.bin" : True,
+                                     "/data/tor-1-1.bin" : True,
+                                     "/data/tor-2-1.bin" : True,
+                                     "/data/missing" : False,
+                                     "/pkginfo/tor/p0-1.txt" : True })
+        self.assertEquals((manager.nEventLoop, manager.nThreaded), (4, 1))
+        self.assertEquals(contents(client.getFilename("/data/tor-2-1.bin")),
+                          "Contents of package tor/2, version 1")
+        self.assert_(manager.finished())
+
+        # Interrupted downloads resume where they left off.
+        manager.statusLog = thandy.download.DownloadStatusLog()
+        http.failAfter = 100*1024
+        job = fetch("/data/big.bin", self.mirrorlist(http.getURL()),
+                    wantHash=bigHash, wantLength=len(data),
+                    repoFile=thandy.repository.PkgFile(client,
+                                                       "/data/big.bin",
+                                                       bigHash))
+        manager.wait()
+        self.assertEquals(results["/data/big.bin"], False)
+        self.assertEquals(os.stat(job._tmpPath).st_size, 100*1024)
+        http.failAfter = None
+        manager.statusLog = thandy.download.DownloadStatusLog()
+        job = fetch("/data/big.bin", self.mirrorlist(http.getURL()),
+                    wantHash=bigHash, wantLength=len(data),
+                    repoFile=thandy.repository.PkgFile(client,
+                                                       "/data/big.bin",
+                                                       bigHash))
+        manager.wait()
+        self.assertEquals(results["/data/big.bin"], True)
+        self.assertEquals(contents(client.getFilename("/data/big.bin")), data)
+        self.assertEquals(http.requests[-1][1].get("range"),
+                          "bytes=%d-" % (100*1024))
+
+        # We can go through a SOCKS4a proxy.
+        proxy = SocksProxy()
+        oldProxy = (thandy.socksurls.SOCKS_HOST, thandy.socksurls.SOCKS_PORT)
+        thandy.socksurls.setSocksProxy(*proxy.server_address)
+        try:
+            rp = "/data/tor-0-1.bin"
+            os.unlink(client.getFilename(rp))
+            fetch(rp, self.mirrorlist("http://localhost:%d"
+                                      % http.server_address[1]),
+                  useTor=True)
+            manager.wait()
+        finally:
+            thandy.socksurls.setSocksProxy(*oldProxy)
+            proxy.stop()
+        self.assertEquals(results[rp], True)
+        self.assertEquals(proxy.connections, [("localhost",
+                                               http.server_address[1])])
+        self.assertEquals(contents(client.getFilename(rp)),
+                          "Contents of package tor/0, version 1")
+
+    def test_segmented(self):
+        data = os.urandom(1024*1024)
+        rp = "/data/big.bin"
+        h = thandy.formats.getDigest(data)
+        self.server.writeFile(rp, data)
+        fast = self.startHTTPServer()
+        slow = thandy.benchmarks.LocalMirror(self.server.root, delay=0.3)
+        badRoot = os.path.join(self._dir, "bad")
+        os.makedirs(os.path.join(badRoot, "data"))
+        f = open(os.path.join(badRoot, "data", "big.bin"), 'wb')
+        f.write(data[:-1] + chr(ord(data[-1]) ^ 1))
+        f.close()
+        bad = thandy.benchmarks.LocalMirror(badRoot, delay=0.05)
+        missing = thandy.benchmarks.LocalMirror(self._dir)
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        dest = client.getFilename(rp)
+        def fetch(*servers):
+            mirrors = { 'mirrors' : [] }
+            for s in servers:
+                mirrors['mirrors'].extend(self.mirrorlist(s.getURL())
+                                          ['mirrors'])
+            log = thandy.download.DownloadStatusLog()
+            job = thandy.download.ThandyDownloadJob(
+                rp, dest, mirrors, wantHash=h, wantLength=len(data),
+                repoFile=thandy.repository.PkgFile(client, rp, h),
+                downloadStatusLog=log)
+            self.assertFalse(job._usesTransfers)
+            return job, job.download(), log
+
+        saved = (thandy.download._MIN_SEGMENTED_LENGTH,
+                 thandy.download._SEGMENT_SIZE,
+                 thandy.download._MIN_SEGMENT_SPLIT)
+        (thandy.download._MIN_SEGMENTED_LENGTH,
+         thandy.download._SEGMENT_SIZE,
+         thandy.download._MIN_SEGMENT_SPLIT) = (64*1024, 64*1024, 8*1024)
+        try:
+            # The fast mirror does most of the work, and takes over part
+            # of what the slow one had.
+            nFast, nSlow = len(fast.requests), len(slow.requests)
+            job, failure, log = fetch(fast, slow)
+            self.assertEquals(failure, None)
+            self.assertEquals(contents(dest), data)
+            self.assert_(len(fast.requests) - nFast > 16)
+            self.assert_(len(slow.requests) - nSlow <= 2)
+            self.assertEquals(job.getMirror(), fast.getURL())
+            self.assertFalse(os.path.exists(job._tmpPath))
+
+            # A mirror that can't help us gets blamed, and the others
+            # finish the job.
+            os.unlink(dest)
+            job, failure, log = fetch(fast, missing)
+            self.assertEquals(failure, None)
+            self.assertEquals(contents(dest), data)
+            self.assertEquals(log._mirrorFailures.keys(), [missing.getURL()])
+
+            # If the file is bad, we blame every mirror that sent us part
+            # of it.
+            os.unlink(dest)
+            job, failure, log = fetch(bad, slow)
+            self.assertNotEquals(failure, None)
+            log.failed(failure)
+            self.assertEquals(sorted(log._mirrorFailures.keys()),
+                              sorted([bad.getURL(), slow.getURL()]))
+            self.assertEquals(log._netFailure[0], 0)
+            self.assertFalse(os.path.exists(dest))
+            self.assertFalse(os.path.exists(job._tmpPath))
+        finally:
+            (thandy.download._MIN_SEGMENTED_LENGTH,
+             thandy.download._SEGMENT_SIZE,
+             thandy.download._MIN_SEGMENT_SPLIT) = saved
+            for s in (slow, bad, missing):
+                s.stop()
+
+    def test_hedge(self):
+        self.server.addBundle("tor", 1)
+        rp = "/data/tor-0-1.bin"
+        data = contents(os.path.join(self.server.root, rp[1:]))
+        h = thandy.formats.getDigest(data)
+        fast = self.startHTTPServer()
+        slow = thandy.benchmarks.LocalMirror(self.server.root, delay=1.0)
+        missing = thandy.benchmarks.LocalMirror(self._dir)
+        client = thandy.repository.LocalRepository(self.cacheRoot)
+        dest = client.getFilename(rp)
+        def job(first, second, **kwargs):
+            # We almost always try 'first' first.
+            mirrors = { 'mirrors' : [] }
+            for s, weight in ((first, 1000000), (second, 1)):
+                m = self.mirrorlist(s.getURL())['mirrors'][0]
+                m['weight'] = weight
+                mirrors['mirrors'].append(m)
+            if os.path.exists(dest):
+                os.unlink(dest)
+            return thandy.download.ThandyDownloadJob(
+                rp, dest, mirrors, wantHash=h, wantLength=len(data),
+                repoFile=thandy.repository.PkgFile(client, rp, h),
+                hedge=True, hedgeDelay=0.1, **kwargs)
+
+        try:
+            # If the first mirror is slow, the second one gives us the file.
+            t = time.time()
+            j = job(slow, fast)
+            self.assertEquals(j.download(), None)
+            self.assert_(time.time() - t < 0.9)
+            self.assertEquals(j.getMirror(), fast.getURL())
+            self.assertEquals(contents(dest), data)
+
+            # If the first mirror fails, we don't wait to ask the second.
+            log = thandy.download.DownloadStatusLog()
+            j = job(missing, slow, downloadStatusLog=log)
+            self.assertEquals(j.download(), None)
+            self.assertEquals(j.getMirror(), slow.getURL())
+            self.assertEquals(log._mirrorFailures.keys(), [missing.getURL()])
+
+            # The event loop can hedge too.
+            manager = thandy.asyncdownload.EventLoopDownloadManager()
+            results = []
+            for first, second in ((slow, fast), (missing, fast)):
+                j = job(first, second)
+                j.setCallbacks(lambda: results.append(True),
+                               lambda: results.append(False))
+                t = time.time()
+                manager.addDownloadJob(j)
+                manager.wait()
+                self.assert_(time.time() - t < 0.9)
+                self.assertEquals(j.getMirror(), fast.getURL())
+                self.assertEquals(contents(dest), data)
+            self.assertEquals(results, [True, True])
+            self.assertEquals(manager._hedges, [])
+            self.assert_(manager.finished())
+
+            # Big files don't get hedged.
+            j = job(slow, fast)
+            j._wantLength = thandy.download._MAX_HEDGED_LENGTH + 1
+            self.assertEquals(j._getHedgeMirrors(), None)
+        finally:
+            slow.stop()
+            missing.stop()
+
+    def test_resumableSHA256(self):
+        if not thandy.download.ResumableSHA256.isAvailable():
+            return
+        h1 = thandy.download.ResumableSHA256()
+        h1.update("abc")
+        self.assertEquals(h1.digest(), thandy.formats.getDigest("abc"))
+        h2 = thandy.download.ResumableSHA256(h1.getState())
+        h2.update("def")
+        self.assertEquals(h2.digest(), thandy.formats.getDigest("abcdef"))
+        self.assertEquals(h1.digest(), thandy.formats.getDigest("abc"))
+
+        # We refuse states that OpenSSL couldn't have made.
+        ResumableSHA256 = thandy.download.ResumableSHA256
+        fmt = ResumableSHA256._CTX_FORMAT
+        fields = list(struct.unpack(fmt, h1.getState()))
+        self.assertEquals(fields[8:10] + fields[26:], [ 24, 0, 3, 32 ])
+        ResumableSHA256(h1.getState(), 3)
+        self.assertRaises(ValueError, ResumableSHA256, h1.getState(), 4)
+        self.assertRaises(ValueError, ResumableSHA256, h1.getState()[1:])
+        for i, v in ((26, 64), (26, 4), (27, 28), (8, 25)):
+            bad = fields[:]
+            bad[i] = v
+            self.assertRaises(ValueError, ResumableSHA256,
+                              struct.pack(fmt, *bad))
+
+class DownloadStatusLogTests(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._explore = thandy.download._EXPLORE_PROBABILITY
+        thandy.download._EXPLORE_PROBABILITY = 0
+
+    def tearDown(self):
+        thandy.download._EXPLORE_PROBABILITY = self._explore
+        deltree(self._dir)
+
+    def test_mirrorStats(self):
+        fname = os.path.join(self._dir, "status.json")
+        log = thandy.download.DownloadStatusLog.load(fname)
+        mirrors = [ { 'urlbase' : name, 'weight' : 1 }
+                    for name in ("fast", "slow", "new") ]
+        def weights(log, length=None):
+            return dict((m['urlbase'], w) for w, m
+                        in log.weighMirrors(mirrors, length))
+
+        self.assertEquals(weights(log), { "fast" : 1, "slow" : 1, "new" : 1 })
+        for i in xrange(3):
+            log.noteTransfer("fast", 0.05, 1000000, 0.1)
+            log.noteTransfer("slow", 1.0, 1000000, 10)
+        w = weights(log)
+        self.assert_(w["fast"] > w["new"] > w["slow"])
+        # Throughput matters more for big files.
+        self.assert_(weights(log, 10000000)["slow"] < w["slow"])
+
+        # Errors count against a mirror.
+        log.failed(thandy.download.DownloadFailure.mirrorFailed("fast", "/x"))
+        self.assert_(weights(log)["fast"] < w["fast"])
+        log.succeeded("fast", "/x")
+
+        # What we know survives a restart, and fades with time.
+        w = weights(log)
+        log.save()
+        log2 = thandy.download.DownloadStatusLog.load(fname)
+        for k, v in weights(log2).items():
+            self.assertAlmostEquals(v, w[k], 2)
+        for st in log2._mirrorStats.values():
+            st[3] -= 30*24*3600
+        w2 = weights(log2)
+        self.assert_(w["fast"] > w2["fast"] > 1 > w2["slow"] > w["slow"])
+
+        # A bad file is ignored.
+        f = open(fname, 'w')
+        f.write("{ 'v' : 9 }")
+        f.close()
+        log = thandy.download.DownloadStatusLog.load(fname)
+        self.assertEquals(log._mirrorStats, {})
+
+class ValidationCacheTests(unittest.TestCase):
+    def test_lru(self):
+        vc = thandy.repository.ValidationCache(maxSize=4)
+        schema = thandy.formats.BUNDLE_SCHEMA
+        for i in xrange(4):
+            vc.add("raw%d" % i, schema, True, "d%d" % i)
+        self.assertEquals(vc.get("raw0", schema, True), "d0")
+        self.assertEquals(vc.get("raw0", schema, False), None)
+        self.assertEquals(vc.get("raw0", None, True), None)
+        self.assertEquals((vc.hits, vc.misses), (1, 2))
+
+        # Adding a fifth entry throws out the least recently used one.
+        vc.add("raw4", schema, True, "d4")
+        self.assertEquals(len(vc), 3)
+        self.assertEquals(vc.get("raw1", schema, True), None)
+        self.assertEquals(vc.get("raw2", schema, True), None)
+        for i in 0, 3, 4:
+            self.assertEquals(vc.get("raw%d" % i, schema, True), "d%d" % i)
+
+class DeltaTests(unittest.TestCase):
+    def test_delta(self):
+        r = random.Random("delta")
+        old = "".join(chr(r.randrange(256)) for _ in xrange(200*1024))
+        new = old[:50000] + "inserted" + old[50000:120000] + old[130000:]
+        delta = thandy.delta.makeDelta(old, new)
+        self.assert_(len(delta) < 20*1024)
+        out = cStringIO.StringIO()
+        digest = thandy.delta.applyDelta(cStringIO.StringIO(old),
+                                         cStringIO.StringIO(delta), out)
+        self.assertEquals(out.getvalue(), new)
+        self.assertEquals(digest, thandy.formats.getDigest(new))
+
+        # Nothing in common.
+        other = os.urandom(10000)
+        out = cStringIO.StringIO()
+        thandy.delta.applyDelta(cStringIO.StringIO(old),
+                                cStringIO.StringIO(
+                                    thandy.delta.makeDelta(old, other)), out)
+        self.assertEquals(out.getvalue(), other)
+
+        # Bad deltas.
+        header = thandy.delta.DELTA_MAGIC + struct.pack("!Q", 10)
+        for bad in [ "", "Not a delta" + "\0"*20, delta[:-1],
+                     delta[:len(delta)//2],
+                     header + "C" + struct.pack("!QQ", len(old)-5, 10) + "E",
+                     header + "A" + struct.pack("!Q", 5) + "abcde" + "E",
+                     header + "A" + struct.pack("!Q", 11) + "x"*11 + "E",
+                     header + "Q" ]:
+            self.assertRaises(thandy.FormatException,
+                              thandy.delta.applyDelta,
+                              cStringIO.StringIO(old),
+                              cStringIO.StringIO(bad),
+                              cStringIO.StringIO())
+
+class DownloadQueueTests(unittest.TestCase):
+    def job(self, relPath, length=None):
+        return thandy.download.ThandyDownloadJob(
+            relPath, "/tmp/x", { "mirrors" : [] }, wantLength=length)
+
+    def drain(self, q):
+        result = []
+        while not q.empty():
+            result.append(q.get().getRelativePath())
+        return result
+
+    def test_order(self):
+        q = thandy.download.DownloadQueue()
+        for relPath, length in [ ("/data/big.exe", 10000000),
+                                 ("/pkginfo/p/p.txt", 900),
+                                 ("/data/small.exe", 1000),
+                                 ("/meta/timestamp.txt", None),
+                                 ("/bundleinfo/b/b.txt", 2000) ]:
+            q.put(self.job(relPath, length), now=1000)
+        self.assertEquals(len(q), 5)
+        self.assertEquals(self.drain(q),
+                          [ "/meta/timestamp.txt", "/bundleinfo/b/b.txt",
+                            "/pkginfo/p/p.txt", "/data/small.exe",
+                            "/data/big.exe" ])
+        self.assertRaises(Queue.Empty, q.get, False)
+
+    def test_aging(self):
+        q = thandy.download.DownloadQueue(agingInterval=60)
+        q.put(self.job("/data/old.exe", 1000), now=1000)
+        q.put(self.job("/pkginfo/p/new.txt", 1000), now=1100)
+        q.put(self.job("/bundleinfo/b/new.txt", 1000), now=1200)
+        self.assertEquals(self.drain(q),
+                          [ "/data/old.exe", "/pkginfo/p/new.txt",
+                            "/bundleinfo/b/new.txt" ])
+
+    def test_reprioritize(self):
+        q = thandy.download.DownloadQueue()
+        q.put(self.job("/data/a.exe", 1000), now=1000)
+        q.put(self.job("/data/b.exe", 2000), now=1000)
+        q.put(self.job("/pkginfo/p/p.txt", 500), now=1000)
+        self.assert_(q.reprioritize("/data/b.exe",
+                                    thandy.download.PRIORITY_META))
+        self.assert_(not q.reprioritize("/data/missing.exe", 0))
+        self.assertEquals(len(q), 3)
+        self.assertEquals(self.drain(q),
+                          [ "/data/b.exe", "/pkginfo/p/p.txt", "/data/a.exe" ])
+        self.assert_(not q.reprioritize("/data/b.exe", 0))
 
 def suite():
     suite = unittest.TestSuite()
@@ -138,6 +2013,8 @@ def suite():
     suite.addTest(doctest.DocTestSuite(thandy.keys))
     suite.addTest(doctest.DocTestSuite(thandy.checkJson))
     suite.addTest(doctest.DocTestSuite(thandy.encodeToXML))
+    suite.addTest(doctest.DocTestSuite(thandy.download))
+    suite.addTest(doctest.DocTestSuite(thandy.delta))
 
     loader = unittest.TestLoader()
     suite.addTest(loader.loadTestsFromModule(thandy.tests))
@@ -1,5 +1,7 @@
 # Copyright 2008 The Tor Project, Inc.  See LICENSE for licensing information.
 
+import cStringIO
+import gzip
 import logging
 import os
 import re
@@ -104,6 +106,18 @@ def replaceFile(fname, contents, textMode=False):
 
     moveFile(fname_tmp, fname)
 
+def gzipString(contents):
+    """Return 'contents' compressed in gzip format.  The result depends
+       only on 'contents', so every mirror that compresses a file gets
+       the same bytes, and a download can resume from any of them."""
+    out = cStringIO.StringIO()
+    f = gzip.GzipFile(filename="", mode="wb", fileobj=out, mtime=0)
+    try:
+        f.write(contents)
+    finally:
+        f.close()
+    return out.getvalue()
+
 def userFilename(name):
     """Return a path relative to $THANDY_HOME or ~/.thandy whose final path
        component is 'name', creating parent directories as needed."""